@@ -0,0 +1,49 @@
+'''
+Measures how long it takes a fresh interpreter to import eureka's modules,
+and to create the default crawler on first use.
+
+Usage: PYTHONPATH=. python benchmarks/imports.py [repetitions]
+
+'''
+
+import os
+import subprocess
+import sys
+from timeit import default_timer as timer
+
+statements = [
+    ('python startup', 'pass'),
+    ('import eureka', 'import eureka'),
+    ('import eureka.misc', 'import eureka.misc'),
+    ('import eureka.cache', 'import eureka.cache'),
+    ('import eureka.crawler', 'import eureka.crawler'),
+    ('first use of crawler', 'from eureka.crawler import crawler; '
+                             'crawler.opener'),
+]
+
+def run(statement, repetitions):
+    ''' returns the fastest of ``repetitions`` runs, in seconds '''
+
+    env = dict(os.environ)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    best = None
+    for _ in xrange(repetitions):
+        start = timer()
+        subprocess.check_call([sys.executable, '-c', statement], env=env)
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(repetitions=10):
+    baseline = run('pass', repetitions)
+    for name, statement in statements:
+        elapsed = run(statement, repetitions)
+        sys.stdout.write('%-24s %7.1f ms  (+%.1f ms)\n' %
+                         (name, elapsed * 1000, (elapsed - baseline) * 1000))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
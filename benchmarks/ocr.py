@@ -0,0 +1,79 @@
+'''
+Benchmarks OCR throughput and accuracy, with and without preprocessing.
+
+Usage: PYTHONPATH=. python benchmarks/ocr.py fixture-directory [workers]
+
+The fixture directory contains images (png, jpg, gif, bmp or tif), each with
+a text file of the same name holding the expected text, eg. "scan1.png" and
+"scan1.txt". Accuracy is the average similarity between the recognized and
+expected text, from 0 (nothing right) to 1 (exact match).
+
+'''
+
+import os
+import sys
+from difflib import SequenceMatcher
+from timeit import default_timer as timer
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image # the original PIL
+from eureka.tesseract import OCRPool, image_to_string
+
+image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff')
+
+configurations = [
+    ('sequential, no preprocessing', None, None),
+    ('pool, no preprocessing', {}, None),
+    ('pool, grayscale + otsu', {}, dict(threshold='otsu')),
+    ('pool, otsu + deskew + crop', {},
+     dict(threshold='otsu', deskew=True, crop=True)),
+    ('pool, scale 2x + otsu + crop', {},
+     dict(scale=2, threshold='otsu', crop=True)),
+]
+
+def load_fixtures(directory):
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        base, extension = os.path.splitext(name)
+        expected = os.path.join(directory, base + '.txt')
+        if extension.lower() in image_extensions and os.path.exists(expected):
+            image = Image.open(os.path.join(directory, name))
+            image.load()
+            fixtures.append((image, open(expected).read().strip()))
+    return fixtures
+
+def similarity(text, expected):
+    return SequenceMatcher(None, ' '.join(text.split()),
+                           ' '.join(expected.split())).ratio()
+
+def main(directory, workers=4):
+    fixtures = load_fixtures(directory)
+    if not fixtures:
+        sys.exit('no images with expected text found in %s' % directory)
+    images = [image for image, _ in fixtures]
+
+    sys.stdout.write('%d images, %d workers\n' % (len(images), workers))
+    for name, pool_options, preprocess in configurations:
+        start = timer()
+        if pool_options is None:
+            texts = [image_to_string(image) for image in images]
+        else:
+            # a new pool per configuration, so that nothing is cached
+            with OCRPool(workers, preprocess=preprocess) as pool:
+                texts = list(pool.map(images))
+        elapsed = timer() - start
+
+        accuracy = sum(similarity(text, expected) for text, (_, expected)
+                       in zip(texts, fixtures)) / len(fixtures)
+        sys.stdout.write('%-32s %7.2f images/s   accuracy %.3f\n'
+                         % (name, len(images) / elapsed, accuracy))
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        main(sys.argv[1])
+    elif len(sys.argv) == 3:
+        main(sys.argv[1], int(sys.argv[2]))
+    else:
+        sys.exit(__doc__)
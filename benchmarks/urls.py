@@ -0,0 +1,110 @@
+'''
+Benchmarks the query-string helpers in eureka.misc against the
+implementations they replaced, and checks that both produce identical output.
+
+Usage: PYTHONPATH=. python benchmarks/urls.py [number-of-queries]
+
+'''
+
+import sys
+import urllib
+from timeit import default_timer as timer
+from urllib import quote_plus
+
+from eureka.misc import urlencode, urlencode_many, urldecode, urldecode_many
+
+# {{{ reference implementations
+def reference_urldecode(string):
+    for entry in string.split('&'):
+        if '=' in entry:
+            key, value = entry.split('=', 1)
+            yield urllib.unquote(key), urllib.unquote(value)
+        else:
+            yield urllib.unquote(entry), None
+
+def reference_urlencode(query, doseq=0):
+    if hasattr(query, 'items'):
+        query = query.items()
+    l = []
+    if not doseq:
+        for k, v in query:
+            k = quote_plus(str(k))
+            if v is None:
+                l.append(k)
+            else:
+                v = quote_plus(str(v))
+                l.append(k + '=' + v)
+    else:
+        for k, v in query:
+            k = quote_plus(str(k))
+            if isinstance(v, str):
+                v = quote_plus(v)
+                l.append(k + '=' + v)
+            elif isinstance(v, unicode):
+                v = quote_plus(v.encode("ASCII", "replace"))
+                l.append(k + '=' + v)
+            else:
+                if v is None:
+                    l.append(k)
+                else:
+                    try:
+                        x = len(v)
+                    except TypeError:
+                        v = quote_plus(str(v))
+                        l.append(k + '=' + v)
+                    else:
+                        for elt in v:
+                            if elt is None:
+                                elt = k
+                            l.append(k + '=' + quote_plus(str(elt)))
+    return '&'.join(l)
+# }}} reference implementations
+
+def make_queries(count):
+    ''' form submissions, as they are generated when iterating over a form '''
+
+    return [[('__VIEWSTATE', 'dDwtMTA4MzE0MjEwNTs7Pg==' * 8),
+             ('term', str(i % 4)), ('year', 2000 + i % 10),
+             ('subject', u'Math\xe9matiques'), ('submit', None),
+             ('days', ('M', 'W', 'F')), ('q', 'a b&c/%d' % i)]
+            for i in xrange(count)]
+
+def bench(name, function, *args):
+    start = timer()
+    result = function(*args)
+    sys.stdout.write('%-28s %8.1f ms\n' % (name, (timer() - start) * 1000))
+    return result
+
+def main(count=20000):
+    queries = make_queries(count)
+
+    for doseq in (0, 1):
+        if doseq:
+            inputs = queries
+        else:
+            # without doseq, only plain strings and numbers can be encoded
+            inputs = [[(k, v) for k, v in query
+                       if not isinstance(v, (tuple, unicode))]
+                      for query in queries]
+        sys.stdout.write('urlencode, doseq=%s, %s queries\n' % (doseq, count))
+        expected = bench('  reference', lambda: [reference_urlencode(q, doseq)
+                                                 for q in inputs])
+        single = bench('  urlencode', lambda: [urlencode(q, doseq)
+                                               for q in inputs])
+        batched = bench('  urlencode_many', urlencode_many, inputs, doseq)
+        assert expected == single == batched, 'urlencode output differs'
+
+    strings = expected
+    sys.stdout.write('urldecode, %s query strings\n' % count)
+    expected = bench('  reference', lambda: [list(reference_urldecode(s))
+                                             for s in strings])
+    single = bench('  urldecode', lambda: [list(urldecode(s))
+                                           for s in strings])
+    batched = bench('  urldecode_many', urldecode_many, strings)
+    assert expected == single == batched, 'urldecode output differs'
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -4,48 +4,169 @@ a lot faster.
 
 '''
 
+import calendar
+import os
+import threading
 import urllib
 import urllib2
 import httplib
 from StringIO import StringIO
-from sqlite3 import Binary
+from time import time, strptime
 
 from eureka import EurekaException
+from eureka.metrics import null_metrics, request_host, request_metrics
 from eureka.misc import urldecode
+from eureka.url import default_canonicalizer, default_ignored_parameters, \
+                       hostname, parameter_matcher
+
+# the same as sqlite3.Binary; sqlite3 is only imported once a connection is
+# opened, which keeps importing this module cheap
+Binary = buffer
+
+# columns that were added to the cache table after its first version
+_added_columns = (('delta_base', 'INTEGER'), ('fingerprint', 'CHAR(40)'),
+                  ('simhash', 'INTEGER'))
 
 class Cache(urllib2.BaseHandler):
     '''
     A database cache to store cached websites. If sqlite isn't installed, this
     does nothing.
 
+    Every thread uses its own connection to the database, so one cache can be
+    used by many threads at once. (Note that this means that every thread
+    sees a different database if ``database`` is ":memory:".)
+
+    If ``coalesce`` is True and several threads request the same page at the
+    same time, only the first one downloads it; the others wait for it to be
+    stored, and then read it from the cache. They wait for at most
+    ``coalesce_timeout`` seconds before downloading the page themselves.
+    Whoever opens requests with the cache must call ``release(request)``
+    once a request is done or failed; the crawler's opener does.
+
+    Requests whose ``no_cache`` attribute is True bypass the cache.
+
+    If ``deltas`` is True, and a request is cached again with another
+    cache-control (eg. in a daily re-crawl), the previous version of the
+    response is replaced by a delta against the new one (see
+    ``eureka.delta``), if that is much smaller. The newest version is always
+    stored in full, so reading it is as fast as before; older versions are
+    rebuilt from the chain of deltas. ``history(url)`` returns all versions.
+    Older versions are stored decompressed. Responses larger than
+    ``max_delta_size`` bytes are always stored in full.
+
+    The cache stores a fingerprint of every response (see
+    ``eureka.fingerprint``), and, if ``simhash`` is True, its simhash. Every
+    response that the cache returns has ``fingerprint`` and ``simhash``
+    attributes, and an ``unchanged`` attribute: True if a newly downloaded
+    response is the same as the previous version of the request (eg. with
+    another cache-control). A response from the cache is never unchanged,
+    because we can't know whether anyone used it before. The attributes are
+    set on the responses, not on the requests, because a redirect response
+    passes through the cache with the same request as the page it leads to.
+
     '''
 
     # call this handler after the cookie processor is done!
     handler_order = 300
     urllib2.HTTPCookieProcessor.handler_order = 200
 
-    def __init__(self, database='web-cache.sqlite'):
-        self._connection = None
+    metrics = null_metrics
+
+    coalesce_timeout = 120
+
+    max_delta_size = 4 << 20
+
+    # set by _create_tables for databases with cache entries from before urls
+    # were canonicalized
+    _verbatim_urls = False
+
+    def __init__(self, database='web-cache.sqlite',
+                 canonicalizer=default_canonicalizer, key_policy=None,
+                 coalesce=True, deltas=True, simhash=False):
+        '''
+        ``canonicalizer`` converts request urls into the url used as cache
+        key, so that equivalent urls share one cache entry. It should be an
+        ``eureka.url.URLCanonicalizer``, or None to use urls verbatim.
+        Databases that already had cache entries when url canonicalization
+        was introduced keep using verbatim urls, so that their entries
+        aren't lost; clear such a database to start using canonical urls.
+
+        ``key_policy`` decides which request headers are part of the cache
+        key. It should be a ``HeaderKeyPolicy``, and defaults to one that
+        ignores the Referer header and session cookies. If it is False, all
+        headers (except Accept-Encoding) are used.
+
+        '''
+
+        self._local = threading.local()
+        self._stale_connections = []
         self.database = database
+        self.canonicalizer = canonicalizer
+        if key_policy is None:
+            key_policy = default_key_policy
+        self.key_policy = key_policy
+        self.coalesce = coalesce
+        self.deltas = deltas
+        self.simhash = simhash
+        # the cache keys of the requests that are being downloaded
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        '''
+        Forgets the database connection inherited from the parent process, so
+        that a new one is opened in this process.
+
+        '''
+
+        connection = getattr(self._local, 'connection', None)
+        if connection:
+            # don't close the connection: closing it could interfere with
+            # the parent's use of the database. Keeping a reference also
+            # keeps it from being closed by the garbage collector.
+            self._stale_connections.append(connection)
+        # the connections of the parent's other threads are gone with them
+        self._local = threading.local()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
     def connection(self):
+        ''' the database connection of the current thread '''
+
         if not self.database:
             return None
-        elif self._connection:
-            return self._connection
-        else:
-            from eureka.database import connect
-            self._connection = connect(self.database)
 
-            if self._connection:
-                self._create_tables()
+        local = self._local
+        connection = getattr(local, 'connection', None)
+        if connection and local.pid == os.getpid():
+            return connection
+
+        if connection:
+            # we've been forked since the connection was opened
+            self.after_fork()
+            local = self._local
+
+        from eureka.database import connect
+        local.connection = connection = connect(self.database)
+        local.pid = os.getpid()
+
+        if connection:
+            self._create_tables()
 
-            return self._connection
+        return connection
     connection = property(connection)
 
     def _create_tables(self):
         cursor = self.connection.cursor()
         try:
+            cursor.execute('''
+            SELECT name FROM sqlite_master WHERE type='table' AND name='cache'
+            ''')
+            existing = cursor.fetchone() is not None
+
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS cache (
                 date DATETIME NOT NULL,
@@ -58,7 +179,46 @@ class Cache(urllib2.BaseHandler):
                 response_url VARCHAR(1024) NOT NULL,
                 response_code INTEGER NOT NULL,
                 response_message VARCHAR(64) NOT NULL,
-                response_data BLOB NOT NULL
+                response_data BLOB NOT NULL,
+
+                -- if not NULL, response_data is a delta against the
+                -- response of the row with this rowid
+                delta_base INTEGER,
+
+                -- see eureka.fingerprint
+                fingerprint CHAR(40),
+                simhash INTEGER
+            )
+            ''')
+
+            cursor.execute('PRAGMA table_info(cache)')
+            columns = [row[1] for row in cursor.fetchall()]
+            for column, column_type in _added_columns:
+                if column not in columns:
+                    # the table was created by an older version
+                    cursor.execute('ALTER TABLE cache ADD COLUMN %s %s'
+                                   % (column, column_type))
+
+            # user_version 1 means that the cache urls are canonicalized
+            cursor.execute('PRAGMA user_version')
+            if cursor.fetchone()[0] < 1:
+                if existing:
+                    cursor.execute('SELECT 1 FROM cache LIMIT 1')
+                    existing = cursor.fetchone() is not None
+                if existing:
+                    self._verbatim_urls = True
+                else:
+                    cursor.execute('PRAGMA user_version = 1')
+
+            # see Crawler.extract()
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS memo (
+                fingerprint CHAR(40) NOT NULL,
+                extractor VARCHAR(256) NOT NULL,
+                version VARCHAR(64) NOT NULL,
+                result BLOB NOT NULL,
+                date DATETIME NOT NULL,
+                PRIMARY KEY (fingerprint, extractor, version)
             )
             ''')
 
@@ -69,6 +229,43 @@ class Cache(urllib2.BaseHandler):
             )
             ''')
 
+            # see eureka.cookies.IndexedCookieJar.save()
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cookies (
+                version INTEGER,
+                name TEXT,
+                value TEXT,
+                port TEXT,
+                port_specified BOOLEAN,
+                domain TEXT NOT NULL,
+                domain_specified BOOLEAN,
+                domain_initial_dot BOOLEAN,
+                path TEXT NOT NULL,
+                path_specified BOOLEAN,
+                secure BOOLEAN,
+                expires INTEGER,
+                discard BOOLEAN,
+                comment TEXT,
+                comment_url TEXT,
+                rfc2109 BOOLEAN,
+                rest TEXT
+            )
+            ''')
+
+            # see eureka.download
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                url VARCHAR(4112) NOT NULL PRIMARY KEY,
+                path TEXT NOT NULL,
+                cache_control VARCHAR(128) NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                length INTEGER,
+                complete BOOLEAN NOT NULL,
+                date DATETIME NOT NULL
+            )
+            ''')
+
             cursor.execute('''
             CREATE UNIQUE INDEX IF NOT EXISTS
                 cache_index
@@ -96,6 +293,289 @@ class Cache(urllib2.BaseHandler):
         self.connection.commit()
         cursor.close()
 
+    def last_fetched(self, url):
+        '''
+        Returns the time (in seconds since the epoch) at which ``url`` was
+        last downloaded with a GET request and stored in the cache, or None
+        if it isn't in the cache.
+
+        '''
+
+        if not self.connection:
+            return None
+        url = self._cache_url(url)
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''
+            SELECT MAX(date) FROM cache WHERE url = ? AND postdata IS NULL
+            ''', (url,))
+            date, = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if date is None:
+            return None
+        # sqlite's datetime('now') is in UTC
+        return calendar.timegm(strptime(date, '%Y-%m-%d %H:%M:%S'))
+
+    def history(self, url):
+        '''
+        Returns all cached versions of the GET request for ``url``, oldest
+        first, as (date, cache_control, response) tuples. ``date`` is the
+        time at which the version was downloaded, in seconds since the epoch.
+        Responses are decompressed, and those that aren't in the 200s are
+        ``urllib2.HTTPError`` objects.
+
+        '''
+
+        if not self.connection:
+            return []
+        url = self._cache_url(url)
+
+        from eureka.delta import apply_delta
+
+        cursor = self.connection.cursor()
+        try:
+            # newest first, so that we have the base of every delta before
+            # we get to the delta
+            cursor.execute('''
+            SELECT
+                rowid, date, cache_control, response_url, response_code,
+                response_message, response_data, delta_base
+            FROM
+                cache
+            WHERE
+                url = ? AND postdata IS NULL
+            ORDER BY
+                rowid DESC
+            ''', (url,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        versions = []
+        # rowid -> the decoded response text, for the deltas against it
+        texts = {}
+        for rowid, date, cache_control, response_url, code, msg, data, \
+                delta_base in rows:
+            data = str(data)
+            if delta_base is None:
+                data = texts[rowid] = _decoded(data)
+            else:
+                # the base is a newer version of the same request
+                data = texts[rowid] = apply_delta(texts[delta_base], data)
+            date = calendar.timegm(strptime(date, '%Y-%m-%d %H:%M:%S'))
+            versions.append((date, cache_control,
+                             _make_response(response_url, code, msg, data)))
+        versions.reverse()
+        return versions
+
+    def near_duplicates(self, url, max_distance=3):
+        '''
+        Returns the urls of the cached GET requests whose newest response has
+        a simhash that differs from that of the newest response for ``url``
+        in at most ``max_distance`` bits. This needs a cache created with
+        ``simhash=True``, and reads the simhashes of all cached pages.
+
+        '''
+
+        from eureka.fingerprint import hamming_distance
+
+        if not self.connection:
+            return []
+        url = self._cache_url(url)
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''
+            SELECT url, simhash FROM cache
+            WHERE postdata IS NULL AND simhash IS NOT NULL
+            ORDER BY rowid DESC
+            ''')
+            newest = {}
+            for other_url, value in cursor:
+                newest.setdefault(other_url, value)
+        finally:
+            cursor.close()
+
+        value = newest.pop(url, None)
+        if value is None:
+            return []
+        return [other_url for other_url, other_value in newest.iteritems()
+                if hamming_distance(value, other_value) <= max_distance]
+
+    def get_memo(self, fingerprint, extractor, version):
+        '''
+        Returns the result that ``extractor`` (a name) in version ``version``
+        extracted from a response with ``fingerprint``, as stored with
+        ``set_memo``, or None.
+
+        '''
+
+        if not self.connection or fingerprint is None:
+            return None
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''
+            SELECT result FROM memo
+            WHERE fingerprint = ? AND extractor = ? AND version = ?
+            ''', (fingerprint, extractor, str(version)))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return row and str(row[0])
+
+    def set_memo(self, fingerprint, extractor, version, result):
+        '''
+        Stores the string ``result`` that ``extractor`` in version
+        ``version`` extracted from a response with ``fingerprint``.
+
+        '''
+
+        if not self.connection or fingerprint is None:
+            return
+        connection = self.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''
+            INSERT OR REPLACE INTO
+                memo (fingerprint, extractor, version, result, date)
+            VALUES
+                (?, ?, ?, ?, datetime('now'))
+            ''', (fingerprint, extractor, str(version), Binary(result)))
+            connection.commit()
+        finally:
+            cursor.close()
+
+    def download_record(self, url):
+        '''
+        Returns what we know about the download of ``url`` to a file (see
+        ``eureka.download``), as a (path, cache_control, etag, last_modified,
+        length, complete) tuple, or None.
+
+        '''
+
+        if not self.connection:
+            return None
+        url = self._cache_url(url)
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute('''
+            SELECT path, cache_control, etag, last_modified, length, complete
+            FROM downloads WHERE url = ?
+            ''', (url,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if row is None:
+            return None
+        return row[:5] + (bool(row[5]),)
+
+    def record_download(self, url, path, cache_control, etag, last_modified,
+                        length, complete):
+        ''' stores what we know about the download of ``url`` to ``path`` '''
+
+        if not self.connection:
+            return
+        url = self._cache_url(url)
+
+        connection = self.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('''
+            INSERT OR REPLACE INTO
+                downloads
+                (url, path, cache_control, etag, last_modified, length,
+                 complete, date)
+            VALUES
+                (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            ''', (url, path, cache_control, etag, last_modified, length,
+                  bool(complete)))
+            connection.commit()
+        finally:
+            cursor.close()
+
+    def scan(self, like=None, host=None, cache_control=None):
+        '''
+        Yields (url, response) tuples for the cached GET requests whose url
+        matches the SQL LIKE expression ``like``, or whose host is ``host``
+        (which may include a port), or for all cached GET requests. Only the
+        newest response is yielded for every url, and only those cached with
+        ``cache_control``, if it is given. Responses that aren't in the 200s
+        are yielded as ``urllib2.HTTPError`` objects.
+
+        This reads the entries with a single query that scans the table in
+        order, which is much faster than looking them up one by one.
+
+        '''
+
+        if not self.connection:
+            return
+
+        conditions = ['postdata IS NULL']
+        parameters = []
+        if like:
+            conditions.append('url LIKE ?')
+            parameters.append(like)
+        if host:
+            conditions.append("(url LIKE ? ESCAPE '\\' OR "
+                              "url LIKE ? ESCAPE '\\')")
+            host = _escape_like(host.lower())
+            parameters.extend(['http://%s/%%' % host, 'https://%s/%%' % host])
+        if cache_control is not None:
+            conditions.append('cache_control = ?')
+            parameters.append(str(cache_control))
+
+        seen = set()
+        cursor = self.connection.cursor()
+        try:
+            # newest first, so that we can skip older copies as we go
+            cursor.execute('''
+            SELECT
+                url, response_url, response_code, response_message,
+                response_data, delta_base
+            FROM
+                cache
+            WHERE
+                %s
+            ORDER BY
+                rowid DESC
+            ''' % ' AND '.join(conditions), parameters)
+            for url, response_url, code, msg, data, delta_base in cursor:
+                if url in seen:
+                    continue
+                seen.add(url)
+                data = self._resolve(data, delta_base)
+                yield url, _make_response(response_url, code, msg, str(data))
+        finally:
+            cursor.close()
+
+    def _request_url(self, request):
+        ''' returns the url under which ``request`` is cached '''
+
+        return self._cache_url(request.get_full_url())
+
+    def _cache_url(self, url):
+        '''
+        returns the url under which ``url`` is cached; only call this once
+        the connection is open
+
+        '''
+
+        if self.canonicalizer and not self._verbatim_urls:
+            return self.canonicalizer(url)
+        return url
+
+    def _request_headers(self, request):
+        ''' returns the serialized headers ``request`` is cached under '''
+
+        if self.key_policy:
+            return self.key_policy(request.header_items(), request.get_host())
+        return _serialize_headers(request.header_items())
+
     def _fetch(self, url, postdata, headers, cache_control):
         ''' helper method for Cache.fetch() '''
 
@@ -108,7 +588,7 @@ class Cache(urllib2.BaseHandler):
         cursor.execute('''
         SELECT
             response_url, response_code, response_message,
-            response_data
+            response_data, delta_base, fingerprint, simhash
         FROM
             cache
         WHERE
@@ -120,7 +600,110 @@ class Cache(urllib2.BaseHandler):
 
         result = cursor.fetchall()
         cursor.close()
-        return result
+        return [(response_url, code, msg, self._resolve(data, delta_base),
+                 fingerprint, simhash)
+                for response_url, code, msg, data, delta_base, fingerprint,
+                    simhash in result]
+
+    def _resolve(self, data, delta_base):
+        '''
+        returns the response data of a row with the ``response_data`` and
+        ``delta_base`` given, rebuilding it from the chain of deltas if it
+        is a delta
+
+        '''
+
+        if delta_base is None:
+            return data
+
+        from eureka.delta import apply_delta
+
+        deltas = [data]
+        cursor = self.connection.cursor()
+        try:
+            while delta_base is not None:
+                cursor.execute('''
+                SELECT response_data, delta_base FROM cache WHERE rowid = ?
+                ''', (delta_base,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise EurekaException('The base version of a cached '
+                                          'delta is missing')
+                data, delta_base = row
+                deltas.append(data)
+        finally:
+            cursor.close()
+
+        text = _decoded(str(deltas.pop()))
+        for delta in reversed(deltas):
+            text = apply_delta(text, str(delta))
+        return text
+
+    def _previous_version(self, cursor, url, postdata, headers):
+        '''
+        returns the (rowid, response text, fingerprint) of the newest cached
+        version of a request, or None
+
+        '''
+
+        if postdata is None:
+            ifnull_postdata = ''
+        else:
+            ifnull_postdata = postdata
+        # the newest version is never a delta
+        cursor.execute('''
+        SELECT
+            rowid, response_data, fingerprint
+        FROM
+            cache
+        WHERE
+                url = ? and postdata IS NULL = ? and
+            CAST(IFNULL(postdata, '') AS BLOB) = ? and
+            headers = ? and delta_base IS NULL
+        ORDER BY
+            rowid DESC
+        LIMIT 1
+        ''', (url, postdata is None, Binary(ifnull_postdata), headers))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0], str(row[1]), row[2]
+
+    def _delta(self, previous, text):
+        '''
+        returns a delta that turns the response ``text`` into the
+        ``previous`` version of the request (see ``_previous_version``), or
+        None if it isn't worth storing
+
+        '''
+
+        from eureka.delta import make_delta
+
+        old_text = previous[1]
+        if max(len(text), len(old_text)) > self.max_delta_size:
+            return None
+        delta = make_delta(_decoded(text), _decoded(old_text))
+        if len(delta) * 2 > len(old_text):
+            return None
+        return delta
+
+    def _fingerprints(self, text):
+        '''
+        returns the fingerprint and the simhash (or None, if we don't compute
+        them) of the cached response ``text``
+
+        '''
+
+        from eureka.fingerprint import content_fingerprint, simhash
+
+        body = _body(text)
+        value = None
+        if self.simhash:
+            value = simhash(body)
+            if value >= 1 << 63:
+                # sqlite's integers are signed
+                value -= 1 << 64
+        return content_fingerprint(body), value
 
     def http_open(self, request):
         '''
@@ -132,22 +715,89 @@ class Cache(urllib2.BaseHandler):
         # if we don't support sqlite, or if the cache misses, return None
         response = None
 
+        if getattr(request, 'no_cache', False):
+            return None
+
         if self.connection:
-            url = request.get_full_url()
+            url = self._request_url(request)
             postdata = request.get_data()
             cache_control = getattr(request, 'cache_control', '') or ''
-            headers = _serialize_headers(request.header_items())
+            headers = self._request_headers(request)
 
-            results = self._fetch(url, postdata, headers, cache_control)
-            if len(results) > 1:
-                raise EurekaException('Found multiple cache entries with '
-                                      'identical http requests')
-            elif len(results) == 1:
-                url, code, msg, data = results[0]
-                response = _make_response(url, code, msg, data)
+            host = request_host(request)
+            metrics = request_metrics(request, self.metrics)
+            key = (url, postdata, headers, cache_control)
+            while True:
+                with metrics.timer('cache_lookup', host):
+                    results = self._fetch(url, postdata, headers,
+                                          cache_control)
+                if len(results) > 1:
+                    raise EurekaException('Found multiple cache entries with '
+                                          'identical http requests')
+                elif len(results) == 1:
+                    url, code, msg, data, fingerprint, simhash = results[0]
+                    if fingerprint is None:
+                        # cached before we stored fingerprints
+                        fingerprint, simhash = self._fingerprints(str(data))
+                    response = _make_response(url, code, msg, data)
+                    response.fingerprint = fingerprint
+                    response.simhash = simhash
+                    response.unchanged = False
+                    metrics.count('cache_hits', 1, host)
+                    metrics.count('cached_bytes', len(data), host)
+                    break
+                elif self.coalesce and self._wait_for_inflight(request, key):
+                    # another thread downloaded the page; look again
+                    metrics.count('cache_coalesced', 1, host)
+                else:
+                    metrics.count('cache_misses', 1, host)
+                    break
 
         return response
 
+    def _wait_for_inflight(self, request, key):
+        '''
+        If another thread is downloading the request with the cache key
+        ``key``, waits for it to finish and returns True. Otherwise, marks the
+        request as being downloaded and returns False.
+
+        '''
+
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = threading.Event()
+                request.cache_key = key
+                return False
+        if event.wait(self.coalesce_timeout):
+            return True
+
+        # the other download takes too long (or was never released), so we
+        # download it ourselves, and wake up whoever else waits for it
+        with self._inflight_lock:
+            if self._inflight.get(key) is event:
+                self._inflight[key] = threading.Event()
+                request.cache_key = key
+        event.set()
+        return False
+
+    def release(self, request):
+        '''
+        Marks ``request`` as no longer being downloaded, so that other
+        threads that wait for it look it up in the cache (or download it
+        themselves, if it failed). It's safe to call this more than once.
+
+        '''
+
+        key = getattr(request, 'cache_key', None)
+        if key is None:
+            return
+        request.cache_key = None
+        with self._inflight_lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
     def http_response(self, request, response):
         '''
         Stores the given response in the database, if we support sqlite.
@@ -155,60 +805,167 @@ class Cache(urllib2.BaseHandler):
         '''
 
         if self.connection:
-            # Don't do anything if the response is from the cache!
-            if hasattr(response, 'is_from_cache'):
+            # Don't do anything if the response is from the cache, or if it
+            # must not be cached
+            if hasattr(response, 'is_from_cache') or \
+               getattr(request, 'no_cache', False):
                 return response
 
-            url = request.get_full_url()
+            url = self._request_url(request)
             postdata = request.get_data()
             if postdata is None:
                 binary_postdata = None
             else:
                 binary_postdata = Binary(postdata)
-            headers = _serialize_headers(request.header_items())
+            headers = self._request_headers(request)
             cache_control = getattr(request, 'cache_control', '') or ''
 
             response_url = response.geturl()
             response_code = response.code
             response_message = response.msg
             response_headers = response.info()
-            response_data = response.read()
+            host = request_host(request)
+            metrics = request_metrics(request, self.metrics)
+            with metrics.timer('download', host):
+                response_data = response.read()
             response.close()
+            metrics.count('bytes', len(response_data), host)
 
             text = '%s\r\n%s' % \
                     (''.join(response_headers.headers), response_data)
+            fingerprint, simhash = self._fingerprints(text)
 
-            cursor = self.connection.cursor()
-            cursor.execute('''
-            INSERT INTO
-                cache
-                (date, url, postdata, headers, cache_control, response_url,
-                 response_code, response_message, response_data)
-            VALUES
-                (datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (url, binary_postdata, headers, cache_control, response_url,
-                  response_code, response_message, Binary(text)))
-            self.connection.commit()
-            cursor.close()
+            connection = self.connection
+            cursor = connection.cursor()
+            store_start = time()
+            try:
+                previous = self._previous_version(cursor, url, postdata,
+                                                  headers)
+                if previous is not None:
+                    old_fingerprint = previous[2] or \
+                            self._fingerprints(previous[1])[0]
+                    unchanged = old_fingerprint == fingerprint
+                else:
+                    unchanged = False
+                if unchanged:
+                    metrics.count('unchanged_responses', 1, host)
+                # before we write, so that the database isn't locked meanwhile
+                delta = None
+                if self.deltas and previous is not None:
+                    delta = self._delta(previous, text)
+
+                cursor.execute('''
+                INSERT INTO
+                    cache
+                    (date, url, postdata, headers, cache_control, response_url,
+                     response_code, response_message, response_data,
+                     fingerprint, simhash)
+                VALUES
+                    (datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (url, binary_postdata, headers, cache_control,
+                      response_url, response_code, response_message,
+                      Binary(text), fingerprint, simhash))
+                if delta is not None:
+                    # unless another process replaced it in the meantime
+                    cursor.execute('''
+                    UPDATE cache SET response_data = ?, delta_base = ?
+                    WHERE rowid = ? AND delta_base IS NULL
+                    ''', (Binary(delta), cursor.lastrowid, previous[0]))
+                if delta is not None and cursor.rowcount:
+                    metrics.count('cache_deltas', 1, host)
+                    metrics.count('cache_delta_saved_bytes',
+                                  len(previous[1]) - len(delta), host)
+                connection.commit()
+            except connection.IntegrityError:
+                # another process stored the same request in the meantime;
+                # its response is as good as ours
+                connection.rollback()
+                metrics.count('cache_duplicates', 1, host)
+            finally:
+                cursor.close()
+            metrics.timing('cache_store', time() - store_start, host)
+            self.release(request)
 
             # we read all of the response's data, so we need to create a new
             # response object with that data.
-            return _make_response(response_url, response_code,
-                                  response_message, text, False)
+            response = _make_response(response_url, response_code,
+                                      response_message, text, False)
+            response.fingerprint = fingerprint
+            response.simhash = simhash
+            response.unchanged = unchanged
+            return response
         else:
             return response
 
     https_open = http_open
     https_response = http_response
 
+def _decoded(text):
+    '''
+    returns the cached response ``text`` with its body decompressed, if it
+    has a Content-Encoding we can decode, and the headers changed to match
+
+    '''
+
+    from eureka.compression import decompress_body
+
+    headers = httplib.HTTPMessage(StringIO(text))
+    body = decompress_body(headers, headers.fp.read())
+    if body is None:
+        return text
+    for name in ('content-encoding', 'content-length'):
+        if name in headers:
+            del headers[name]
+    return '%s\r\n%s' % (''.join(headers.headers), body)
+
+def _body(text):
+    ''' returns the decompressed body of the cached response ``text`` '''
+
+    return httplib.HTTPMessage(StringIO(_decoded(text))).fp.read()
+
+def _escape_like(text):
+    ''' escapes the wildcards of an SQL LIKE expression in ``text`` '''
+
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class NotCached(EurekaException):
+    ''' raised for requests that aren't cached by an offline crawler '''
+
+    def __init__(self, url):
+        super(NotCached, self).__init__(u'%s is not cached, and we are '
+                                        u'offline' % url)
+        self.url = url
+
+class OfflineHandler(urllib2.BaseHandler):
+    '''
+    Raises ``NotCached`` for every request that gets past the cache, so that
+    a crawler never uses the network.
+
+    '''
+
+    # right after the cache
+    handler_order = 301
+
+    metrics = null_metrics
+
+    def http_open(self, request):
+        self.metrics.count('offline_misses', 1, request_host(request))
+        raise NotCached(request.get_full_url())
+
+    https_open = http_open
+
 def _make_response(url, code, msg, data, is_from_cache=True):
     '''
     Creates a file-like response object out of the url, code, message, headers
     and data of a request. If the code is not in the 200s, return an HTTPError.
+    ``data`` is either a string or a file-like object positioned at the
+    headers.
 
     '''
 
-    headers = httplib.HTTPMessage(StringIO(data))
+    if not hasattr(data, 'readline'):
+        data = StringIO(data)
+    headers = httplib.HTTPMessage(data)
 
     if code >= 200 and code < 300:
         # if the request succeeded return a file-like object...
@@ -224,10 +981,133 @@ def _make_response(url, code, msg, data, is_from_cache=True):
         response.is_from_cache = True
     return response
 
+# headers that don't affect which response we get. Accept-Encoding is ignored
+# because compressed responses are decompressed when they are read from the
+# cache.
+_ignored_headers = frozenset(['accept-encoding'])
+
 def _serialize_headers(header_items):
-    lower_headers = ((k.lower(), v) for k, v in header_items)
+    lower_headers = ((k.lower(), v) for k, v in header_items
+                     if k.lower() not in _ignored_headers)
 
     # ignore case for the header type
     return urllib.urlencode(sorted(lower_headers))
 
+# The Referer header is set from the page a link was found on, so the same
+# page would be cached once for every page linking to it.
+default_ignored_headers = ('referer', 'accept-encoding')
+
+# cookies that only carry a session id or analytics data
+default_ignored_cookies = default_ignored_parameters + (
+        'aspsessionid*', 'asp.net_sessionid', 'session', 'sid', '_ga', '_ga_*',
+        '_gid', '_gat*', '__utm*', '_fbp', '__cf*')
+
+class HeaderKeyPolicy(object):
+    '''
+    Decides which request headers are part of the cache key, so that headers
+    that don't affect the response don't cause cache misses. Header and
+    cookie names are compared ignoring case, and a name ending in "*" matches
+    all names starting with that prefix.
+
+     - if ``include_headers`` is given, only those headers are used
+     - ``ignore_headers`` are never used
+     - cookies in ``ignore_cookies`` are removed from the Cookie header
+
+    ``rules`` is a dictionary from host names to dictionaries of keyword
+    arguments for ``add_rule``, that apply to the host and its subdomains:
+
+        HeaderKeyPolicy(rules={'example.com': {'ignore_cookies': ['visit']}})
+
+    '''
+
+    def __init__(self, ignore_headers=default_ignored_headers,
+                 include_headers=None, ignore_cookies=default_ignored_cookies,
+                 rules=None):
+        self.ignore_headers = tuple(ignore_headers)
+        self.include_headers = include_headers and tuple(include_headers)
+        self.ignore_cookies = tuple(ignore_cookies)
+        self.rules = {}
+        self._matchers = {}
+        for host, rule in (rules or {}).iteritems():
+            self.add_rule(host, **rule)
+
+    def add_rule(self, host, ignore_headers=(), include_headers=None,
+                 ignore_cookies=()):
+        '''
+        Ignores ``ignore_headers`` and ``ignore_cookies`` for requests to
+        ``host`` and its subdomains, in addition to those ignored by default
+        and by previously added rules. If ``include_headers`` is given, only
+        those headers are used for the host.
+
+        '''
+
+        host = hostname(host)
+        old_ignore, old_include, old_cookies = \
+                self.rules.get(host, ((), None, ()))
+        self.rules[host] = (old_ignore + tuple(ignore_headers),
+                            include_headers and tuple(include_headers)
+                                or old_include,
+                            old_cookies + tuple(ignore_cookies))
+        self._matchers.clear()
+
+    def _matcher(self, host):
+        '''
+        returns the (include, ignore, ignore_cookie) matchers for ``host``;
+        include is None if all headers may be included
+
+        '''
+
+        try:
+            return self._matchers[host]
+        except KeyError:
+            ignore = list(self.ignore_headers)
+            include = self.include_headers
+            cookies = list(self.ignore_cookies)
+            # apply the rules of parent domains first
+            for rule_host in sorted(self.rules, key=len):
+                if host == rule_host or host.endswith('.' + rule_host):
+                    rule_ignore, rule_include, rule_cookies = \
+                            self.rules[rule_host]
+                    ignore.extend(rule_ignore)
+                    include = rule_include or include
+                    cookies.extend(rule_cookies)
+            matcher = self._matchers[host] = (
+                    include and parameter_matcher(include),
+                    parameter_matcher(ignore), parameter_matcher(cookies))
+            return matcher
+
+    def __call__(self, header_items, host=None):
+        '''
+        Returns the part of the cache key that is made from the request's
+        ``header_items``.
+
+        '''
+
+        host = hostname(host or '')
+        include, ignore, ignore_cookie = self._matcher(host)
+
+        headers = []
+        for name, value in header_items:
+            name = name.lower()
+            if ignore(name) or (include and not include(name)):
+                continue
+            if name == 'cookie':
+                value = _filter_cookies(value, ignore_cookie)
+                if not value:
+                    continue
+            headers.append((name, value))
+        return urllib.urlencode(sorted(headers))
+
+def _filter_cookies(header, ignore):
+    ''' removes the ignored cookies from a Cookie header, sorts the rest '''
+
+    cookies = []
+    for cookie in header.split(';'):
+        cookie = cookie.strip()
+        if cookie and not ignore(cookie.split('=', 1)[0].strip()):
+            cookies.append(cookie)
+    return '; '.join(sorted(cookies))
+
+default_key_policy = HeaderKeyPolicy()
+
 cache = Cache()
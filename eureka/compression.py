@@ -0,0 +1,244 @@
+'''
+Support for compressed http responses. ``HTTPContentDecoder`` asks servers
+for gzip or deflate compressed responses (and brotli, if the ``brotli``
+module is installed), and transparently decompresses them.
+
+'''
+
+import urllib2
+import zlib
+
+from eureka.limits import _LimitedReader
+from eureka.metrics import null_metrics, request_host
+
+def _brotli_decompressor():
+    ''' returns a brotli decompressor, or None if brotli isn't installed '''
+
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.Decompressor()
+
+def supported_encodings():
+    ''' the content-encodings that we can decode, in order of preference '''
+
+    encodings = ['gzip', 'deflate']
+    if _brotli_decompressor() is not None:
+        encodings.insert(0, 'br')
+    return encodings
+
+class _Deflate(object):
+    '''
+    Decompresses "deflate" data. Some servers send raw deflate data, and
+    some zlib-wrapped deflate data (which is what the standard says); we
+    decide which one it is from the first chunk.
+
+    '''
+
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return ''
+        return self._decompressor.flush()
+
+class _Brotli(object):
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+        # brotli and brotlipy name this method differently
+        self.decompress = getattr(decompressor, 'process', None) or \
+                          decompressor.decompress
+
+    def flush(self):
+        return ''
+
+def _make_decompressor(encoding):
+    ''' returns a decompressor for ``encoding``, or None if unsupported '''
+
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return _Deflate()
+    elif encoding == 'br':
+        decompressor = _brotli_decompressor()
+        return decompressor and _Brotli(decompressor)
+    else:
+        return None
+
+def decompress_body(headers, data):
+    '''
+    Decompresses ``data``, the whole body of a response whose headers are
+    ``headers``, according to its Content-Encoding. Returns None if the body
+    isn't compressed, or not in a format we can decode, or if it is corrupt.
+
+    '''
+
+    encoding = (headers.get('content-encoding') or '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return None
+    decompressor = _make_decompressor(encoding)
+    if decompressor is None:
+        return None
+    try:
+        return decompressor.decompress(data) + decompressor.flush()
+    except zlib.error:
+        return None
+
+class _DecodingReader(object):
+    '''
+    A file-like object that decompresses the data read from ``fp``, one
+    chunk at a time.
+
+    '''
+
+    chunk_size = 16384
+
+    def __init__(self, fp, decompressor):
+        self.fp = fp
+        self.decompressor = decompressor
+        self.buffer = ''
+        self.eof = False
+
+    def _fill(self, size=None, until=None):
+        '''
+        decompresses data until the buffer has ``size`` bytes, or contains
+        ``until``, or the input is exhausted.
+
+        '''
+
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while not self.eof and (size is None or length < size) and \
+              (until is None or until not in chunks[-1]):
+            data = self.fp.read(self.chunk_size)
+            if data:
+                data = self.decompressor.decompress(data)
+            else:
+                data = self.decompressor.flush()
+                self.eof = True
+            chunks.append(data)
+            length += len(data)
+        self.buffer = ''.join(chunks)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            data, self.buffer = self.buffer, ''
+        else:
+            self._fill(size)
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        self._fill(size, '\n')
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if size is not None:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fp.close()
+
+# the attributes that the cache sets on its responses
+_response_attributes = ('is_from_cache', 'fingerprint', 'simhash', 'unchanged')
+
+class HTTPContentDecoder(urllib2.BaseHandler):
+    '''
+    Advertises the compression formats we support in an Accept-Encoding
+    header (unless ``advertise`` is False, or the request already has one),
+    and decompresses responses that have a Content-Encoding.
+
+    If ``store_compressed`` is True, the handler runs after the cache, so that
+    the cache stores the compressed data as it was received, and responses
+    are decompressed every time they are read from the cache. Otherwise the
+    cache stores the decompressed data.
+
+    ``max_body_size`` limits the size of the decompressed data, so that a
+    small compressed response can't expand into a huge one. A request's
+    ``max_body_size`` attribute overrides it, and its ``truncate_body``
+    attribute works like for ``eureka.limits.HTTPResponseLimits``. Responses
+    to requests whose ``decode_content`` attribute is False are returned as
+    they are.
+
+    '''
+
+    metrics = null_metrics
+
+    def __init__(self, advertise=True, store_compressed=True,
+                 max_body_size=None):
+        self.advertise = advertise
+        self.accept_encoding = ', '.join(supported_encodings())
+        self.max_body_size = max_body_size
+        if store_compressed:
+            self.handler_order = 350 # after the cache
+        else:
+            self.handler_order = 270 # after the response limits
+
+    def http_request(self, request):
+        if self.advertise and not request.has_header('Accept-encoding'):
+            request.add_unredirected_header('Accept-Encoding',
+                                            self.accept_encoding)
+        return request
+
+    https_request = http_request
+
+    def http_response(self, request, response):
+        headers = response.info()
+        encoding = (headers.get('content-encoding') or '').strip().lower()
+        if not encoding or encoding == 'identity' or \
+           not getattr(request, 'decode_content', True):
+            return response
+
+        decompressor = _make_decompressor(encoding)
+        if decompressor is None:
+            # we can't decode this; let the caller deal with it
+            return response
+
+        if not hasattr(response, 'is_from_cache'):
+            self.metrics.count('compressed_responses', 1,
+                               request_host(request))
+
+        url = response.geturl()
+        fp = _DecodingReader(response.fp, decompressor)
+        limit = getattr(request, 'max_body_size', self.max_body_size)
+        if limit is not None:
+            fp = _LimitedReader(fp, limit, url,
+                                getattr(request, 'truncate_body', False))
+
+        # the headers now describe the decompressed data
+        for name in ('content-encoding', 'content-length'):
+            if name in headers:
+                del headers[name]
+
+        if isinstance(response, urllib2.HTTPError):
+            decoded = urllib2.HTTPError(url, response.code, response.msg,
+                                        headers, fp)
+        else:
+            decoded = urllib2.addinfourl(fp, headers, url, response.code)
+            decoded.msg = response.msg
+        for name in _response_attributes:
+            if hasattr(response, name):
+                setattr(decoded, name, getattr(response, name))
+        return decoded
+
+    https_response = http_response
@@ -0,0 +1,400 @@
+'''
+Timeouts for http connections. urllib2 only knows a single socket timeout,
+and by default none at all, so a server that stops responding can hang a
+crawler forever. The handlers in this module time out each phase of a
+request separately:
+
+ - ``connect``: establishing the connection
+ - ``first_byte``: waiting for the response, after the request was sent
+ - ``read``: waiting for more data while reading the response (an idle
+   timeout, so a large download doesn't time out as long as data arrives)
+ - ``total``: the whole request, from connecting to reading the last byte
+
+All timeouts are in seconds, and None means no timeout. They are configured
+per crawler, per host and per request:
+
+    policy = TimeoutPolicy(Timeouts(connect=10, read=30),
+                           hosts={'slow.example.com': Timeouts(read=120)})
+    crawler = Crawler(timeouts=policy)
+    crawler.fetch(url, timeouts=Timeouts(total=60))
+
+'''
+
+import heapq
+import httplib
+import socket
+import sys
+import threading
+import urllib2
+from functools import partial
+from itertools import count
+from time import time
+
+from eureka import EurekaException
+from eureka.metrics import null_metrics, request_host
+from eureka.url import hostname
+
+__all__ = ('Timeouts', 'TimeoutPolicy', 'RequestTimeout', 'default_timeouts',
+           'TimeoutHTTPHandler', 'TimeoutHTTPSHandler')
+
+class RequestTimeout(EurekaException, socket.timeout):
+    '''
+    raised when a phase of a request timed out. It is a ``socket.timeout``,
+    so it is retried like other network errors.
+
+    '''
+
+    def __init__(self, url, phase, seconds):
+        super(RequestTimeout, self).__init__(
+            u'The %s timeout of %.1f seconds was exceeded for %s'
+            % (phase, seconds, url))
+        self.url = url
+        self.phase = phase
+        self.seconds = seconds
+
+class Timeouts(object):
+    ''' The timeouts of the phases of a request; see the module docs. '''
+
+    __slots__ = ('connect', 'first_byte', 'read', 'total')
+
+    def __init__(self, connect=None, first_byte=None, read=None, total=None):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.read = read
+        self.total = total
+
+    @classmethod
+    def make(cls, timeouts):
+        '''
+        Converts ``timeouts`` to a ``Timeouts`` object. It can be a Timeouts
+        object, a dictionary of keyword arguments, or a number, which (like
+        urllib2's timeout) is used for the connect, first_byte and read
+        timeouts.
+
+        '''
+
+        if timeouts is None or isinstance(timeouts, Timeouts):
+            return timeouts
+        elif isinstance(timeouts, dict):
+            return cls(**timeouts)
+        else:
+            return cls(timeouts, timeouts, timeouts)
+
+    def override(self, other):
+        '''
+        returns a copy of these timeouts, with the timeouts that are set in
+        ``other`` replacing ours
+
+        '''
+
+        if other is None:
+            return self
+        return Timeouts(*[getattr(other, name) if getattr(other, name)
+                          is not None else getattr(self, name)
+                          for name in self.__slots__])
+
+    def __repr__(self):
+        return 'Timeouts(%s)' % ', '.join('%s=%r' % (name, getattr(self, name))
+                                          for name in self.__slots__)
+
+# long enough for slow servers, but a dead server doesn't hang us forever
+default_timeouts = Timeouts(connect=30, first_byte=60, read=60)
+
+class TimeoutPolicy(object):
+    '''
+    The timeouts for all hosts. ``hosts`` maps host names to ``Timeouts``
+    that override ``default`` for the host and its subdomains (only the
+    timeouts that are set in them).
+
+    '''
+
+    def __init__(self, default=default_timeouts, hosts=None):
+        self.default = Timeouts.make(default) or Timeouts()
+        self.hosts = {}
+        self._cache = {}
+        for host, timeouts in (hosts or {}).iteritems():
+            self.set_host(host, timeouts)
+
+    def set_host(self, host, timeouts):
+        self.hosts[hostname(host)] = Timeouts.make(timeouts)
+        self._cache.clear()
+
+    def for_host(self, host):
+        ''' returns the ``Timeouts`` for ``host`` '''
+
+        host = hostname(host or '')
+        try:
+            return self._cache[host]
+        except KeyError:
+            timeouts = self.default
+            # apply the timeouts of parent domains first
+            for rule_host in sorted(self.hosts, key=len):
+                if host == rule_host or host.endswith('.' + rule_host):
+                    timeouts = timeouts.override(self.hosts[rule_host])
+            self._cache[host] = timeouts
+            return timeouts
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return deadline - time()
+
+def _min_timeout(timeout, deadline):
+    '''
+    returns the smaller of ``timeout`` and the time left until ``deadline``,
+    and whether the deadline is the limit
+
+    '''
+
+    remaining = _remaining(deadline)
+    if remaining is None or (timeout is not None and timeout <= remaining):
+        return timeout, False
+    return max(remaining, 0.001), True
+
+class _Watchdog(object):
+    '''
+    A background thread that shuts down the sockets of connections that
+    passed their deadline. Socket timeouts only limit the time a single
+    read may wait, so a server that keeps sending a byte every few seconds
+    would never time out otherwise.
+
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._counter = count()
+        self._thread = None
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        # the thread doesn't exist in the child process
+        self.__init__()
+
+    def watch(self, deadline, connection, sock):
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, self._counter.next(),
+                                        connection, sock))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='eureka-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                deadline, _, connection, sock = self._heap[0]
+                wait = deadline - time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+            if not connection.done:
+                connection.expired = True
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+_watchdog = _Watchdog()
+
+class _TimedReader(object):
+    '''
+    Wraps the socket file of an httplib.HTTPResponse, and applies the read
+    and total timeouts to every read.
+
+    '''
+
+    def __init__(self, fp, sock, connection):
+        self.fp = fp
+        self.sock = sock
+        self.connection = connection
+
+    def _call(self, method, *args):
+        connection = self.connection
+        timeout, is_deadline = _min_timeout(connection.timeouts.read,
+                                            connection.deadline)
+        if connection.deadline is not None:
+            self.sock.settimeout(timeout)
+        try:
+            data = method(*args)
+        except (socket.error, httplib.HTTPException):
+            if connection.expired:
+                connection.timed_out('total', connection.total_seconds())
+            if sys.exc_info()[0] is socket.timeout:
+                connection.timed_out(is_deadline and 'total' or 'read',
+                                     timeout)
+            raise
+        if connection.expired:
+            # the watchdog shut down the socket, which looks like the end of
+            # the response
+            connection.timed_out('total', connection.total_seconds())
+        if not data:
+            connection.done = True
+        return data
+
+    def read(self, *args):
+        return self._call(self.fp.read, *args)
+
+    def readline(self, *args):
+        return self._call(self.fp.readline, *args)
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.connection.done = True
+        self.fp.close()
+
+class _TimeoutMixin:
+    '''
+    Mixin for httplib connections. ``timeouts`` is a ``Timeouts`` object, and
+    ``deadline`` the absolute time by which the request must be finished.
+
+    '''
+
+    def _setup(self, timeouts, deadline, url, metrics, resolver):
+        if resolver is not None:
+            # httplib connects with self._create_connection
+            self._create_connection = partial(resolver.create_connection,
+                                              metrics=metrics)
+        self.timeouts = timeouts
+        self.deadline = deadline
+        self.url = url
+        self.metrics = metrics
+        self.started = time()
+        # set once the response is read or closed, or the deadline passed
+        self.done = False
+        self.expired = False
+
+    def total_seconds(self):
+        ''' the number of seconds from the start until the deadline '''
+
+        return self.deadline - self.started
+
+    def timed_out(self, phase, seconds):
+        self.done = True
+        self.metrics.count('timeouts', 1, self.host)
+        self.metrics.count('%s_timeouts' % phase, 1, self.host)
+        raise RequestTimeout(self.url, phase, seconds or 0)
+
+    def connect(self):
+        timeout, is_deadline = _min_timeout(self.timeouts.connect,
+                                            self.deadline)
+        self.timeout = socket._GLOBAL_DEFAULT_TIMEOUT if timeout is None \
+                       else timeout
+        try:
+            self._base.connect(self)
+        except socket.timeout:
+            self.timed_out(is_deadline and 'total' or 'connect', timeout)
+
+    def getresponse(self, buffering=False):
+        sock = self.sock
+        timeout, is_deadline = _min_timeout(self.timeouts.first_byte,
+                                            self.deadline)
+        sock.settimeout(timeout)
+        try:
+            response = self._base.getresponse(self, buffering)
+        except socket.timeout:
+            self.close()
+            self.timed_out(is_deadline and 'total' or 'first_byte', timeout)
+
+        # httplib may have closed our socket object already, if the server
+        # closes the connection after the response; the response's file
+        # keeps using the underlying socket
+        sock = getattr(response.fp, '_sock', sock)
+        # from now on, time out while waiting for data
+        sock.settimeout(self.timeouts.read)
+        response.fp = _TimedReader(response.fp, sock, self)
+        if self.deadline is not None:
+            _watchdog.watch(self.deadline, self, sock)
+        return response
+
+class _TimeoutHTTPConnection(_TimeoutMixin, httplib.HTTPConnection):
+    _base = httplib.HTTPConnection
+
+    def __init__(self, host, timeouts, deadline, url, metrics, resolver,
+                 **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self._setup(timeouts, deadline, url, metrics, resolver)
+
+class _TimeoutHandlerMixin:
+    metrics = null_metrics
+
+    def _connection_factory(self, request):
+        ''' returns the function that do_open uses to create a connection '''
+
+        timeouts = self.policy.for_host(request.get_host()) \
+                       .override(getattr(request, 'timeouts', None))
+        deadline = getattr(request, 'deadline', None)
+        if timeouts.total is not None:
+            total_deadline = time() + timeouts.total
+            if deadline is None or total_deadline < deadline:
+                deadline = total_deadline
+        if deadline is not None and deadline <= time():
+            self.metrics.count('timeouts', 1, request_host(request))
+            raise RequestTimeout(request.get_full_url(), 'total', 0)
+
+        url = request.get_full_url()
+        metrics = self.metrics
+        resolver = self.resolver
+        connection_class = self._connection_class
+        def factory(host, timeout=None, **kwargs):
+            return connection_class(host, timeouts, deadline, url, metrics,
+                                    resolver, **kwargs)
+        return factory
+
+class TimeoutHTTPHandler(_TimeoutHandlerMixin, urllib2.HTTPHandler):
+    '''
+    Replaces urllib2's HTTPHandler, and opens connections that time out as
+    given by ``policy`` (a ``TimeoutPolicy``). A request's ``timeouts``
+    attribute (a ``Timeouts`` object) overrides the policy, and its
+    ``deadline`` attribute is the absolute time by which the request must be
+    done, eg. because the crawler's retry deadline ends then.
+
+    If a ``resolver`` (an ``eureka.resolver.DNSCache``) is given, host names
+    are resolved with it.
+
+    '''
+
+    _connection_class = _TimeoutHTTPConnection
+
+    def __init__(self, policy=None, debuglevel=0, resolver=None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.policy = policy or TimeoutPolicy()
+        self.resolver = resolver
+
+    def http_open(self, request):
+        return self.do_open(self._connection_factory(request), request)
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class _TimeoutHTTPSConnection(_TimeoutMixin, httplib.HTTPSConnection):
+        _base = httplib.HTTPSConnection
+
+        def __init__(self, host, timeouts, deadline, url, metrics, resolver,
+                     **kwargs):
+            httplib.HTTPSConnection.__init__(self, host, **kwargs)
+            self._setup(timeouts, deadline, url, metrics, resolver)
+
+    class TimeoutHTTPSHandler(_TimeoutHandlerMixin, urllib2.HTTPSHandler):
+        ''' The https version of ``TimeoutHTTPHandler``. '''
+
+        _connection_class = _TimeoutHTTPSConnection
+
+        def __init__(self, policy=None, debuglevel=0, context=None,
+                     resolver=None):
+            urllib2.HTTPSHandler.__init__(self, debuglevel, context)
+            self.policy = policy or TimeoutPolicy()
+            self.resolver = resolver
+
+        def https_open(self, request):
+            return self.do_open(self._connection_factory(request), request,
+                                context=self._context)
+else:
+    TimeoutHTTPSHandler = None
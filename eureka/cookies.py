@@ -0,0 +1,426 @@
+'''
+Cookie jars for crawlers that are used by many threads at once.
+
+``cookielib.CookieJar`` protects all of its cookies with a single lock, and
+looks at every domain it knows for each request. A ``ShardedCookieJar`` keeps
+the cookies of each cookie domain (eg. "example.com" for a cookie set with
+"Domain=.example.com") in a separate jar with its own lock, so threads that
+crawl different sites don't wait for each other. A request only looks at the
+jars of its host and the host's parent domains:
+
+    crawler = Crawler(cookies=ShardedCookieJar())
+
+An ``IndexedCookieJar`` additionally indexes every shard by domain and path,
+so that long crawls that collect thousands of cookies don't look at all of
+them for every request. It can cap the number of cookies, and store them in
+the cache database between runs.
+
+'''
+
+import cookielib
+import threading
+from collections import OrderedDict
+from itertools import chain
+from time import time
+from urllib import quote
+
+from eureka.misc import urldecode
+
+__all__ = ('ShardedCookieJar', 'IndexedCookieJar')
+
+def _shard_key(domain):
+    ''' the key of the shard for cookies of ``domain`` '''
+
+    return domain.lower().lstrip('.')
+
+def _request_shard_keys(request):
+    '''
+    the keys of the shards that can hold cookies for ``request``: those of
+    the request host and of all its parent domains
+
+    '''
+
+    keys = set()
+    for host in cookielib.eff_request_host(request):
+        labels = _shard_key(host).split('.')
+        for i in xrange(len(labels)):
+            keys.add('.'.join(labels[i:]))
+    return keys
+
+class ShardedCookieJar(cookielib.CookieJar):
+    '''
+    A ``cookielib.CookieJar`` that stores the cookies of every cookie domain
+    in a separate jar (a shard), each with its own lock. Cookies for a
+    request are looked up in the shards of the request host and its parent
+    domains only. It can be used in place of a ``CookieJar`` anywhere.
+
+    '''
+
+    def __init__(self, policy=None):
+        cookielib.CookieJar.__init__(self, policy)
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+
+    def _new_shard(self):
+        return cookielib.CookieJar(self._policy)
+
+    def _shard(self, domain):
+        ''' returns the shard of ``domain``, creating it if needed '''
+
+        key = _shard_key(domain)
+        shard = self._shards.get(key)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.get(key)
+                if shard is None:
+                    shard = self._shards[key] = self._new_shard()
+        return shard
+
+    def _request_shards(self, request):
+        ''' the existing shards that can hold cookies for ``request`` '''
+
+        shards = []
+        for key in _request_shard_keys(request):
+            shard = self._shards.get(key)
+            if shard is not None:
+                shards.append(shard)
+        return shards
+
+    def set_policy(self, policy):
+        self._policy = policy
+        for shard in self._shards.values():
+            shard.set_policy(policy)
+
+    def add_cookie_header(self, request):
+        # like CookieJar.add_cookie_header, but with the cookies of several
+        # shards, each of which is locked only while we look at it
+        now = int(time())
+        shards = self._request_shards(request)
+        cookies = []
+        for shard in shards:
+            with shard._cookies_lock:
+                shard._policy._now = shard._now = now
+                cookies.extend(shard._cookies_for_request(request))
+
+        attrs = self._cookie_attrs(cookies)
+        if attrs and not request.has_header('Cookie'):
+            request.add_unredirected_header('Cookie', '; '.join(attrs))
+        # if necessary, advertise that we know RFC 2965
+        if self._policy.rfc2965 and not self._policy.hide_cookie2 and \
+           not request.has_header('Cookie2'):
+            if any(cookie.version != 1 for cookie in cookies):
+                request.add_unredirected_header('Cookie2', '$Version="1"')
+
+        for shard in shards:
+            shard.clear_expired_cookies()
+
+    def extract_cookies(self, response, request):
+        for cookie in self.make_cookies(response, request):
+            self.set_cookie_if_ok(cookie, request)
+
+    def make_cookies(self, response, request):
+        # this doesn't look at any cookies, so it needs no lock
+        self._policy._now = self._now = int(time())
+        return cookielib.CookieJar.make_cookies(self, response, request)
+
+    def set_cookie_if_ok(self, cookie, request):
+        self._shard(cookie.domain).set_cookie_if_ok(cookie, request)
+
+    def set_cookie(self, cookie):
+        self._shard(cookie.domain).set_cookie(cookie)
+
+    def clear(self, domain=None, path=None, name=None):
+        if domain is not None:
+            shard = self._shards.get(_shard_key(domain))
+            if shard is None:
+                raise KeyError(domain)
+            shard.clear(domain, path, name)
+        else:
+            for shard in self._shards.values():
+                shard.clear()
+
+    def clear_session_cookies(self):
+        for shard in self._shards.values():
+            shard.clear_session_cookies()
+
+    def clear_expired_cookies(self):
+        for shard in self._shards.values():
+            shard.clear_expired_cookies()
+
+    def __iter__(self):
+        return chain.from_iterable(self._shards.values())
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards.values())
+
+    def after_fork(self):
+        ''' replaces all locks, which might be held by a parent's thread '''
+
+        self._cookies_lock = threading.RLock()
+        self._shards_lock = threading.Lock()
+        for shard in self._shards.values():
+            shard._cookies_lock = threading.RLock()
+
+class _IndexedShard(cookielib.CookieJar):
+    '''
+    A shard of an ``IndexedCookieJar``. In stead of checking every cookie it
+    has for every request, it only looks at the domains and paths that can
+    match the request, and doesn't scan for expired cookies.
+
+    '''
+
+    def __init__(self, jar):
+        cookielib.CookieJar.__init__(self, jar._policy)
+        self._jar = jar
+
+    def _cookies_for_request(self, request):
+        cookies = []
+        for domain in _candidate_domains(request):
+            if domain in self._cookies:
+                cookies.extend(self._cookies_for_domain(domain, request))
+        return cookies
+
+    def _cookies_for_domain(self, domain, request):
+        policy = self._policy
+        if not policy.domain_return_ok(domain, request):
+            return []
+
+        cookies = []
+        now = time()
+        cookies_by_path = self._cookies[domain]
+        for path in _candidate_paths(cookielib.request_path(request)):
+            cookies_by_name = cookies_by_path.get(path)
+            if not cookies_by_name or \
+                    not policy.path_return_ok(path, request):
+                continue
+            for cookie in cookies_by_name.values():
+                if cookie.is_expired(now):
+                    # expire cookies lazily, as we come across them
+                    del cookies_by_name[cookie.name]
+                    self._jar._forget(cookie)
+                elif policy.return_ok(cookie, request):
+                    cookies.append(cookie)
+        return cookies
+
+    def clear_expired_cookies(self):
+        # CookieJar calls this for every request, which means looking at
+        # every cookie. Our expired cookies are dropped when they are looked
+        # up, or by IndexedCookieJar.clear_expired_cookies().
+        pass
+
+    def set_cookie(self, cookie):
+        cookielib.CookieJar.set_cookie(self, cookie)
+        self._jar._remember(cookie)
+
+def _candidate_domains(request):
+    '''
+    the keys under which CookieJar may have stored the cookies for
+    ``request``: the request host and its parent domains, with and without a
+    leading dot
+
+    '''
+
+    domains = set()
+    for host in cookielib.eff_request_host(request):
+        labels = host.split('.')
+        for i in xrange(len(labels)):
+            domain = '.'.join(labels[i:])
+            domains.add(domain)
+            domains.add('.' + domain)
+    return domains
+
+def _candidate_paths(path):
+    '''
+    the cookie paths that match the request path ``path``: the path itself,
+    and every prefix of it that ends just before or after a slash
+
+    '''
+
+    paths = set([path])
+    index = path.find('/', 1)
+    while index != -1:
+        paths.add(path[:index])
+        paths.add(path[:index + 1])
+        index = path.find('/', index + 1)
+    paths.add('/')
+    return paths
+
+# the cookie attributes that are stored in the database, in order
+_cookie_columns = ('version', 'name', 'value', 'port', 'port_specified',
+                   'domain', 'domain_specified', 'domain_initial_dot', 'path',
+                   'path_specified', 'secure', 'expires', 'discard', 'comment',
+                   'comment_url', 'rfc2109')
+
+def _encode_rest(rest):
+    '''
+    encodes the nonstandard attributes of a cookie as a query string, in
+    which attributes without a value, like HttpOnly, have no equal sign
+
+    '''
+
+    return '&'.join(quote(name, '') if value is None else
+                    '%s=%s' % (quote(name, ''), quote(str(value), ''))
+                    for name, value in sorted(rest.items()))
+
+class IndexedCookieJar(ShardedCookieJar):
+    '''
+    A ``ShardedCookieJar`` for crawls that collect many cookies. Looking up
+    the cookies for a request only looks at the request's domains and paths,
+    in stead of at every cookie, and expired cookies are dropped when they are
+    come across, in stead of with a scan of all cookies on every request.
+
+    If ``max_cookies`` is set, the least recently set cookies are discarded
+    once the jar holds more cookies than that.
+
+    The cookies can be stored in the database of an ``eureka.cache.Cache``
+    with ``save()``, and restored with ``load()``. If a ``cache`` is given,
+    the cookies stored in it are loaded right away:
+
+        jar = IndexedCookieJar(max_cookies=10000, cache=cache)
+        crawler = Crawler(cookies=jar, cache=cache)
+        ...
+        jar.save(cache)
+
+    '''
+
+    def __init__(self, policy=None, max_cookies=None, cache=None):
+        ShardedCookieJar.__init__(self, policy)
+        self.max_cookies = max_cookies
+        # (domain, path, name) of every cookie, least recently set first
+        self._order = OrderedDict()
+        self._order_lock = threading.Lock()
+        if cache is not None:
+            self.load(cache)
+
+    def _new_shard(self):
+        return _IndexedShard(self)
+
+    def after_fork(self):
+        ShardedCookieJar.after_fork(self)
+        self._order_lock = threading.Lock()
+
+    def _remember(self, cookie):
+        key = (cookie.domain, cookie.path, cookie.name)
+        with self._order_lock:
+            self._order.pop(key, None)
+            self._order[key] = True
+
+    def _forget(self, cookie):
+        with self._order_lock:
+            self._order.pop((cookie.domain, cookie.path, cookie.name), None)
+
+    def _evict(self):
+        '''
+        discards the least recently set cookies, if there are more than
+        ``max_cookies``. This is only called while we hold no shard's lock.
+
+        '''
+
+        if self.max_cookies is None:
+            return
+        with self._order_lock:
+            victims = []
+            while len(self._order) > self.max_cookies:
+                victims.append(self._order.popitem(last=False)[0])
+        for domain, path, name in victims:
+            shard = self._shards.get(_shard_key(domain))
+            if shard is None:
+                continue
+            try:
+                cookielib.CookieJar.clear(shard, domain, path, name)
+            except KeyError:
+                pass # it's gone already
+
+    def extract_cookies(self, response, request):
+        ShardedCookieJar.extract_cookies(self, response, request)
+        self._evict()
+
+    def set_cookie_if_ok(self, cookie, request):
+        ShardedCookieJar.set_cookie_if_ok(self, cookie, request)
+        self._evict()
+
+    def set_cookie(self, cookie):
+        ShardedCookieJar.set_cookie(self, cookie)
+        self._evict()
+
+    def clear(self, domain=None, path=None, name=None):
+        ShardedCookieJar.clear(self, domain, path, name)
+        with self._order_lock:
+            for key in self._order.keys():
+                if (domain is None or key[0] == domain) and \
+                   (path is None or key[1] == path) and \
+                   (name is None or key[2] == name):
+                    del self._order[key]
+
+    def clear_session_cookies(self):
+        for cookie in list(self):
+            if cookie.discard:
+                self.clear(cookie.domain, cookie.path, cookie.name)
+
+    def clear_expired_cookies(self):
+        now = time()
+        for cookie in list(self):
+            if cookie.is_expired(now):
+                self.clear(cookie.domain, cookie.path, cookie.name)
+
+    def __len__(self):
+        return len(self._order)
+
+    def save(self, cache, ignore_discard=False, ignore_expires=False):
+        '''
+        Replaces the cookies stored in the database of ``cache`` with the
+        cookies in this jar. Like ``cookielib.FileCookieJar.save``, session
+        cookies and expired cookies are only saved if ``ignore_discard`` or
+        ``ignore_expires`` is True.
+
+        '''
+
+        now = time()
+        rows = []
+        for cookie in list(self):
+            if (cookie.discard and not ignore_discard) or \
+               (cookie.is_expired(now) and not ignore_expires):
+                continue
+            row = [getattr(cookie, column) for column in _cookie_columns]
+            row.append(_encode_rest(cookie._rest))
+            rows.append(row)
+
+        connection = cache.connection
+        cursor = connection.cursor()
+        try:
+            cursor.execute('DELETE FROM cookies')
+            cursor.executemany('INSERT INTO cookies (%s, rest) VALUES (%s)'
+                    % (', '.join(_cookie_columns),
+                       ', '.join('?' * (len(_cookie_columns) + 1))), rows)
+            connection.commit()
+        finally:
+            cursor.close()
+
+    def load(self, cache, ignore_discard=False, ignore_expires=False):
+        '''
+        Adds the cookies stored in the database of ``cache`` to this jar.
+        Expired cookies are skipped unless ``ignore_expires`` is True.
+
+        '''
+
+        cursor = cache.connection.cursor()
+        try:
+            cursor.execute('SELECT %s, rest FROM cookies'
+                           % ', '.join(_cookie_columns))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        now = time()
+        for row in rows:
+            values = dict(zip(_cookie_columns, row))
+            for column in ('port_specified', 'domain_specified',
+                           'domain_initial_dot', 'path_specified', 'secure',
+                           'discard', 'rfc2109'):
+                values[column] = bool(values[column])
+            values['rest'] = dict(urldecode(row[-1])) if row[-1] else {}
+            cookie = cookielib.Cookie(**values)
+            if (cookie.discard and not ignore_discard) or \
+               (cookie.is_expired(now) and not ignore_expires):
+                continue
+            self.set_cookie(cookie)
@@ -1,17 +1,17 @@
 #TODO: don't cache retried errors when cookies are disabled (?)
+import os
 import urllib2
 import httplib
 import logging
-import urllib
 import urlparse
 import socket
+import threading
 from time import time, sleep
 from functools import partial
 from random import random
-from eureka.misc import urldecode, urlencode, short_repr
+from eureka.misc import urlencode, short_repr, add_parameters_to_url
+from eureka.metrics import null_metrics, request_host
 from sys import stderr
-from copy import copy
-from itertools import tee, izip
 
 __all__ = ('firefox_user_agent', 'default_user_agent', 'crawler', 'Crawler')
 
@@ -34,7 +34,11 @@ class Crawler():
     5 and 8.
 
     If ``retries`` is specified in the contstructor, the Crawler will re-try
-    downloading timed-out pages that many times.
+    downloading timed-out pages that many times. For finer control over
+    retries, a ``retry_policy`` (see ``eureka.scheduler.RetryPolicy``) can be
+    given in stead. If a ``circuit_breaker`` (see
+    ``eureka.scheduler.CircuitBreaker``) is given, hosts that fail repeatedly
+    are skipped for a while.
 
     If ``silent`` is set to False in __init__, the crawler will print the url
     of the downloading page for every request.
@@ -51,17 +55,93 @@ class Crawler():
     If ``cache_control`` is not null, all fetches will automatically use 
     cache-control with a standard counter variable.
 
+    ``canonicalizer`` is the ``eureka.url.URLCanonicalizer`` used for
+    robots.txt lookups and for ``Crawler.is_new_url``. If it is True, the
+    ``eureka.url.default_canonicalizer`` is used, and if it is None or
+    False, urls are used verbatim. The cache's canonicalizer is
+    configured on the ``eureka.cache.Cache`` object itself.
+
+    If ``metrics`` is set to an ``eureka.metrics.Metrics`` object, the crawler
+    and its handlers record timings (robots.txt checks, cache lookups, delays,
+    network, parsing) and counters (cache hits and misses, retries, errors,
+    bytes) to it. Objects that can be shared with other crawlers aren't
+    changed: the cache and the resolver record the metrics of the crawler
+    whose request they handle, and a ``throttle`` that is passed in keeps its
+    own ``metrics``.
+
+    ``max_body_size`` and ``max_header_size`` limit the number of bytes that
+    are read from a response, and ``content_types`` is a list of allowed
+    content-type prefixes, such as ('text/', 'application/xml'). Responses
+    exceeding these limits raise an exception before they are read into
+    memory; see ``eureka.limits.HTTPResponseLimits``.
+
+    If ``compression`` is True, the crawler asks servers for gzip or deflate
+    compressed responses. The cache stores them compressed. Compressed
+    responses are always decompressed before they are returned.
+
+    ``timeouts`` limits how long the crawler waits for a server: it is either
+    an ``eureka.connection.Timeouts`` object, or an
+    ``eureka.connection.TimeoutPolicy`` with timeouts per host, or False for
+    no timeouts at all. It defaults to ``eureka.connection.default_timeouts``.
+    Timeouts count as failures for the retry policy and circuit breaker.
+
+    ``resolver`` is an ``eureka.resolver.DNSCache`` that caches the addresses
+    of the hosts we connect to. If it is True (the default), the shared
+    ``eureka.resolver.dns_cache`` is used; if it is False, every connection
+    asks the system resolver.
+
+    If ``threadsafe`` is True, the crawler can be used by many threads at
+    once: ``cookies=True`` then creates an ``eureka.cookies.ShardedCookieJar``
+    in stead of a single-lock ``CookieJar``. (The cache always uses one
+    database connection per thread.)
+
+    ``throttle`` is an ``eureka.throttle.HostThrottle`` that adapts the
+    number of concurrent requests to each host to how fast it responds, and
+    pauses requests to hosts that respond with 429 or 503 and a Retry-After
+    header. If it is True, a ``HostThrottle`` with default settings is used.
+    It matters when the crawler is used by several threads, eg. with
+    ``fetch_many(urls, workers=8)``.
+
+    If ``offline`` is True, the crawler only serves pages from its cache, and
+    raises ``eureka.cache.NotCached`` for pages that aren't cached. It never
+    uses the network, not even for robots.txt files, so ``robotstxt``,
+    ``delay`` and ``throttle`` are ignored. See also ``replay``, which reads
+    many cached pages at once.
+
     '''
 
     def __init__(self, cookies=True, user_agent=default_user_agent,
             delay=0, retries=0, cache=True, silent=False, robotstxt=True,
-            verbose=False, truncate=False, cache_control=False, sanitize=False):
-
-        http_processors = []
+            verbose=False, truncate=False, cache_control=False, sanitize=False,
+            canonicalizer=True, metrics=None, retry_policy=None,
+            circuit_breaker=None, max_body_size=None, max_header_size=None,
+            content_types=None, compression=True, threadsafe=False,
+            timeouts=None, resolver=True, throttle=None, offline=False):
+
+        from eureka.url import URLSet, default_canonicalizer
+
+        if canonicalizer is True:
+            canonicalizer = default_canonicalizer
+        self.canonicalizer = canonicalizer or None
+        self.seen_urls = URLSet(canonicalizer=self.canonicalizer)
+
+        http_processors = [_RedirectHandler()]
+
+        self.offline = offline
+        if offline:
+            if not cache:
+                raise ValueError('An offline crawler needs a cache')
+            # the pages were checked when they were downloaded
+            robotstxt = False
+            delay = 0
+            throttle = None
 
         if robotstxt:
             import robotstxt
-            http_processors.append(robotstxt.RobotsTxt())
+            self.robots = robotstxt.RobotsTxt(self.canonicalizer)
+            http_processors.append(self.robots)
+        else:
+            self.robots = None
 
         if cache is True: # yes, this is correct
             from eureka.cache import cache
@@ -69,6 +149,9 @@ class Crawler():
         if cache:
             self.cache = cache
             http_processors.append(cache)
+            if offline:
+                from eureka.cache import OfflineHandler
+                http_processors.append(OfflineHandler())
         else:
             self.cache = None
 
@@ -79,7 +162,10 @@ class Crawler():
             self.cache_control = None
 
         if cookies is not None and cookies is not False:
-            if cookies is True:
+            if cookies is True and threadsafe:
+                from eureka.cookies import ShardedCookieJar
+                self.cookies = ShardedCookieJar()
+            elif cookies is True:
                 import cookielib
                 self.cookies = cookielib.CookieJar()
             else:
@@ -98,7 +184,68 @@ class Crawler():
                 delay = (delay,)
             http_processors.append(HTTPDelay(*delay))
 
-        self.opener = urllib2.build_opener(*http_processors)
+        # handlers that other crawlers may use as well
+        shared = [cache]
+        if throttle is True:
+            from eureka.throttle import HostThrottle
+            throttle = HostThrottle()
+        else:
+            shared.append(throttle)
+        self.throttle = throttle or None
+        if self.throttle:
+            http_processors.append(self.throttle)
+            http_processors.append(self.throttle.end_handler)
+
+        if max_body_size is not None or max_header_size is not None or \
+           content_types is not None:
+            from eureka.limits import HTTPResponseLimits
+            http_processors.append(HTTPResponseLimits(max_body_size,
+                    max_header_size, content_types))
+
+        from eureka.compression import HTTPContentDecoder
+        self._decoder = HTTPContentDecoder(advertise=compression,
+                                           max_body_size=max_body_size)
+        http_processors.append(self._decoder)
+
+        from eureka.connection import Timeouts, TimeoutPolicy, \
+                                      TimeoutHTTPHandler, TimeoutHTTPSHandler
+        if timeouts is False:
+            timeouts = TimeoutPolicy(Timeouts())
+        elif timeouts is None:
+            timeouts = TimeoutPolicy()
+        elif not isinstance(timeouts, TimeoutPolicy):
+            timeouts = TimeoutPolicy(timeouts)
+        self.timeouts = timeouts
+
+        if resolver is True:
+            from eureka.resolver import dns_cache as resolver
+        self.resolver = resolver or None
+
+        http_processors.append(TimeoutHTTPHandler(timeouts,
+                                                  resolver=self.resolver))
+        if TimeoutHTTPSHandler is not None:
+            http_processors.append(TimeoutHTTPSHandler(timeouts,
+                    resolver=self.resolver))
+
+        if metrics:
+            from eureka.metrics import NetworkTimerStart, NetworkTimerEnd, \
+                                       RequestMetrics
+            http_processors.append(RequestMetrics(metrics))
+            http_processors.append(NetworkTimerStart(metrics))
+            http_processors.append(NetworkTimerEnd(metrics))
+            for processor in http_processors:
+                if hasattr(processor, 'metrics') and \
+                   not any(processor is handler for handler in shared):
+                    processor.metrics = metrics
+        self.metrics = metrics or null_metrics
+
+        releasers = []
+        if self.cache:
+            # so that other threads waiting for a failed url go on
+            releasers.append(self.cache.release)
+        if self.throttle:
+            releasers.append(self.throttle.release)
+        self.opener = _Opener(http_processors, releasers)
 
         self.user_agent = user_agent
         if user_agent:
@@ -108,7 +255,50 @@ class Crawler():
 
         self.sanitize = sanitize
 
-        self.retries = retries
+        if retry_policy is None:
+            from eureka.scheduler import RetryPolicy
+            retry_policy = RetryPolicy(retries)
+        self.retry_policy = retry_policy
+        self.retries = retry_policy.retries
+        self.circuit_breaker = circuit_breaker
+
+        from eureka import forking
+        self._pid = os.getpid()
+        forking.register(self)
+
+    # If this is set to True, a forked child process starts without the
+    # cookies the parent collected, eg. so that each worker gets its own
+    # session.
+    clear_cookies_after_fork = False
+
+    def after_fork(self):
+        '''
+        Resets per-process state in a forked child process. This is called by
+        ``eureka.forking.after_fork()``, or automatically, when ``fetch``
+        notices that the process id changed.
+
+        '''
+
+        self._pid = os.getpid()
+        cookies = self.cookies
+        if cookies is not None:
+            if hasattr(cookies, 'after_fork'):
+                cookies.after_fork()
+            elif hasattr(cookies, '_cookies_lock'):
+                # the lock may have been held by another thread in the parent
+                cookies._cookies_lock = threading.RLock()
+            if self.clear_cookies_after_fork:
+                cookies.clear()
+
+    def is_new_url(self, url):
+        '''
+        Returns True the first time it is called with ``url`` or any url
+        equivalent to it, and False afterwards. Crawl code can use this to
+        avoid following the same link twice.
+
+        '''
+
+        return self.seen_urls.add(url)
 
     def _open_http(self, method, url, values, **extra_args):
         '''
@@ -126,7 +316,8 @@ class Crawler():
     # IMPORTANT: if any arguments are added to fetch(), they must be added
     # below, as well, next to the other "IMPORTANT" comment
     def fetch(self, url, data=None, headers={}, referer=True,
-              cache_control=None, retries=None):
+              cache_control=None, retries=None, deadline=None, timeouts=None,
+              stream=False):
         '''
         Fetches the data at the given url. If ``data`` is ``None``, we use
         a GET request, otherwise, we use a POST request.
@@ -144,8 +335,30 @@ class Crawler():
         If a ``retries`` integer argument is specified, page fetches will be
         retried ``retries`` times on page-load errors.
 
+        If a ``deadline`` is specified, we give up retrying once that many
+        seconds have passed since the first try, and a request that is still
+        running then times out.
+
+        ``timeouts`` overrides the crawler's timeouts for this request; see
+        ``eureka.connection.Timeouts``.
+
+        If ``stream`` is True, the response is returned as it arrives: it
+        bypasses the cache, isn't decompressed (we ask for an uncompressed
+        response, though) and has no body size limit. This is meant for large
+        files; see ``fetch_to_file``.
+
+        If the crawler has a cache, the response's ``fingerprint`` attribute
+        identifies its content, and its ``unchanged`` attribute is True if it
+        was downloaded again, and is the same as the previously cached
+        version of the page; see ``eureka.cache.Cache``.
+
         '''
 
+        if self._pid != os.getpid():
+            # we were forked without eureka.forking.fork()
+            from eureka import forking
+            forking.after_fork()
+
         if self.cache_control and not cache_control:
             cache_control = self.cache_control.next()
 
@@ -159,8 +372,12 @@ class Crawler():
                 referer = url.getparent().base_url
             else: # nope... can't determine referer from url
                 referer = None
+        # don't modify the caller's (or the default argument's) dictionary
+        headers = dict(headers)
         if referer:
             headers['Referer'] = referer
+        if stream:
+            headers.setdefault('Accept-Encoding', 'identity')
         if retries is None:
             retries = self.retries
 
@@ -172,7 +389,8 @@ class Crawler():
                 # function, then they must be added here, as well!!!
                 http = partial(self._open_http, headers=headers,
                                referer=referer, cache_control=cache_control,
-                               retries=retries)
+                               retries=retries, deadline=deadline,
+                               timeouts=timeouts, stream=stream)
                 return html.submit_form(url, extra_values=data, open_http=http)
             else:
                 raise ValueError('Crawler.fetch expects url of type '
@@ -187,50 +405,121 @@ class Crawler():
         request = urllib2.Request(url, data=data, headers=headers)
         if cache_control is not None:
             request.cache_control = str(cache_control)
+        if stream:
+            request.no_cache = True
+            request.decode_content = False
+            request.max_body_size = None
+
+        metrics = self.metrics
+        policy = self.retry_policy
+        breaker = self.circuit_breaker
+        host = request.get_host().lower()
+        deadline = policy.deadline_for(time(), deadline)
+        if timeouts is not None:
+            from eureka.connection import Timeouts
+            request.timeouts = Timeouts.make(timeouts)
+        if deadline is not None:
+            request.deadline = deadline
 
         # download multiple times in case of url-errors...
         error = None
         for retry in xrange(retries + 1):
+            if retry:
+                metrics.count('retries', 1, host)
+            if breaker:
+                breaker.check(host)
             try:
-                result = self.opener.open(request)
+                with metrics.timer('fetch', host):
+                    result = self.opener.open(request)
                 result.__enter__ = lambda: result
                 result.__exit__ = lambda x,y,z: result.close()
+                # set by the cache on the final response, after redirects;
+                # see eureka.cache.Cache
+                result.fingerprint = getattr(result, 'fingerprint', None)
+                result.simhash = getattr(result, 'simhash', None)
+                result.unchanged = getattr(result, 'unchanged', False)
+                if breaker:
+                    breaker.success(host)
                 return result
 
-            except urllib2.HTTPError, e:
-                if 500 <= e.code < 600 :
-                    # if many errors happen, retain the first one
-                    print 'passing_HTTP_ERROR:' + url + ':retry:' + str(retry)
-                    error = error or e
-                    import time
-                    import random
-                    time.sleep(5 * 2**min(retry, 8) * random.random())
-                else:
+            except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                metrics.count(_error_kind(e), 1, host)
+                if not policy.is_retryable(e):
                     raise
+                if breaker and breaker.failure(host):
+                    metrics.count('circuit_opened', 1, host)
+                    logging.warning('too many errors for %s; pausing requests '
+                                    'to it', host)
 
-            except urllib2.URLError, e:
-                # check whether we should re-try fetching the page
-                if e.reason.strerror not in ('Connection refused',):
-                    # don't retry downloading page if a non-http error
-                    # happened
-                    raise e
-                else:
-                    # if many errors happen, retain the first one
-                    print 'passing_CONNECTION_ERROR:' + url + ':retry:' + str(retry)
-                    time.sleep(5 * 2**min(retry, 8) * random.random())
-                    error = error or e
-
-            except (httplib.IncompleteRead, httplib.BadStatusLine, socket.error), e:
+                # if many errors happen, retain the first one
                 error = error or e
-                import time
-                import random
-                print 'passing_NETWORK_ERROR:' + url + ':retry:' + str(retry)
-                time.sleep(5 * 2**min(retry, 8) * random.random())
+                if retry == retries:
+                    break
+                delay = policy.delay(retry, e)
+                if deadline is not None and time() + delay > deadline:
+                    metrics.count('deadline_exceeded', 1, host)
+                    break
+                logging.warning('error fetching %s (try %s): %r',
+                                url, retry, e)
+                self._backoff(delay, host)
 
         # we can only get here, if an error occurred
-        print 'RAISE_ERROR:::::' + url + ':RETRIED:' + str(retry)
+        metrics.count('failed_fetches', 1, host)
+        if retry:
+            logging.error('giving up on %s after %s tries', url, retry + 1)
         raise error
 
+    def fetch_many(self, urls, method='fetch', workers=1, **kwargs):
+        '''
+        Fetches all ``urls`` with the crawler method ``method`` (eg.
+        "fetch_html"), and yields (url, result, error) tuples as requests
+        finish. Failed requests are retried later, while other urls are
+        being fetched; see ``eureka.scheduler.RetryScheduler``. Up to
+        ``workers`` requests run at once.
+
+        '''
+
+        from eureka.scheduler import RetryScheduler
+        scheduler = RetryScheduler(self, method, workers=workers)
+        for url in urls:
+            scheduler.add(url, **kwargs)
+        return iter(scheduler)
+
+    def fetch_to_file(self, url, path, headers={}, referer=True,
+                      cache_control=None, retries=None, chunk_size=1 << 16):
+        '''
+        Downloads ``url`` to the file ``path`` in chunks of ``chunk_size``
+        bytes, and returns a read-only ``mmap`` of the file (or an empty
+        string if it is empty), so that large files are never held in memory.
+
+        Interrupted downloads are resumed where they stopped, also by later
+        calls, if the server supports range requests. Downloads are recorded
+        in the cache database, and a completed download of ``url`` to the
+        same ``path`` (with the same ``cache_control``) isn't repeated. See
+        ``eureka.download.download`` for the details.
+
+        '''
+
+        from eureka.download import download
+        return download(self, url, path, headers=headers, referer=referer,
+                        cache_control=cache_control, retries=retries,
+                        chunk_size=chunk_size)
+
+    def _backoff(self, delay, host=None):
+        ''' sleeps for ``delay`` seconds after an error '''
+
+        self.metrics.timing('retry_sleep', delay, host)
+        sleep(delay)
+
+    def _parse(self, fp, parse):
+        ''' calls ``parse(fp)`` and records the time it took '''
+
+        metrics = self.metrics
+        if not metrics:
+            return parse(fp)
+        with metrics.timer('parse', urlparse.urlsplit(fp.geturl())[1]):
+            return parse(fp)
+
     def fetch_xml(self, *args, **kwargs):
         '''
         Makes a request to ``url`` and returns the result parsed as xml.
@@ -238,16 +527,35 @@ class Crawler():
         A keyword argument ``encoding`` can be specified to override the page's
         default encoding.
 
-        '''
+        If the keyword argument ``if_changed`` is True, None is returned in
+        stead if the page is unchanged (see ``fetch``), without parsing it.
 
-        from eureka.xml import XMLParser
-        from lxml import etree
+        '''
 
         encoding = kwargs.pop('encoding', None)
+        if_changed = kwargs.pop('if_changed', False)
 
         with self.fetch(*args, **kwargs) as fp:
-            result = etree.parse(fp, parser=XMLParser(encoding=encoding)).getroot()
-            return result
+            if if_changed and self._unchanged(fp):
+                return None
+            return self._parse(fp, partial(self._xml_document,
+                                           encoding=encoding))
+
+    def _unchanged(self, fp):
+        ''' returns whether the response ``fp`` is unchanged, and counts it '''
+
+        if not getattr(fp, 'unchanged', False):
+            return False
+        self.metrics.count('unchanged_skipped', 1,
+                           urlparse.urlsplit(fp.geturl())[1])
+        return True
+
+    def _xml_document(self, fp, encoding=None):
+        from eureka.xml import XMLParser
+        from lxml import etree
+
+        parser = XMLParser(encoding=encoding)
+        return etree.parse(fp, parser=parser).getroot()
 
     def fetch_pdf(self, url, command=None, xml=None, extra_args=None, *args, **kwargs):
         '''
@@ -257,11 +565,20 @@ class Crawler():
         The arguments `command`, `xml` and `extra_args` have the same meaning
         as in pdftohtml in eureka/pdf.py
 
+        If a ``converter`` keyword argument is given, it should be an
+        ``eureka.pdf.PDFConverterPool``, which is used for the conversion in
+        stead. The pool's settings override `command`, `xml` and `extra_args`.
+
         '''
 
         from eureka.pdf import pdftohtml
 
+        converter = kwargs.pop('converter', None)
+
         with self.fetch(url, *args, **kwargs) as fp:
+            if converter is not None:
+                return converter.convert(fp)
+
             converter_args = {}
             if xml is not None:        converter_args['xml'] = xml
             if command is not None:    converter_args['command'] = command
@@ -269,67 +586,228 @@ class Crawler():
 
             return pdftohtml(fp, **converter_args)
 
+    def fetch_pdf_document(self, url, command=None, extra_args=(),
+                           chunk_size=10, *args, **kwargs):
+        '''
+        Fetches a pdf file, and returns it as an ``eureka.pdf.PDFDocument``,
+        whose pages are only converted as they are accessed. Call the
+        document's ``close()`` method when done with it.
+
+        '''
+
+        from eureka.pdf import PDFDocument
+
+        with self.fetch(url, *args, **kwargs) as fp:
+            return PDFDocument(fp, command=command, extra_args=extra_args,
+                               chunk_size=chunk_size)
+
+    def fetch_pdfs(self, urls, converter, **kwargs):
+        '''
+        Fetches and converts many pdf files concurrently with ``converter``,
+        an ``eureka.pdf.PDFConverterPool``. Yields the converted documents in
+        the order of ``urls``. ``kwargs`` are passed on to ``fetch``.
+
+        '''
+
+        return converter.imap(self.fetch(url, **kwargs) for url in urls)
+
     def fetch_xhtml(self, *args, **kwargs):
         '''
         Like ``fetch_xml``, but we expect an XHTML response.
 
         A keyword argument ``encoding`` can be specified to override the page's
-        default encoding.
+        default encoding, and ``if_changed`` works like for ``fetch_xml``.
 
         '''
 
-        from eureka.xml import XHTMLParser
-        from lxml import etree
-
         encoding = kwargs.pop('encoding', 'utf-8')
+        if_changed = kwargs.pop('if_changed', False)
 
         with self.fetch(*args, **kwargs) as fp:
-            result = etree.parse(fp, parser=XHTMLParser(encoding=encoding)).getroot()
-            result.make_links_absolute(fp.geturl(), handle_failures='ignore')
-            return result
+            if if_changed and self._unchanged(fp):
+                return None
+            return self._parse(fp, partial(self._xhtml_document,
+                                           encoding=encoding))
+
+    def _xhtml_document(self, fp, encoding='utf-8'):
+        from eureka.xml import XHTMLParser
+        from lxml import etree
+
+        parser = XHTMLParser(encoding=encoding)
+        result = etree.parse(fp, parser=parser).getroot()
+        result.make_links_absolute(fp.geturl(), handle_failures='ignore')
+        return result
 
     def fetch_html(self, *args, **kwargs):
         '''
         Like ``fetch_xml``, but we expect an HTML response.
 
         A keyword argument ``encoding`` can be specified to override the page's
-        default encoding.
+        default encoding, and ``if_changed`` works like for ``fetch_xml``.
 
         '''
 
-        from eureka.xml import HTMLParser
-        from lxml import etree
-
         encoding = kwargs.pop('encoding', None)
+        if_changed = kwargs.pop('if_changed', False)
+        parse = partial(self._html_document, encoding=encoding)
+
+        # fetch() retries errors that happen while opening the page; here we
+        # only retry pages that were cut off while being parsed. Both share
+        # one deadline.
+        retries = kwargs.get('retries')
+        if retries is None:
+            retries = self.retries
+        deadline = self.retry_policy.deadline_for(time(),
+                                                  kwargs.get('deadline'))
 
         error = None
-        for retry in xrange(self.retries+1):
+        for retry in xrange(retries+1):
+          if deadline is not None:
+            kwargs['deadline'] = max(deadline - time(), 0)
           try:
             with self.fetch(*args, **kwargs) as fp:
-                if self.sanitize:
-                    from StringIO import StringIO
-                    raw = fp.read()
-                    processed = raw.decode('ascii', 'ignore').encode(
-                            'utf-8', 'ignore')
-                    result = etree.parse(
-                            StringIO(processed), parser=HTMLParser(encoding=encoding)
-                            ).getroot()
-                else:
-                    result = etree.parse(
-                        fp, parser=HTMLParser(encoding=encoding)).getroot()
-
-                result.make_links_absolute(fp.geturl(), handle_failures='ignore')
-                return result
+                if if_changed and self._unchanged(fp):
+                    return None
+                return self._parse(fp, parse)
           except httplib.IncompleteRead, e:
             error = error or e
-            import time
-            import random
-            print 'passing_INCOMPLETE_READ.retry:' + str(retry)
-            time.sleep(5 * 2**min(retry, 8) * random.random())
-
-        print 'raising_INCOMPLETE_READ:RETRIED:' + str(retry)
+            self.metrics.count('incomplete_reads')
+            if retry == retries:
+                break
+            delay = self.retry_policy.delay(retry, e)
+            if deadline is not None and time() + delay > deadline:
+                break
+            logging.warning('incomplete read (try %s)', retry)
+            self._backoff(delay)
+
+        logging.error('giving up after %s incomplete reads', retry + 1)
         raise error
 
+    def _html_document(self, fp, encoding=None):
+        from eureka.xml import HTMLParser
+        from lxml import etree
+
+        if self.sanitize:
+            from StringIO import StringIO
+            raw = fp.read()
+            processed = raw.decode('ascii', 'ignore').encode(
+                    'utf-8', 'ignore')
+            result = etree.parse(
+                    StringIO(processed), parser=HTMLParser(encoding=encoding)
+                    ).getroot()
+        else:
+            result = etree.parse(
+                fp, parser=HTMLParser(encoding=encoding)).getroot()
+        result.make_links_absolute(fp.geturl(), handle_failures='ignore')
+        return result
+
+    # the crawler methods that replay() and extract() can use, and their
+    # parsers
+    _parsers = {'fetch': None, 'fetch_xml': '_xml_document',
+                'fetch_xhtml': '_xhtml_document',
+                'fetch_html': '_html_document'}
+
+    def replay(self, like=None, host=None, method='fetch_html',
+               cache_control=None, **kwargs):
+        '''
+        Reads the cached pages whose url matches the SQL LIKE expression
+        ``like`` or whose host is ``host`` (or all cached pages) in bulk,
+        without any requests, and yields (url, result, error) tuples like
+        ``fetch_many``. ``result`` is what the crawler method ``method``
+        ("fetch", "fetch_xml", "fetch_xhtml" or "fetch_html") would return;
+        ``kwargs`` are passed on to its parser (eg. ``encoding``).
+
+        Only the newest copy of every page is used, and only GET requests.
+        Pages that were cached with an error status, or that can't be
+        parsed, are yielded with the error. See ``eureka.cache.Cache.scan``.
+
+        '''
+
+        if self.cache is None:
+            raise ValueError('replay needs a cache')
+        try:
+            parse = self._parsers[method]
+        except KeyError:
+            raise ValueError('replay does not support %r' % method)
+        if parse is not None:
+            parse = partial(getattr(self, parse), **kwargs)
+
+        metrics = self.metrics
+        for url, response in self.cache.scan(like, host, cache_control):
+            metrics.count('replayed_pages', 1)
+            response = self._decoder.http_response(urllib2.Request(url),
+                                                   response)
+            if isinstance(response, urllib2.HTTPError):
+                yield url, None, response
+            elif parse is None:
+                yield url, response, None
+            else:
+                try:
+                    result = self._parse(response, parse)
+                except Exception, e:
+                    yield url, None, e
+                else:
+                    yield url, result, None
+
+    def extract(self, url, func, version=1, method='fetch_html', name=None,
+                **kwargs):
+        '''
+        Returns ``func(document)``, where ``document`` is the page at ``url``
+        as returned by the crawler method ``method`` ("fetch", "fetch_xml",
+        "fetch_xhtml" or "fetch_html").
+
+        The result is stored in the cache (so it must be picklable), under
+        the page's url and fingerprint, ``name`` and ``version``. If the page
+        is the same the next time, the stored result is returned, and the
+        page isn't parsed at all. Change ``version`` whenever ``func``
+        changes in a way that changes its results.
+
+        ``name`` identifies ``func``. It defaults to the module, name and
+        first line of a named function, and must be given for lambdas and
+        other callables.
+
+        ``kwargs`` are passed on to ``fetch``, except ``encoding``, which is
+        passed on to the parser.
+
+        '''
+
+        import cPickle as pickle
+        from eureka.fingerprint import content_fingerprint
+
+        try:
+            parse = self._parsers[method]
+        except KeyError:
+            raise ValueError('extract does not support %r' % method)
+        if parse is not None:
+            parser_kwargs = {}
+            if 'encoding' in kwargs:
+                parser_kwargs['encoding'] = kwargs.pop('encoding')
+            parse = partial(getattr(self, parse), **parser_kwargs)
+
+        extractor = name or _extractor_name(func)
+        cache = self.cache
+        with self.fetch(url, **kwargs) as fp:
+            key = None
+            if cache is not None and fp.fingerprint is not None:
+                # links are made absolute, so the url matters, too
+                key = content_fingerprint('%s\n%s' % (fp.geturl(),
+                                                       fp.fingerprint))
+                memo = cache.get_memo(key, extractor, version)
+                if memo is not None:
+                    self.metrics.count('memo_hits', 1,
+                                       urlparse.urlsplit(fp.geturl())[1])
+                    return pickle.loads(memo)
+
+            if parse is None:
+                result = func(fp)
+            else:
+                result = func(self._parse(fp, parse))
+
+        if key is not None:
+            cache.set_memo(key, extractor, version,
+                           pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        return result
+
     def fetch_broken_html(self, *args, **kwargs):
         '''
         like ``fetch_html`` with even more relaxed parsing by using
@@ -346,6 +824,28 @@ class Crawler():
             result.make_links_absolute(fp.geturl(), handle_failures='ignore')
             return result
 
+def _extractor_name(func):
+    ''' the default name of the extractor ``func``; see ``Crawler.extract`` '''
+
+    # bound methods are named after their function
+    code = getattr(getattr(func, '__func__', func), '__code__', None)
+    if code is None or func.__name__ == '<lambda>':
+        raise ValueError('Crawler.extract needs a name for %r' % (func,))
+    return '%s.%s:%s' % (func.__module__, func.__name__, code.co_firstlineno)
+
+def _error_kind(error):
+    ''' the name of the metrics counter for a failed request '''
+
+    if isinstance(error, urllib2.HTTPError):
+        return 'http_errors'
+    elif isinstance(error, socket.timeout) or \
+         isinstance(getattr(error, 'reason', None), socket.timeout):
+        return 'timeout_errors'
+    elif isinstance(error, urllib2.URLError):
+        return 'connection_errors'
+    else:
+        return 'network_errors'
+
 class HTTPRequestPrinter(urllib2.BaseHandler):
     '''
     A URL-handler that prints HTTP requests as they are performed. There are
@@ -448,6 +948,8 @@ class HTTPDelay(urllib2.BaseHandler):
     # run this after the cache, so we don't cause delays when a page is cached
     handler_order = 301
 
+    metrics = null_metrics
+
     def __init__(self, min_delay, max_delay=None):
         '''
         The delay is a random number between min_delay and max_delay. If
@@ -457,6 +959,7 @@ class HTTPDelay(urllib2.BaseHandler):
 
         self.last_request_time = 0
         self.min_delay = min_delay
+        self._lock = threading.Lock()
 
         if max_delay is None:
             self.max_delay = min_delay
@@ -477,45 +980,102 @@ class HTTPDelay(urllib2.BaseHandler):
             delay = self.min_delay \
                   + random() * (self.max_delay-self.min_delay)
         else:
-            delay = self.delay
-
-        # figure out how long we need to sleep
-        cur_time = time()
-        sleep_time = self.last_request_time + delay - cur_time
-
-        if sleep_time <= 0:
-            self.last_request_time = cur_time
-        else:
+            delay = self.min_delay
+
+        # figure out how long we need to sleep. Every thread reserves the
+        # time of its request while holding the lock, but sleeps without it.
+        with self._lock:
+            cur_time = time()
+            request_time = max(self.last_request_time + delay, cur_time)
+            self.last_request_time = request_time
+        sleep_time = request_time - cur_time
+
+        if sleep_time > 0:
+            self.metrics.timing('delay', sleep_time, request_host(request))
             sleep(sleep_time)
-            self.last_request_time = time()
 
     https_open = http_open
 
-def add_parameters_to_url(url, values):
+class _RedirectHandler(urllib2.HTTPRedirectHandler):
     '''
-    adds ``values`` as url-encoded GET parameters to ``url``. ``values`` is
-    specified as a dictionary.
+    Follows redirects like ``urllib2.HTTPRedirectHandler``, and copies the
+    attributes that ``Crawler.fetch`` sets on a request (like its
+    cache-control) to the request for the new location, so that the page a
+    redirect leads to is fetched the same way.
+
+    '''
+
+    attributes = ('cache_control', 'no_cache', 'decode_content',
+                  'max_body_size', 'timeouts', 'deadline')
+
+    def redirect_request(self, request, fp, code, msg, headers, newurl):
+        new = urllib2.HTTPRedirectHandler.redirect_request(self, request, fp,
+                code, msg, headers, newurl)
+        if new is not None:
+            for name in self.attributes:
+                if hasattr(request, name):
+                    setattr(new, name, getattr(request, name))
+        return new
 
+class _Opener(urllib2.OpenerDirector):
     '''
+    An opener that calls its ``releasers`` with every request that fails,
+    so that handlers can give back what they hold for it (like a throttle
+    slot). This includes the requests that handlers open themselves, like
+    redirects and robots.txt files, which ``Crawler.fetch`` never sees.
+
+    '''
+
+    def __init__(self, handlers, releasers):
+        urllib2.OpenerDirector.__init__(self)
+        # build_opener adds the default handlers we didn't replace
+        for handler in urllib2.build_opener(*handlers).handlers:
+            self.add_handler(handler)
+        self.releasers = releasers
+
+    def open(self, fullurl, data=None,
+             timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        if isinstance(fullurl, basestring):
+            fullurl = urllib2.Request(fullurl, data)
+        try:
+            return urllib2.OpenerDirector.open(self, fullurl, data, timeout)
+        except:
+            for release in self.releasers:
+                release(fullurl)
+            raise
+
+class _DefaultCrawler(object):
+    '''
+    Stands in for the default crawler, ``eureka.crawler.crawler``. The actual
+    ``Crawler`` object, along with its cache, cookie jar and handlers, is only
+    created when the default crawler is first used, so that importing this
+    module stays cheap.
+
+    '''
+
+    def __init__(self):
+        object.__setattr__(self, '_crawler', None)
+        object.__setattr__(self, '_lock', threading.Lock())
 
-    scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
-    query_list = urldecode(query)
-    if len(query_list) < 2:
-        print(url)
-        print(query_list)
+    def _get_crawler(self):
+        crawler = self._crawler
+        if crawler is None:
+            with self._lock:
+                crawler = self._crawler
+                if crawler is None:
+                    crawler = Crawler()
+                    object.__setattr__(self, '_crawler', crawler)
+        return crawler
 
-    # remove these keys from the GET parameters, as we are specifying new
-    # values for them...
-    delete_keys = set(dict(values))
-    new_query = []
+    def __getattr__(self, name):
+        return getattr(self._get_crawler(), name)
 
-    for key, value in query_list:
-        if key not in delete_keys:
-            new_query.append((key, value))
-    for key, value in values:
-        new_query.append((key, value))
+    def __setattr__(self, name, value):
+        setattr(self._get_crawler(), name, value)
 
-    query = urlencode(new_query, doseq=1)
-    return urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
+    def __repr__(self):
+        if self._crawler is None:
+            return '<default eureka crawler (not created yet)>'
+        return repr(self._crawler)
 
-crawler = Crawler()
+crawler = _DefaultCrawler()
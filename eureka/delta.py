@@ -0,0 +1,123 @@
+'''
+Compact deltas between two versions of a page, which the cache uses to store
+old versions of pages that are crawled repeatedly.
+
+Pages are compared in chunks that end at a newline or at a ">", so that
+minified html, which has few newlines, still diffs well. Runs of chunks are
+matched through a hash table, like rsync does, which takes linear time, so
+that large pages can be compared too. A delta is a list of instructions to
+copy a range of the base version, or to insert new data, compressed with
+zlib:
+
+    delta = make_delta(new, old)
+    assert apply_delta(new, delta) == old
+
+'''
+
+import re
+import struct
+import zlib
+
+__all__ = ('make_delta', 'apply_delta')
+
+_chunks = re.compile(r'[^\n>]*[\n>]|[^\n>]+$')
+
+# the first bytes of every (uncompressed) delta, for future formats
+_magic = 'D1'
+
+# the number of chunks that are looked up at once; single chunks (like
+# "</p>\n") repeat too often to tell where a copy starts
+_window = 4
+
+def make_delta(base, target):
+    ''' returns a delta that turns the string ``base`` into ``target`` '''
+
+    base_chunks = _chunks.findall(base)
+    target_chunks = _chunks.findall(target)
+    # the offset of every chunk of base, and of its end
+    offsets = [0]
+    for chunk in base_chunks:
+        offsets.append(offsets[-1] + len(chunk))
+
+    # the first position of every run of chunks in base
+    index = {}
+    for i in xrange(len(base_chunks) - _window + 1):
+        index.setdefault(tuple(base_chunks[i:i + _window]), i)
+
+    instructions = [_magic]
+    copy_start = copy_end = None
+    inserted = []
+    # where in base we expect the next match: after the last copy, and
+    # after as many chunks as were replaced since
+    expected = 0
+    j, target_length, base_length = 0, len(target_chunks), len(base_chunks)
+    while j < target_length:
+        chunk = target_chunks[j]
+        if expected < base_length and base_chunks[expected] == chunk:
+            i = expected
+        else:
+            i = index.get(tuple(target_chunks[j:j + _window]))
+        if i is None:
+            inserted.append(chunk)
+            j += 1
+            expected += 1
+            continue
+
+        # extend the match as far as it goes
+        end = i
+        while end < base_length and j < target_length and \
+              base_chunks[end] == target_chunks[j]:
+            end += 1
+            j += 1
+        if not inserted and copy_end == offsets[i]:
+            # this continues the previous copy
+            copy_end = offsets[end]
+            expected = end
+            continue
+        if copy_start is not None:
+            instructions.append(_copy(copy_start, copy_end))
+        if inserted:
+            instructions.append(_insert(''.join(inserted)))
+            inserted = []
+        copy_start, copy_end = offsets[i], offsets[end]
+        expected = end
+
+    if copy_start is not None:
+        instructions.append(_copy(copy_start, copy_end))
+    if inserted:
+        instructions.append(_insert(''.join(inserted)))
+    return zlib.compress(''.join(instructions))
+
+def _copy(start, end):
+    return 'C%s' % struct.pack('>II', start, end - start)
+
+def _insert(data):
+    return 'I%s%s' % (struct.pack('>I', len(data)), data)
+
+def apply_delta(base, delta):
+    '''
+    returns the string that ``delta`` (made by ``make_delta``) turns
+    ``base`` into
+
+    '''
+
+    delta = zlib.decompress(delta)
+    if delta[:2] != _magic:
+        raise ValueError('not a delta')
+
+    parts = []
+    position = 2
+    end = len(delta)
+    while position < end:
+        instruction = delta[position]
+        if instruction == 'C':
+            start, length = struct.unpack_from('>II', delta, position + 1)
+            parts.append(base[start:start + length])
+            position += 9
+        elif instruction == 'I':
+            length, = struct.unpack_from('>I', delta, position + 1)
+            parts.append(delta[position + 5:position + 5 + length])
+            position += 5 + length
+        else:
+            raise ValueError('invalid delta instruction %r' % instruction)
+    return ''.join(parts)
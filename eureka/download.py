@@ -0,0 +1,269 @@
+'''
+Downloading large files straight to disk. ``Crawler.fetch`` returns a
+response that callers read into memory, and the cache stores responses in
+its database; neither works for multi-gigabyte files. ``download`` in stead
+streams the response into a file in small chunks:
+
+    data = crawler.fetch_to_file('http://example.com/dump.tar', 'dump.tar')
+
+The file is written as "<path>.part", and only renamed to ``path`` once it is
+complete and its length is right. If a download is interrupted, it is resumed
+with a range request, using the response's ETag (or Last-Modified date) as
+If-Range validator, so that the server sends the whole file again if it
+changed in the meantime.
+
+Downloads are recorded in the ``downloads`` table of the crawler's cache
+database, which is what lets a later run resume an interrupted download, or
+skip a completed one. Completed files are returned as read-only memory maps.
+
+'''
+
+import httplib
+import logging
+import mmap
+import os
+import re
+import socket
+import urllib2
+
+from eureka import EurekaException
+
+__all__ = ('DownloadError', 'download', 'open_mapped')
+
+class DownloadError(EurekaException):
+    ''' raised when a server's response doesn't fit the download '''
+
+    def __init__(self, url, reason):
+        super(DownloadError, self).__init__(u'Error downloading %s: %s'
+                                            % (url, reason))
+        self.url = url
+        self.reason = reason
+
+def open_mapped(path):
+    '''
+    returns a read-only ``mmap`` of the file at ``path``, or an empty string
+    if the file is empty (which can't be mapped)
+
+    '''
+
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+_content_range = re.compile(r'^\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$', re.I)
+
+def _parse_content_range(value):
+    ''' returns the (first, last, length) of a Content-Range, or None '''
+
+    match = _content_range.match(value or '')
+    if not match:
+        return None
+    first, last, length = match.groups()
+    return int(first), int(last), length != '*' and int(length) or None
+
+def _content_length(headers):
+    length = (headers.get('content-length') or '').strip()
+    return length.isdigit() and int(length) or None
+
+def _validator(etag, last_modified):
+    '''
+    the If-Range value for a response with ``etag`` and ``last_modified``;
+    weak ETags can't be used for range requests
+
+    '''
+
+    if etag and not etag.startswith('W/'):
+        return etag
+    return last_modified
+
+class _Download(object):
+    ''' the state of one download; see ``download`` '''
+
+    def __init__(self, crawler, url, path, headers, referer, cache_control,
+                 chunk_size):
+        self.crawler = crawler
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.headers = headers
+        self.referer = referer
+        self.cache_control = cache_control
+        self.chunk_size = chunk_size
+        self.cache = crawler.cache if crawler.cache and \
+                                      crawler.cache.connection else None
+        self.host = urllib2.Request(url).get_host().lower()
+        self.etag = self.last_modified = self.length = None
+
+    def _record(self, complete):
+        if self.cache is not None:
+            self.cache.record_download(self.url, self.path, self.cache_control,
+                                       self.etag, self.last_modified,
+                                       self.length, complete)
+
+    def completed(self):
+        ''' returns whether a complete copy was downloaded before '''
+
+        record = self.cache and self.cache.download_record(self.url)
+        if record is None:
+            return False
+        path, cache_control, etag, last_modified, length, complete = record
+        if path != self.path or cache_control != self.cache_control:
+            return False
+        if not complete:
+            self.etag, self.last_modified, self.length = \
+                    etag, last_modified, length
+            return False
+        try:
+            return os.path.getsize(self.path) == length
+        except OSError:
+            return False # the file was deleted
+
+    def offset(self):
+        '''
+        the size of the part we already have, if we know enough about it to
+        resume the download, or else 0
+
+        '''
+
+        if _validator(self.etag, self.last_modified) is None:
+            return 0
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    def _open(self, offset):
+        ''' sends the request for the rest of the file from ``offset`` '''
+
+        headers = dict(self.headers)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = _validator(self.etag, self.last_modified)
+        return self.crawler.fetch(self.url, headers=headers,
+                                  referer=self.referer,
+                                  cache_control=self.cache_control,
+                                  retries=0, stream=True)
+
+    def transfer(self):
+        '''
+        downloads the rest of the file into the part file, and returns its
+        size once it is complete
+
+        '''
+
+        metrics = self.crawler.metrics
+        offset = self.offset()
+        try:
+            response = self._open(offset)
+        except urllib2.HTTPError, e:
+            if e.code != 416 or not offset:
+                raise
+            # our part is no part of the file; start over
+            e.close()
+            offset = 0
+            response = self._open(offset)
+
+        with response:
+            headers = response.info()
+            etag, last_modified = headers.get('etag'), \
+                                  headers.get('last-modified')
+            expected = _content_length(headers)
+
+            if response.code == 206:
+                content_range = _parse_content_range(
+                        headers.get('content-range'))
+                if content_range is None or content_range[0] != offset or \
+                   (self.etag and etag and etag != self.etag):
+                    if not offset:
+                        raise DownloadError(self.url, 'unexpected partial '
+                                            'response (%s)' % content_range)
+                    # this isn't the rest of the file we have; start over
+                    logging.warning('restarting download of %s', self.url)
+                    self.etag = self.last_modified = None
+                    response.close()
+                    return self.transfer()
+                first, last, length = content_range
+                expected = last - first + 1
+                metrics.count('download_resumes', 1, self.host)
+            else:
+                # the server sent the whole file (eg. because it changed)
+                offset = 0
+                length = expected
+
+            self.etag, self.last_modified, self.length = \
+                    etag, last_modified, length
+            # so that the download can be resumed if it's interrupted
+            self._record(False)
+
+            received = 0
+            with open(self.part_path, offset and 'r+b' or 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+            metrics.count('bytes', received, self.host)
+
+        if expected is not None and received != expected:
+            # we keep what we got, and retry from there
+            raise httplib.IncompleteRead('', expected - received)
+        size = offset + received
+        if self.length is not None and size != self.length:
+            raise DownloadError(self.url, 'expected %s bytes, got %s'
+                                % (self.length, size))
+        return size
+
+    def finish(self, size):
+        os.rename(self.part_path, self.path)
+        self.length = size
+        self._record(True)
+
+def download(crawler, url, path, headers={}, referer=True, cache_control=None,
+             retries=None, chunk_size=1 << 16):
+    '''
+    Downloads ``url`` to the file ``path`` with ``crawler``, and returns a
+    read-only memory map of the file (see ``open_mapped``). See the module
+    documentation.
+
+    ``headers``, ``referer`` and ``cache_control`` are used like in
+    ``Crawler.fetch``. Failed or interrupted requests are retried up to
+    ``retries`` times (the crawler's retries by default), according to the
+    crawler's retry policy; each retry continues where the last one stopped.
+
+    If the file was downloaded to ``path`` before (with the same
+    ``cache_control``) and still has the right size, it isn't downloaded
+    again.
+
+    '''
+
+    if cache_control is None and crawler.cache_control:
+        cache_control = crawler.cache_control.next()
+    cache_control = str(cache_control or '')
+
+    state = _Download(crawler, url, path, headers, referer, cache_control,
+                      chunk_size)
+    metrics = crawler.metrics
+    if state.completed():
+        metrics.count('download_hits', 1, state.host)
+        return open_mapped(path)
+
+    policy = crawler.retry_policy
+    if retries is None:
+        retries = crawler.retries
+    for retry in xrange(retries + 1):
+        try:
+            size = state.transfer()
+            break
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if retry == retries or not policy.is_retryable(e):
+                raise
+            logging.warning('error downloading %s (try %s): %r',
+                            url, retry, e)
+            crawler._backoff(policy.delay(retry, e), state.host)
+
+    state.finish(size)
+    return open_mapped(path)
@@ -0,0 +1,60 @@
+'''
+Fingerprints of page contents, which the cache computes for every response
+it stores. The exact fingerprint (a SHA-1 hash of the decompressed body)
+tells whether a page changed at all since it was last downloaded. The
+simhash, which is optional because it is more expensive, is similar for
+pages whose text is similar, so that near-duplicates can be found:
+
+    if hamming_distance(simhash(a), simhash(b)) <= 3:
+        ...
+
+'''
+
+import hashlib
+import re
+import struct
+
+__all__ = ('content_fingerprint', 'simhash', 'hamming_distance')
+
+def content_fingerprint(body):
+    ''' returns the exact fingerprint of the response body ``body`` '''
+
+    return hashlib.sha1(body).hexdigest()
+
+_tags = re.compile(r'<[^>]*>')
+# whatever the encoding, words are separated by whitespace
+_words = re.compile(r'\S+')
+
+def simhash(body, shingle_size=3):
+    '''
+    Returns the 64-bit simhash of the text in the html or text ``body``,
+    made from its runs of ``shingle_size`` words. Pages with similar text
+    have simhashes that differ in few bits.
+
+    '''
+
+    words = _words.findall(_tags.sub(' ', body).lower())
+    weights = {}
+    for i in xrange(max(len(words) - shingle_size + 1, 1)):
+        shingle = ' '.join(words[i:i + shingle_size])
+        weights[shingle] = weights.get(shingle, 0) + 1
+
+    totals = [0] * 64
+    for shingle, weight in weights.iteritems():
+        value, = struct.unpack('>Q', hashlib.md5(shingle).digest()[:8])
+        for bit in xrange(64):
+            if value >> bit & 1:
+                totals[bit] += weight
+            else:
+                totals[bit] -= weight
+
+    result = 0
+    for bit, total in enumerate(totals):
+        if total > 0:
+            result |= 1 << bit
+    return result
+
+def hamming_distance(a, b):
+    ''' the number of bits in which the simhashes ``a`` and ``b`` differ '''
+
+    return bin((a ^ b) & 0xffffffffffffffff).count('1')
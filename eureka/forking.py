@@ -0,0 +1,43 @@
+'''
+Support for pre-fork worker models, where a parent process warms up eureka's
+caches (parsed robots.txt files, cookies, compiled XPath expressions) and
+then forks many workers.
+
+Objects that hold per-process state, such as sqlite connections and locks,
+register themselves here. After a fork, the child process must call
+``after_fork()``, or use ``eureka.forking.fork()`` in stead of ``os.fork()``,
+which does so automatically. Caches also notice a changed process id on their
+own, and re-open their database connection.
+
+'''
+
+import os
+import weakref
+
+__all__ = ('register', 'after_fork', 'fork')
+
+_objects = weakref.WeakSet()
+
+def register(obj):
+    '''
+    Registers ``obj``, so that its ``after_fork()`` method is called in child
+    processes. Only a weak reference to ``obj`` is kept.
+
+    '''
+
+    _objects.add(obj)
+    return obj
+
+def after_fork():
+    ''' resets the per-process state of all registered objects '''
+
+    for obj in list(_objects):
+        obj.after_fork()
+
+def fork():
+    ''' same as ``os.fork()``, but calls ``after_fork()`` in the child '''
+
+    pid = os.fork()
+    if pid == 0:
+        after_fork()
+    return pid
@@ -0,0 +1,166 @@
+'''
+Limits on the size and type of http responses, so that a misbehaving server
+can't make a crawler read a multi-gigabyte response into memory.
+
+'''
+
+import urllib2
+
+from eureka import EurekaException
+from eureka.metrics import null_metrics, request_host
+
+class ResponseTooLarge(EurekaException):
+    ''' raised when a response's headers or body exceed the size limit '''
+
+    def __init__(self, url, what, limit):
+        super(ResponseTooLarge, self).__init__(
+            u'Size limit of %s bytes exceeded by the %s of %s'
+            % (limit, what, url))
+        self.url = url
+        self.limit = limit
+
+class UnwantedContentType(EurekaException):
+    ''' raised when a response's content-type isn't in the allow-list '''
+
+    def __init__(self, url, content_type):
+        super(UnwantedContentType, self).__init__(
+            u'Refusing to read %s with content-type "%s"'
+            % (url, content_type))
+        self.url = url
+        self.content_type = content_type
+
+class _LimitedReader(object):
+    '''
+    Wraps a file-like object, and raises ResponseTooLarge as soon as more than
+    ``limit`` bytes are read from it. If ``truncate`` is True, the data ends
+    after ``limit`` bytes in stead.
+
+    '''
+
+    def __init__(self, fp, limit, url, truncate=False):
+        self.fp = fp
+        self.remaining = limit
+        self.limit = limit
+        self.url = url
+        self.truncate = truncate
+        if hasattr(fp, 'fileno'):
+            self.fileno = fp.fileno
+
+    def _count(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0 and self.truncate:
+            # drop what's beyond the limit
+            data = data[:self.remaining]
+            self.remaining = 0
+        elif self.remaining < 0:
+            self.close()
+            raise ResponseTooLarge(self.url, 'body', self.limit)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # read one byte more than allowed, to see whether there is more
+            return self._count(self.fp.read(self.remaining + 1))
+        return self._count(self.fp.read(min(size, self.remaining + 1)))
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining + 1:
+            size = self.remaining + 1
+        return self._count(self.fp.readline(size))
+
+    def readlines(self, sizehint=0):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fp.close()
+
+class HTTPResponseLimits(urllib2.BaseHandler):
+    '''
+    Checks responses before their body is read:
+
+     - responses whose headers are larger than ``max_header_size`` bytes, or
+       whose Content-Length is larger than ``max_body_size``, raise
+       ``ResponseTooLarge``
+     - if ``content_types`` is given, responses whose content-type doesn't
+       start with one of the given strings (eg. "text/" or "application/xml")
+       raise ``UnwantedContentType``. Error responses are not checked, so
+       that they still raise an HTTPError.
+
+    Reading more than ``max_body_size`` bytes from the body of a response
+    raises ``ResponseTooLarge``, even if the server sent no Content-Length.
+
+    A request's ``max_body_size`` and ``content_types`` attributes override
+    ``max_body_size`` and ``content_types``. If its ``truncate_body``
+    attribute is True, bodies larger than ``max_body_size`` are cut off, in
+    stead of raising ``ResponseTooLarge``. Cached responses are not checked.
+
+    '''
+
+    # after the network, but before the cache reads the response
+    handler_order = 260
+
+    metrics = null_metrics
+
+    def __init__(self, max_body_size=None, max_header_size=None,
+                 content_types=None):
+        self.max_body_size = max_body_size
+        self.max_header_size = max_header_size
+        if content_types is not None:
+            content_types = tuple(t.lower() for t in content_types)
+        self.content_types = content_types
+
+    def http_response(self, request, response):
+        if hasattr(response, 'is_from_cache'):
+            return response
+
+        url = response.geturl()
+        headers = response.info()
+        try:
+            self._check_headers(request, url, headers,
+                                200 <= response.code < 300)
+        except EurekaException:
+            response.close()
+            self.metrics.count('responses_refused', 1,
+                               request_host(request))
+            raise
+
+        limit = getattr(request, 'max_body_size', self.max_body_size)
+        if limit is None:
+            return response
+
+        reader = _LimitedReader(response.fp, limit, url,
+                                getattr(request, 'truncate_body', False))
+        limited = urllib2.addinfourl(reader, headers, url, response.code)
+        limited.msg = response.msg
+        return limited
+
+    https_response = http_response
+
+    def _check_headers(self, request, url, headers, check_content_type):
+        if self.max_header_size is not None:
+            size = sum(len(line) for line in headers.headers)
+            if size > self.max_header_size:
+                raise ResponseTooLarge(url, 'headers', self.max_header_size)
+
+        content_types = getattr(request, 'content_types', self.content_types)
+        if content_types is not None and check_content_type:
+            if content_types is not self.content_types:
+                content_types = tuple(t.lower() for t in content_types)
+            content_type = (headers.get('content-type') or '').strip().lower()
+            if not content_type.startswith(content_types):
+                raise UnwantedContentType(url, content_type)
+
+        limit = getattr(request, 'max_body_size', self.max_body_size)
+        length = headers.get('content-length')
+        if limit is not None and length and length.strip().isdigit() and \
+                int(length) > limit and \
+                not getattr(request, 'truncate_body', False):
+            raise ResponseTooLarge(url, 'body', limit)
@@ -0,0 +1,365 @@
+'''
+Counters and timers for the crawler, so that we can see where a crawl spends
+its time without attaching a profiler.
+
+    from eureka.metrics import Metrics, MemorySink
+    sink = MemorySink()
+    crawler = Crawler(metrics=Metrics(sink))
+    ...
+    print sink.report()
+
+Metrics are recorded per host (if known) and sent to one or more sinks. A
+sink is any object with a ``record(kind, name, host, value)`` method, where
+``kind`` is either "count" or "timing". This module provides an in-memory
+sink, a sink that writes to the ``logging`` module, and a sink that serves
+its values in the Prometheus text format over http.
+
+'''
+
+import logging
+import threading
+import urllib2
+from time import time
+
+__all__ = ('Metrics', 'MemorySink', 'LoggingSink', 'PrometheusSink',
+           'null_metrics')
+
+class _Timer(object):
+    ''' context manager returned by ``Metrics.timer`` '''
+
+    __slots__ = ('metrics', 'name', 'host', 'start')
+
+    def __init__(self, metrics, name, host):
+        self.metrics = metrics
+        self.name = name
+        self.host = host
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.timing(self.name, time() - self.start, self.host)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass
+_null_timer = _NullTimer()
+
+class Metrics(object):
+    '''
+    Records counters and timings, and passes them on to ``sinks``. Without
+    any sinks, recording a metric does nothing, and costs next to nothing.
+
+    '''
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def __nonzero__(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def count(self, name, value=1, host=None):
+        ''' increments the counter ``name`` by ``value`` '''
+
+        for sink in self.sinks:
+            sink.record('count', name, host, value)
+
+    def timing(self, name, seconds, host=None):
+        ''' records that the operation ``name`` took ``seconds`` seconds '''
+
+        for sink in self.sinks:
+            sink.record('timing', name, host, seconds)
+
+    def timer(self, name, host=None):
+        '''
+        Returns a context manager that records the time spent in its body:
+
+            with metrics.timer('parse', host):
+                ...
+
+        '''
+
+        if not self.sinks:
+            return _null_timer
+        return _Timer(self, name, host)
+
+# the metrics object of crawlers and handlers that weren't given one
+null_metrics = Metrics()
+
+def request_metrics(request, default):
+    '''
+    returns the metrics of the crawler that opened ``request`` (see
+    ``RequestMetrics``), or else ``default``
+
+    '''
+
+    return getattr(request, 'metrics', None) or default
+
+def request_host(request):
+    ''' returns the host of a urllib2.Request, for use as a metrics label '''
+
+    try:
+        return request.get_host().lower()
+    except (AttributeError, ValueError):
+        return None
+
+class MemorySink(object):
+    '''
+    Keeps running totals in memory. ``counters`` maps (name, host) to the
+    counter's value and ``timers`` maps (name, host) to [count, total, max].
+    Every value is also added to the (name, None) total over all hosts.
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        ''' starts with a new lock and empty totals in a forked child '''
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+    def record(self, kind, name, host, value):
+        with self._lock:
+            keys = (host is None) and ((name, None),) \
+                                  or ((name, host), (name, None))
+            for key in keys:
+                if kind == 'timing':
+                    timer = self.timers.get(key)
+                    if timer is None:
+                        self.timers[key] = [1, value, value]
+                    else:
+                        timer[0] += 1
+                        timer[1] += value
+                        if value > timer[2]:
+                            timer[2] = value
+                else:
+                    self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, host=None):
+        ''' returns the value of a counter, or 0 if it was never counted '''
+
+        return self.counters.get((name, host), 0)
+
+    def total_time(self, name, host=None):
+        ''' returns the total number of seconds recorded for a timer '''
+
+        return self.timers.get((name, host), (0, 0.0, 0.0))[1]
+
+    def hit_rate(self, host=None):
+        '''
+        Returns the fraction of cache lookups that were cache hits, or None if
+        there were no lookups.
+
+        '''
+
+        hits = self.counter('cache_hits', host)
+        lookups = hits + self.counter('cache_misses', host)
+        if not lookups:
+            return None
+        return float(hits) / lookups
+
+    def report(self, hosts=False):
+        '''
+        Returns a human-readable summary. Per-host values are only included
+        if ``hosts`` is True.
+
+        '''
+
+        with self._lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+        for (name, host), (count, total, maximum) in timers:
+            if host is None or hosts:
+                lines.append('%-32s %8d calls %10.3fs total %8.3fs max' %
+                             (_label(name, host), count, total, maximum))
+        for (name, host), value in counters:
+            if host is None or hosts:
+                lines.append('%-32s %8d' % (_label(name, host), value))
+                if name == 'cache_misses':
+                    lines.append('%-32s %7.1f%%' % (
+                            _label('cache_hit_rate', host),
+                            100 * self.hit_rate(host)))
+        return '\n'.join(lines)
+
+def _label(name, host):
+    if host is None:
+        return name
+    return '%s[%s]' % (name, host)
+
+class LoggingSink(object):
+    ''' Writes every recorded value to a logger. '''
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('eureka.metrics')
+        self.level = level
+
+    def record(self, kind, name, host, value):
+        if kind == 'timing':
+            self.logger.log(self.level, 'metrics: %s %.4fs',
+                            _label(name, host), value)
+        else:
+            self.logger.log(self.level, 'metrics: %s +%s',
+                            _label(name, host), value)
+
+class PrometheusSink(MemorySink):
+    '''
+    A ``MemorySink`` that can render its values in the Prometheus text
+    exposition format. ``serve()`` starts a background http server on the
+    local host that serves them to a Prometheus scraper.
+
+    '''
+
+    def __init__(self, prefix='eureka_'):
+        super(PrometheusSink, self).__init__()
+        self.prefix = prefix
+        self.server = None
+
+    def after_fork(self):
+        # the server thread only runs in the parent process
+        super(PrometheusSink, self).after_fork()
+        self.server = None
+
+    def render(self):
+        ''' returns the current values in the Prometheus text format '''
+
+        with self._lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+        previous = None
+        for (name, host), value in counters:
+            if host is None:
+                continue
+            metric = '%s%s_total' % (self.prefix, name)
+            if metric != previous:
+                lines.append('# TYPE %s counter' % metric)
+                previous = metric
+            lines.append('%s{host="%s"} %s' % (metric, _escape(host), value))
+        for (name, host), (count, total, maximum) in timers:
+            if host is None:
+                continue
+            metric = '%s%s_seconds' % (self.prefix, name)
+            if metric != previous:
+                lines.append('# TYPE %s summary' % metric)
+                previous = metric
+            lines.append('%s_count{host="%s"} %d' % (metric, _escape(host),
+                                                     count))
+            lines.append('%s_sum{host="%s"} %.6f' % (metric, _escape(host),
+                                                     total))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def serve(self, port=9108, address='127.0.0.1'):
+        '''
+        Serves ``render()`` over http at http://``address``:``port``/ in a
+        daemon thread. Returns the server object.
+
+        '''
+
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        sink = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+def _escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"')
+
+# {{{ handlers that time the network part of a request
+class RequestMetrics(urllib2.BaseHandler):
+    '''
+    Sets the ``metrics`` attribute of every request that passes through the
+    handler chain, including redirects and robots.txt files. Handlers that
+    several crawlers can share, like the default cache, record their metrics
+    with ``request_metrics``, so that they count for the crawler that opened
+    the request.
+
+    '''
+
+    handler_order = 0 # before anyone else sees the request
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def http_request(self, request):
+        request.metrics = self.metrics
+        return request
+
+    https_request = http_request
+
+class NetworkTimerStart(urllib2.BaseHandler):
+    '''
+    Marks the time at which a request leaves the handler chain for the
+    network, ie. after robots.txt, cache lookups and delays.
+
+    '''
+
+    handler_order = 499 # just before the default http handlers
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def http_open(self, request):
+        request.network_start_time = time()
+
+    https_open = http_open
+
+class NetworkTimerEnd(urllib2.BaseHandler):
+    '''
+    Records the time from ``NetworkTimerStart`` until the response headers
+    were received. Reading the body is timed by whoever reads it.
+
+    '''
+
+    # after the cookie processor, but before the cache reads the response body
+    handler_order = 250
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def http_response(self, request, response):
+        start = getattr(request, 'network_start_time', None)
+        if start is not None and not hasattr(response, 'is_from_cache'):
+            host = request_host(request)
+            self.metrics.timing('network', time() - start, host)
+            self.metrics.count('responses', 1, host)
+        return response
+
+    https_response = http_response
+# }}} handlers that time the network part of a request
@@ -1,5 +1,9 @@
+import re
+import sys
 from itertools import groupby
-from urllib import quote_plus
+# urlparse.unquote is the same as urllib.unquote, but importing urllib is a
+# lot slower
+from urlparse import urlparse, urlunparse, unquote
 
 # {{{ functions related to short_repr
 max_len = 66
@@ -87,83 +91,206 @@ def urldecode(string):
 
     '''
 
-    import urllib
-
     for entry in string.split('&'):
-        if '=' in entry:
-            key, value = entry.split('=', 1)
-            yield urllib.unquote(key), urllib.unquote(value)
+        key, eq, value = entry.partition('=')
+        if '%' in key:
+            key = unquote(key)
+        if not eq:
+            yield key, None
+        elif '%' in value:
+            yield key, unquote(value)
         else:
-            yield urllib.unquote(entry), None
+            yield key, value
 
-def urlencode(query, doseq=0):
-    """
-    Same as urllib.urlencode, but queries with items whose second element is
-    None will be converted to a url argument without an equal sign.
+class _DecodeCache(dict):
+    ''' maps the "key=value" entries of query strings to their decoding '''
 
-    """
+    def __missing__(self, entry):
+        value = self[entry] = iter(urldecode(entry)).next()
+        return value
+
+def urldecode_many(strings):
+    '''
+    Decodes many query strings at once. Returns a list with the
+    ``list(urldecode(string))`` of each of the ``strings``. Parameters that
+    occur in several of the strings, like the fixed fields of a form, are
+    only decoded once.
 
-    if hasattr(query,"items"):
+    '''
+
+    decode = _DecodeCache().__getitem__
+    return [map(decode, string.split('&')) for string in strings]
+
+def _query_items(query):
+    ''' returns the (key, value) pairs of a mapping or a sequence of pairs '''
+
+    if hasattr(query, 'items'):
         # mapping objects
-        query = query.items()
-    else:
-        # it's a bother at times that strings and string-like objects are
-        # sequences...
-        try:
-            # non-sequence items should not work with len()
-            # non-empty strings will fail this
-            if len(query) and not isinstance(query[0], tuple):
-                raise TypeError
-            # zero-length sequences of all types will get here and succeed,
-            # but that's a minor nit - since the original implementation
-            # allowed empty dicts that type of behavior probably should be
-            # preserved for consistency
-        except TypeError:
-            ty,va,tb = sys.exc_info()
-            raise TypeError, "not a valid non-string sequence or mapping object", tb
+        return query.items()
+
+    # it's a bother at times that strings and string-like objects are
+    # sequences...
+    try:
+        # non-sequence items should not work with len()
+        # non-empty strings will fail this
+        if len(query) and not isinstance(query[0], tuple):
+            raise TypeError
+        # zero-length sequences of all types will get here and succeed,
+        # but that's a minor nit - since the original implementation
+        # allowed empty dicts that type of behavior probably should be
+        # preserved for consistency
+    except TypeError:
+        ty, va, tb = sys.exc_info()
+        raise TypeError, "not a valid non-string sequence or mapping object", tb
+    return query
+
+# {{{ fast quote_plus
+_always_safe = ('ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                'abcdefghijklmnopqrstuvwxyz'
+                '0123456789' '_.-')
+_quote_table = dict((chr(i), '%%%02X' % i) for i in xrange(256))
+_quote_table.update((c, c) for c in _always_safe)
+_quote_table[' '] = '+'
+_unsafe_re = re.compile('[^%s]' % re.escape(_always_safe))
+
+def _quote_plus(string, search=_unsafe_re.search, sub=_unsafe_re.sub,
+                quote_char=lambda match: _quote_table[match.group()]):
+    '''
+    Same as ``urllib.quote_plus(string)`` for byte strings, but strings that
+    need no quoting are returned without copying them.
+
+    '''
+
+    if search(string) is None:
+        return string
+    return sub(quote_char, string)
+
+class _QuoteCache(dict):
+    '''
+    Memoizes ``quote_plus(str(key))``, looked up as ``cache[type(key), key]``.
+    Parameter names repeat for every submission of the same form, so they
+    only need to be quoted once. The type is part of the key because equal
+    keys may quote differently, like ``True`` and ``1``.
+
+    '''
+
+    max_size = 4096
+
+    def __missing__(self, type_key):
+        if len(self) >= self.max_size:
+            self.clear()
+        value = self[type_key] = _quote_plus(str(type_key[1]))
+        return value
+
+_quoted_keys = _QuoteCache()
+
+class _QuotedValues(dict):
+    '''
+    Memoizes ``_quote_plus(value)`` for the byte strings of a batch of
+    queries; see ``urlencode_many``.
+
+    '''
+
+    def __missing__(self, value):
+        quoted = self[value] = _quote_plus(value)
+        return quoted
+# }}} fast quote_plus
+
+def _encode_items(query, doseq, quoted_keys, _quote_plus=_quote_plus):
+    '''
+    helper for ``urlencode`` and ``urlencode_many``; ``_quote_plus`` quotes
+    byte strings
+
+    '''
 
     l = []
+    append = l.append
     if not doseq:
         # preserve old behavior
         for k, v in query:
-            k = quote_plus(str(k))
+            k = quoted_keys[type(k), k]
             if v is None:
-                l.append(k)
+                append(k)
             else:
-                v = quote_plus(str(v))
-                l.append(k + '=' + v)
-    else:
-        for k, v in query:
-            k = quote_plus(str(k))
-            if isinstance(v, str):
-                v = quote_plus(v)
-                l.append(k + '=' + v)
-            elif isinstance(v, unicode):
-                # is there a reasonable way to convert to ASCII?
-                # encode generates a string, but "replace" or "ignore"
-                # lose information and "strict" can raise UnicodeError
-                v = quote_plus(v.encode("ASCII","replace"))
-                l.append(k + '=' + v)
+                append(k + '=' + _quote_plus(str(v)))
+        return '&'.join(l)
+
+    for k, v in query:
+        k = quoted_keys[type(k), k]
+        t = type(v)
+        if t is str:
+            append(k + '=' + _quote_plus(v))
+        elif v is None:
+            append(k)
+        elif t is unicode or isinstance(v, unicode):
+            # is there a reasonable way to convert to ASCII?
+            # encode generates a string, but "replace" or "ignore"
+            # lose information and "strict" can raise UnicodeError
+            append(k + '=' + _quote_plus(v.encode("ASCII", "replace")))
+        elif isinstance(v, str):
+            append(k + '=' + _quote_plus(v))
+        else:
+            try:
+                # is this a sufficient test for sequence-ness?
+                len(v)
+            except TypeError:
+                # not a sequence
+                append(k + '=' + _quote_plus(str(v)))
             else:
-                if v is None:
-                    l.append(k)
-                else:
-                    try:
-                        # is this a sufficient test for sequence-ness?
-                        x = len(v)
-                    except TypeError:
-                        # not a sequence
-                        v = quote_plus(str(v))
-                        l.append(k + '=' + v)
-                    else:
-                        # loop over the sequence
-                        for elt in v:
-                            if elt is None:
-                                elt = k
-                            l.append(k + '=' + quote_plus(str(elt)))
-
+                # loop over the sequence
+                for elt in v:
+                    if elt is None:
+                        elt = k
+                    append(k + '=' + _quote_plus(str(elt)))
     return '&'.join(l)
 
+def urlencode(query, doseq=0):
+    """
+    Same as urllib.urlencode, but queries with items whose second element is
+    None will be converted to a url argument without an equal sign.
+
+    """
+
+    return _encode_items(_query_items(query), doseq, _quoted_keys)
+
+def urlencode_many(queries, doseq=0):
+    '''
+    Encodes many queries at once; returns a list with the
+    ``urlencode(query, doseq)`` of each of the ``queries``. Values that occur
+    in several of the queries, like the fixed fields of a form, are only
+    quoted once.
+
+    '''
+
+    encode = _encode_items
+    items = _query_items
+    quote = _QuotedValues().__getitem__
+    return [encode(items(query), doseq, _quoted_keys, quote)
+            for query in queries]
+
+def add_parameters_to_url(url, values):
+    '''
+    adds ``values`` as url-encoded GET parameters to ``url``. ``values`` is
+    specified as a dictionary, or as a list of (key, value) pairs. Existing
+    parameters with the same keys are replaced.
+
+    '''
+
+    values = _query_items(values)
+    scheme, netloc, path, params, query, fragment = urlparse(url)
+
+    new_query = []
+    if query:
+        # remove these keys from the GET parameters, as we are specifying new
+        # values for them...
+        delete_keys = frozenset(key for key, _ in values)
+        new_query.extend(item for item in urldecode(query)
+                         if item[0] not in delete_keys)
+    new_query.extend(values)
+
+    query = _encode_items(new_query, 1, _quoted_keys)
+    return urlunparse((scheme, netloc, path, params, query, fragment))
+
 def chain(iterable):
     '''
     like ``itertools.chain``, but takes an iterable argument, in stead of
@@ -2,12 +2,90 @@
 # PATH. In Ubuntu, this is the package poppler-utils, and on windows, it can be
 # downloaded from http://sourceforge.net/projects/pdftohtml/
 
+import re
+from collections import OrderedDict
+from hashlib import sha1
 from tempfile import NamedTemporaryFile
 from subprocess import Popen, PIPE
-from os import remove
+from os import remove, path
+
+from eureka.pool import LRUCache, WorkerPool
 
 class PDFException(Exception): pass
 
+def _default_command():
+    from settings import pdf_converter
+    return pdf_converter
+
+def _copy_to_tempfile(fp, chunk_size=65536):
+    '''
+    Streams the file-like object ``fp`` into a temporary pdf file, without
+    holding the whole file in memory. Returns the name of the temporary file,
+    and the sha1 hex-digest of its content.
+
+    '''
+
+    digest = sha1()
+    tempfile = NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            tempfile.write(chunk)
+    except:
+        tempfile.close()
+        remove(tempfile.name)
+        raise
+    tempfile.close()
+    return tempfile.name, digest.hexdigest()
+
+def _start_pdftohtml(filename, command, xml, extra_args, stdout=PIPE):
+    ''' starts pdftohtml on ``filename``, with its output to ``stdout`` '''
+
+    cmdline = [command, '-stdout']
+    if xml:
+        cmdline.append('-xml')
+    cmdline.extend(extra_args)
+    cmdline.append(filename)
+    return Popen(args=cmdline, stdout=stdout)
+
+def _wait(proc):
+    ''' waits for pdftohtml to exit, and raises PDFException if it failed '''
+
+    returncode = proc.wait()
+    if returncode != 0:
+        raise PDFException('pdftohtml was unable to convert file from'
+                'pdf to html. Return code was %s' % returncode)
+
+def _parse(source):
+    ''' parses pdftohtml's output from the file or file-like ``source`` '''
+
+    from lxml import etree
+    from eureka.xml import XMLParser
+
+    return etree.parse(source, parser=XMLParser()).getroot()
+
+def _run_pdftohtml(filename, command, xml, extra_args):
+    '''
+    runs pdftohtml on ``filename``, and returns its parsed output, which is
+    parsed as it is produced, so that it is never held in memory as a whole
+
+    '''
+
+    proc = _start_pdftohtml(filename, command, xml, extra_args)
+    try:
+        document = _parse(proc.stdout)
+    except:
+        proc.stdout.close()
+        # if pdftohtml failed, that's why we couldn't parse its output
+        _wait(proc)
+        raise
+    proc.stdout.close()
+    _wait(proc)
+    return document
+
 def pdftohtml(fp, command=None, xml=True, extra_args=[]):
     '''
     Uses pdftohtml to convert a file-like object fp into an xml or html file
@@ -16,35 +94,286 @@ def pdftohtml(fp, command=None, xml=True, extra_args=[]):
 
     '''
 
-    from lxml import etree
-    from eureka.xml import XMLParser
-
     if not command:
-        from settings import pdf_converter
-        command = pdf_converter
-    
-    tempfile = NamedTemporaryFile(suffix='.pdf', delete=False)
+        command = _default_command()
+
+    filename, _ = _copy_to_tempfile(fp)
     try:
-        tempfile.write(fp.read())
-        tempfile.close()
-        
-        cmdline = [command, '-stdout']
-        if xml:
-            cmdline.append('-xml')
-        cmdline.extend(extra_args)
-        cmdline.append(tempfile.name)
-
-        proc = Popen(args=cmdline, stdout=PIPE)
-        xml = etree.parse(proc.stdout, parser=XMLParser()).getroot()
-        returncode = proc.wait()
-
-        if returncode != 0:
-            raise PDFException('pdftohtml was unable to convert file from'
-                    'pdf to html. Return code was %s' % returncode)
+        return _run_pdftohtml(filename, command, xml, extra_args)
     finally:
-        tempfile.close()
-        remove(tempfile.name)
+        remove(filename)
+
+def _remove_quietly(filename):
+    try:
+        remove(filename)
+    except OSError:
+        pass # eg. on windows, while someone still reads it
+
+def _parse_output(output):
+    ''' parses and closes the output file returned by a pool worker '''
+
+    try:
+        return _parse(output)
+    finally:
+        output.close()
+
+class PDFConverterPool(WorkerPool):
+    '''
+    Converts many pdf files concurrently, by running up to ``processes``
+    pdftohtml processes at once. The arguments `command`, `xml` and
+    `extra_args` have the same meaning as in ``pdftohtml``.
+
+    pdftohtml's output is written to temporary files, which are parsed by
+    whoever asks for the documents. The files of the last ``cache_size``
+    conversions are kept (until ``close()``), keyed by the sha1 hash of the
+    pdf file, so that the same pdf isn't converted twice.
+
+        pool = PDFConverterPool(processes=8)
+        for tree in pool.imap(crawler.fetch(url) for url in pdf_urls):
+            ...
+
+    '''
+
+    def __init__(self, processes=4, command=None, xml=True, extra_args=(),
+                 cache_size=128):
+        WorkerPool.__init__(self, processes)
+        self.processes = processes
+        self.command = command or _default_command()
+        self.xml = xml
+        self.extra_args = list(extra_args)
+        self.cache_size = cache_size
+        # sha1 of the pdf -> the name of the file with pdftohtml's output
+        self._outputs = LRUCache(cache_size, _remove_quietly)
+
+    def _cached_output(self, digest):
+        ''' opens the cached output for the pdf with ``digest``, if any '''
+
+        name = self._outputs.get(digest)
+        if name is None:
+            return None
+        try:
+            return open(name, 'rb')
+        except IOError:
+            return None # it was evicted in the meantime
+
+    def _convert(self, fp):
+        '''
+        streams ``fp`` to disk and converts it; returns an open file with
+        pdftohtml's output
+
+        '''
+
+        filename, digest = _copy_to_tempfile(fp)
+        try:
+            output = self._cached_output(digest)
+            if output is None:
+                output = NamedTemporaryFile(suffix='.xml', delete=False)
+                try:
+                    _wait(_start_pdftohtml(filename, self.command, self.xml,
+                                           self.extra_args, stdout=output))
+                except:
+                    output.close()
+                    _remove_quietly(output.name)
+                    raise
+                output.seek(0)
+                self._outputs.put(digest, output.name)
+        finally:
+            remove(filename)
+            if hasattr(fp, 'close'):
+                fp.close()
+        return output
+
+    def convert(self, fp):
+        ''' converts a single pdf file-like object, like ``pdftohtml`` '''
+
+        return _parse_output(self._convert(fp))
+
+    def submit(self, fp):
+        '''
+        Starts converting ``fp`` in the background. Returns an object whose
+        ``get()`` method returns the converted document.
+
+        '''
+
+        return _PendingConversion(self._pool.apply_async(self._convert, (fp,)))
+
+    def imap(self, fps):
+        '''
+        Converts the pdf file-like objects from the iterable ``fps``, and
+        yields the converted documents in the same order.
+
+        '''
+
+        return self._ordered(self.submit, fps)
+
+    def close(self):
+        '''
+        waits for all conversions to finish, stops the workers, and removes
+        the cached output
+
+        '''
+
+        WorkerPool.close(self)
+        self._outputs.clear()
+
+class _PendingConversion(object):
+    def __init__(self, async_result):
+        self._result = async_result
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        # parse in the calling thread; lxml trees shouldn't cross threads
+        return _parse_output(self._result.get(timeout))
+
+def _page_count(filename, command):
+    '''
+    Uses pdfinfo, which is installed alongside pdftohtml, to determine the
+    number of pages of a pdf file. Returns None if that doesn't work.
+
+    '''
+
+    directory, name = path.split(command)
+    pdfinfo = path.join(directory, name.replace('pdftohtml', 'pdfinfo'))
+    if pdfinfo == command:
+        return None
+
+    try:
+        proc = Popen(args=[pdfinfo, filename], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        return None
+    output, _ = proc.communicate()
+    match = re.search(r'^Pages:\s*(\d+)', output, re.MULTILINE)
+    if proc.returncode != 0 or not match:
+        return None
+    return int(match.group(1))
+
+class PDFDocument(object):
+    '''
+    A pdf file that is converted to xml lazily, ``chunk_size`` pages at a
+    time, as its pages are accessed. Pages are returned as the "page" elements
+    of pdftohtml's xml output. Page numbers start at 1:
+
+        with crawler.fetch_pdf_document(url) as document:
+            for page in document.pages(1, 3):
+                ...
+
+    The last ``cache_chunks`` converted chunks are kept in memory. The pdf
+    itself is kept in a temporary file until ``close()`` is called.
+
+    '''
+
+    def __init__(self, fp, command=None, extra_args=(), chunk_size=10,
+                 cache_chunks=8):
+        self.command = command or _default_command()
+        self.extra_args = list(extra_args)
+        self.chunk_size = chunk_size
+        self.cache_chunks = cache_chunks
+        self.filename, self.digest = _copy_to_tempfile(fp)
+        self._chunks = OrderedDict()
+        self._page_count = None
+        self._asked_pdfinfo = False
+
+    def __len__(self):
+        return self.page_count
+
+    @property
+    def page_count(self):
+        '''
+        The number of pages. If pdfinfo isn't available, the whole document
+        has to be converted to find out.
+
+        '''
+
+        if self._known_page_count() is None:
+            for _ in self.pages():
+                pass
+        return self._page_count
+
+    def _known_page_count(self):
+        '''
+        returns the number of pages if pdfinfo can tell, or if we converted
+        the last page already, and otherwise None
+
+        '''
+
+        if self._page_count is None and not self._asked_pdfinfo:
+            self._asked_pdfinfo = True
+            self._page_count = _page_count(self.filename, self.command)
+        return self._page_count
+
+    def _chunk(self, index):
+        ''' returns the list of pages in the ``index``-th chunk '''
+
+        if index in self._chunks:
+            pages = self._chunks[index] = self._chunks.pop(index)
+            return pages
+
+        first = index * self.chunk_size + 1
+        last = first + self.chunk_size - 1
+        # pdftohtml may fail if we ask for pages past the end
+        page_count = self._known_page_count()
+        if page_count is not None:
+            if first > page_count:
+                return []
+            last = min(last, page_count)
+
+        document = _run_pdftohtml(self.filename, self.command, True,
+                ['-f', str(first), '-l', str(last)] + self.extra_args)
+        pages = document.xpath('page')
+
+        # pdftohtml converts the last page again, if we ask for pages
+        # past the end of the document
+        pages = [page for page in pages
+                 if first <= int(page.get('number', first)) <= last]
+        if len(pages) < last - first + 1:
+            self._page_count = first - 1 + len(pages)
+
+        self._chunks[index] = pages
+        while len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return pages
+
+    def page(self, number):
+        ''' returns page number ``number``, counting from 1 '''
+
+        if number < 1:
+            raise IndexError('pdf page numbers start at 1')
+        pages = self._chunk((number - 1) // self.chunk_size)
+        offset = (number - 1) % self.chunk_size
+        if offset >= len(pages):
+            raise IndexError('pdf has no page %s' % number)
+        return pages[offset]
+
+    def pages(self, first=1, last=None):
+        '''
+        Yields the pages from ``first`` to ``last`` (inclusive), or to the end
+        of the document. Pages are only converted as they are reached.
+
+        '''
+
+        number = first
+        while last is None or number <= last:
+            try:
+                yield self.page(number)
+            except IndexError:
+                return
+            number += 1
+
+    def __iter__(self):
+        return self.pages()
+
+    def close(self):
+        ''' removes the temporary copy of the pdf '''
 
+        if self.filename is not None:
+            remove(self.filename)
+            self.filename = None
+        self._chunks.clear()
 
-    return xml
+    def __enter__(self):
+        return self
 
+    def __exit__(self, type, value, traceback):
+        self.close()
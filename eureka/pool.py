@@ -0,0 +1,100 @@
+'''
+Helpers for running an external program, like pdftohtml or tesseract, on
+many inputs at once. ``eureka.pdf.PDFConverterPool`` and
+``eureka.tesseract.OCRPool`` are built on them.
+
+'''
+
+import threading
+from collections import OrderedDict, deque
+
+class LRUCache(object):
+    '''
+    A thread-safe mapping that keeps the ``size`` most recently used
+    entries. If ``evicted`` is given, it is called with the value of every
+    entry that is dropped.
+
+    '''
+
+    def __init__(self, size, evicted=None):
+        self.size = size
+        self.evicted = evicted
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' returns the value for ``key``, or None '''
+
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value # mark as recently used
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self._entries[key] = value
+            dropped = []
+            while len(self._entries) > self.size:
+                dropped.append(self._entries.popitem(last=False)[1])
+        if old is not None and old is not value:
+            dropped.append(old)
+        if self.evicted is not None:
+            for value in dropped:
+                self.evicted(value)
+
+    def clear(self):
+        with self._lock:
+            dropped = self._entries.values()
+            self._entries.clear()
+        if self.evicted is not None:
+            for value in dropped:
+                self.evicted(value)
+
+    def __len__(self):
+        return len(self._entries)
+
+class WorkerPool(object):
+    '''
+    Runs jobs in up to ``workers`` threads. The actual work happens in
+    subprocesses, so threads are enough to keep all cores busy. Subclasses
+    start jobs with ``self._pool.apply_async``.
+
+    '''
+
+    def __init__(self, workers):
+        from multiprocessing.pool import ThreadPool
+
+        self.workers = workers
+        self._pool = ThreadPool(workers)
+
+    def _ordered(self, submit, items):
+        '''
+        Calls ``submit(item)`` for the items of the iterable ``items``, and
+        yields the results of calling ``get()`` on what it returns (like a
+        ``multiprocessing.pool.AsyncResult``), in the same order. At most
+        twice as many items as there are workers are read ahead of the
+        consumer.
+
+        '''
+
+        pending = deque()
+        for item in items:
+            pending.append(submit(item))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        ''' waits for all jobs to finish, and stops the workers '''
+
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
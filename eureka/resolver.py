@@ -0,0 +1,219 @@
+'''
+A cache for DNS lookups. Without it, every new connection looks up its host
+name with a blocking ``getaddrinfo`` call, which can take a large part of
+the time to the first byte when crawling many small sites.
+
+The system resolver doesn't tell us the TTL of its answers, so addresses are
+cached for a fixed ``ttl``. Failed lookups are cached for ``negative_ttl``.
+Host names can be resolved in advance, on a small thread pool:
+
+    resolver = DNSCache()
+    crawler = Crawler(resolver=resolver)
+    resolver.prefetch(urls)
+
+'''
+
+import socket
+import threading
+import urlparse
+from time import time
+
+from eureka.metrics import null_metrics
+from eureka.url import hostname
+
+__all__ = ('DNSCache', 'dns_cache')
+
+class _Entry(object):
+    __slots__ = ('addresses', 'error', 'expires')
+
+    def __init__(self, addresses, error, expires):
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+
+def _hostname(host_or_url):
+    ''' returns the lower-case host name of a url, or of a "host:port" '''
+
+    if '://' in host_or_url:
+        return urlparse.urlsplit(host_or_url).hostname or ''
+    return hostname(host_or_url)
+
+class DNSCache(object):
+    '''
+    Resolves host names with ``socket.getaddrinfo``, and caches the results.
+    If several threads look up the same host at once, only one of them asks
+    the system resolver. At most ``max_size`` host names are cached.
+    ``prefetch`` uses up to ``workers`` threads.
+
+    As a ``DNSCache`` is usually shared by several crawlers, its methods take
+    the ``metrics`` to record to; if they get none, its own ``metrics`` are
+    used.
+
+    '''
+
+    metrics = null_metrics
+
+    def __init__(self, ttl=300, negative_ttl=30, max_size=10000, workers=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.workers = workers
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        # other threads' lookups and the prefetch threads are gone
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pool = None
+
+    def _lookup(self, host):
+        '''
+        returns the cached entry for ``host``, or an Event to wait for if
+        another thread is resolving it, or None if we should resolve it
+
+        '''
+
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry.expires > time():
+                return entry
+            event = self._pending.get(host)
+            if event is None:
+                self._pending[host] = threading.Event()
+            return event
+
+    def _store(self, host, entry):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                now = time()
+                for key, old in self._entries.items():
+                    if old.expires <= now:
+                        del self._entries[key]
+                if len(self._entries) >= self.max_size:
+                    self._entries.clear()
+            self._entries[host] = entry
+            self._pending.pop(host).set()
+
+    def resolve(self, host, metrics=None):
+        '''
+        Returns the ``getaddrinfo`` results for ``host`` (with port 0), or
+        raises socket.gaierror if it can't be resolved.
+
+        '''
+
+        metrics = metrics or self.metrics
+        host = host.lower()
+        while True:
+            entry = self._lookup(host)
+            if isinstance(entry, _Entry):
+                metrics.count('dns_hits', 1, host)
+                break
+            elif entry is not None:
+                entry.wait()
+                continue
+
+            metrics.count('dns_misses', 1, host)
+            start = time()
+            try:
+                addresses = socket.getaddrinfo(host, 0, 0, socket.SOCK_STREAM)
+            except socket.gaierror, e:
+                metrics.count('dns_failures', 1, host)
+                entry = _Entry(None, e, time() + self.negative_ttl)
+            except:
+                # eg. a KeyboardInterrupt; don't cache anything
+                with self._lock:
+                    self._pending.pop(host).set()
+                raise
+            else:
+                entry = _Entry(addresses, None, time() + self.ttl)
+            metrics.timing('dns', time() - start, host)
+            self._store(host, entry)
+            break
+
+        if entry.error is not None:
+            raise entry.error
+        return entry.addresses
+
+    def create_connection(self, address,
+                          timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                          source_address=None, metrics=None):
+        '''
+        Same as ``socket.create_connection``, but uses the cache to resolve
+        the host name. httplib connections can use this in stead.
+
+        '''
+
+        host, port = address
+        error = None
+        for family, socktype, proto, _, sockaddr in self.resolve(host,
+                                                                 metrics):
+            sockaddr = (sockaddr[0], port) + tuple(sockaddr[2:])
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error, e:
+                error = e
+                if sock is not None:
+                    sock.close()
+
+        if error is not None:
+            raise error
+        raise socket.error('getaddrinfo returns an empty list')
+
+    def _prefetch(self, host, metrics):
+        try:
+            self.resolve(host, metrics)
+        except socket.error:
+            pass # it's in the cache as a failed lookup now
+
+    def prefetch(self, hosts, metrics=None):
+        '''
+        Resolves the host names (or the hosts of the urls) in ``hosts`` in
+        the background, unless they are already cached.
+
+        '''
+
+        from multiprocessing.pool import ThreadPool
+
+        now = time()
+        queued = set()
+        for host in hosts:
+            host = _hostname(host)
+            entry = self._entries.get(host)
+            if not host or host in queued or host in self._pending or \
+                    (entry is not None and entry.expires > now):
+                continue
+            queued.add(host)
+            if self._pool is None:
+                with self._lock:
+                    if self._pool is None:
+                        self._pool = ThreadPool(self.workers)
+            (metrics or self.metrics).count('dns_prefetches', 1, host)
+            self._pool.apply_async(self._prefetch, (host, metrics))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def close(self):
+        ''' stops the prefetch threads '''
+
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+# the resolver of crawlers that are created with resolver=True
+dns_cache = DNSCache()
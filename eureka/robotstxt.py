@@ -1,18 +1,52 @@
 import logging
+import threading
 import urllib2
 from urlparse import urlsplit
 from robotparser import RobotFileParser
 
+from eureka import EurekaException
+from eureka.metrics import null_metrics, request_host
+from eureka.url import default_canonicalizer
+
 class RobotDisallow(Exception):
     pass
 
+def parse_sitemap_urls(lines):
+    ''' returns the urls of the "Sitemap:" lines of a robots.txt file '''
+
+    urls = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        field, _, value = line.partition(':')
+        if field.strip().lower() == 'sitemap' and value.strip():
+            urls.append(value.strip())
+    return urls
+
 class RobotsTxt(urllib2.BaseHandler):
     handler_order = 99 # run this before the default handlers
 
-    def __init__(self):
+    metrics = null_metrics
+
+    # like Google, we only read the first 500 KB of a robots.txt file
+    max_size = 500 * 1024
+
+    def __init__(self, canonicalizer=default_canonicalizer):
         # A global cache of all robots files we've downloaded so far.
         # It is a dictionary from url to robotparser.RobotFileParser
         self.robot_files = {}
+        # the sitemap urls listed in the robots files, by robots.txt url
+        self.sitemap_urls = {}
+
+        # urls are canonicalized before looking up their robots.txt file, so
+        # that eg. "http://Example.com:80/" and "http://example.com/" share
+        # one robots.txt download
+        self.canonicalizer = canonicalizer
+
+        # one lock per robots.txt url, so that only one thread downloads it
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # the robots.txt urls that the current thread is downloading
+        self._fetching = threading.local()
 
     @staticmethod
     def make_robot_url(url):
@@ -30,7 +64,10 @@ class RobotsTxt(urllib2.BaseHandler):
     def http_request(self, request):
         user_agent = request.get_header('User-agent')
         url = request.get_full_url()
-        if not self.can_fetch(url, user_agent):
+        with self.metrics.timer('robots', request_host(request)):
+            allowed = self.can_fetch(url, user_agent)
+        if not allowed:
+            self.metrics.count('robots_disallowed', 1, request_host(request))
             raise RobotDisallow('Error: URL is disallowed in robots.txt:'+url)
         return request
 
@@ -38,22 +75,58 @@ class RobotsTxt(urllib2.BaseHandler):
         ''' fetches the appropriate robots.txt file '''
 
         if robot_url in self.robot_files:
-            robot_file = self.robot_files[robot_url]
-        else:
-            # Set this url to None to catch recursion loops
-            self.robot_files[robot_url] = None 
+            return self.robot_files[robot_url]
+
+        fetching = getattr(self._fetching, 'urls', None)
+        if fetching is None:
+            fetching = self._fetching.urls = set()
+        if robot_url in fetching:
+            # we're being called recursively, while downloading robot_url
+            return None
+
+        with self._locks_lock:
+            lock = self._locks.setdefault(robot_url, threading.Lock())
+        with lock:
+            # another thread may have downloaded it while we waited
+            if robot_url in self.robot_files:
+                return self.robot_files[robot_url]
+
+            fetching.add(robot_url)
             try:
-                robotstxt = self.parent.open(robot_url)
+                # robots.txt files are read whatever the crawler's limits
+                # on responses, as they limit what the crawler may fetch
+                request = urllib2.Request(robot_url)
+                request.content_types = None
+                request.max_body_size = self.max_size
+                request.truncate_body = True
+                robotstxt = self.parent.open(request)
                 try:
+                    lines = robotstxt.read(self.max_size).splitlines(True)
                     robot_file = RobotFileParser()
-                    robot_file.parse(robotstxt.readlines())
+                    robot_file.parse(lines)
+                    self.sitemap_urls[robot_url] = parse_sitemap_urls(lines)
                 finally:
                     robotstxt.close()
-            except (urllib2.HTTPError, urllib2.URLError):
+            except (urllib2.HTTPError, urllib2.URLError, EurekaException):
                 robot_file = None
+            finally:
+                fetching.discard(robot_url)
             self.robot_files[robot_url] = robot_file
         return robot_file
 
+    def sitemaps(self, url):
+        '''
+        Returns the sitemap urls listed in the robots.txt file of ``url``'s
+        site. Downloads the robots.txt file, as needed.
+
+        '''
+
+        if self.canonicalizer:
+            url = self.canonicalizer(url)
+        robot_url = RobotsTxt.make_robot_url(url)
+        self.get_robot(robot_url)
+        return self.sitemap_urls.get(robot_url, [])
+
     def can_fetch(self, url, user_agent=None):
         '''
         Determines whether a given url may be fetched using the given
@@ -67,6 +140,8 @@ class RobotsTxt(urllib2.BaseHandler):
 
         if not user_agent:
             user_agent = '*'
+        if self.canonicalizer:
+            url = self.canonicalizer(url)
         robot_url = RobotsTxt.make_robot_url(url)
         robot = self.get_robot(robot_url)
 
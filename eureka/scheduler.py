@@ -0,0 +1,494 @@
+'''
+Retrying failed fetches without blocking the whole crawl.
+
+``Crawler.fetch`` retries failed requests in place, sleeping between tries,
+which is fine for a single page. A ``RetryScheduler`` in stead puts a failed
+request back into its queue with a not-before time, and works on other urls
+in the meantime:
+
+    scheduler = RetryScheduler(crawler, method='fetch_html')
+    for url in urls:
+        scheduler.add(url)
+    for url, html, error in scheduler:
+        ...
+
+'''
+
+import heapq
+import httplib
+import logging
+import socket
+import threading
+import urllib2
+import urlparse
+from collections import deque
+from itertools import count
+from random import random
+from time import time, sleep
+
+from eureka import EurekaException
+
+__all__ = ('RetryPolicy', 'CircuitBreaker', 'CircuitOpen', 'RetryScheduler',
+           'parse_retry_after')
+
+class CircuitOpen(EurekaException):
+    ''' raised when a host is skipped because it failed too often '''
+
+    def __init__(self, host, until):
+        super(CircuitOpen, self).__init__(
+            u'Too many failures for %s; not retrying for %.0f seconds'
+            % (host, max(until - time(), 0)))
+        self.host = host
+        self.until = until
+
+def parse_retry_after(value):
+    '''
+    Parses the value of a Retry-After header, which is either a number of
+    seconds or an http date, and returns the number of seconds to wait (at
+    least 0), or None if ``value`` is missing or invalid.
+
+    '''
+
+    from email.utils import parsedate_tz, mktime_tz
+
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    try:
+        return max(mktime_tz(date) - time(), 0)
+    except (OverflowError, ValueError):
+        return None
+
+def retry_after(error):
+    '''
+    returns the number of seconds the Retry-After header of the http error
+    ``error`` asks us to wait, or None
+
+    '''
+
+    headers = getattr(error, 'hdrs', None)
+    if headers is None:
+        return None
+    return parse_retry_after(headers.get('retry-after'))
+
+class RetryPolicy(object):
+    '''
+    Decides which errors are retried, how often, and how long to wait in
+    between. The n-th retry waits a random time between 0 and
+    ``backoff * 2**min(n, max_exponent)`` seconds, or longer if the server
+    asked for that with a Retry-After header (up to ``max_retry_after``
+    seconds).
+
+    If ``deadline`` is set, a request is given up once that many seconds have
+    passed since its first try, or if the next retry would start after that.
+
+    '''
+
+    def __init__(self, retries=0, backoff=5, max_exponent=8, deadline=None,
+                 max_retry_after=600):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_exponent = max_exponent
+        self.deadline = deadline
+        self.max_retry_after = max_retry_after
+
+    def is_retryable(self, error):
+        ''' returns whether a request that failed with ``error`` is retried '''
+
+        if isinstance(error, urllib2.HTTPError):
+            # 429 is "Too Many Requests"
+            return 500 <= error.code < 600 or error.code == 429
+        elif isinstance(error, urllib2.URLError):
+            return isinstance(error.reason, socket.timeout) or \
+                   getattr(error.reason, 'strerror', None) in \
+                    ('Connection refused',)
+        else:
+            return isinstance(error, (httplib.IncompleteRead,
+                                      httplib.BadStatusLine, socket.error))
+
+    def delay(self, retry, error=None):
+        ''' the number of seconds to wait before the ``retry``-th retry '''
+
+        delay = self.backoff * 2**min(retry, self.max_exponent) * random()
+        wait = retry_after(error)
+        if wait is not None:
+            delay = max(delay, min(wait, self.max_retry_after))
+        return delay
+
+    def deadline_for(self, start, deadline=None):
+        '''
+        Returns the absolute time at which a request started at ``start``
+        must be given up, or None. ``deadline`` overrides the policy's
+        deadline.
+
+        '''
+
+        if deadline is None:
+            deadline = self.deadline
+        if deadline is None:
+            return None
+        return start + deadline
+
+class CircuitBreaker(object):
+    '''
+    Stops sending requests to a host after ``failures`` consecutive failed
+    requests. After ``reset_after`` seconds, one request is let through; if it
+    succeeds, the host is used normally again.
+
+    '''
+
+    def __init__(self, failures=5, reset_after=60):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._failures = {}
+        self._open_until = {}
+        # crawler threads share the breaker
+        self._lock = threading.Lock()
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def open_until(self, host):
+        '''
+        Returns the time until which requests to ``host`` are blocked, or
+        None if requests to the host are allowed.
+
+        '''
+
+        if host not in self._open_until:
+            return None
+        with self._lock:
+            until = self._open_until.get(host)
+            if until is None:
+                return None
+            if time() >= until:
+                # half-open: let one request through; another failure
+                # re-opens
+                self._open_until.pop(host, None)
+                self._failures[host] = self.failures - 1
+                return None
+            return until
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+
+    def failure(self, host):
+        ''' records a failure; returns True if this opened the circuit '''
+
+        with self._lock:
+            failures = self._failures[host] = self._failures.get(host, 0) + 1
+            if failures >= self.failures:
+                self._open_until[host] = time() + self.reset_after
+                self._failures[host] = 0
+                return True
+            return False
+
+    def check(self, host):
+        ''' raises ``CircuitOpen`` if requests to ``host`` are blocked '''
+
+        until = self.open_until(host)
+        if until is not None:
+            raise CircuitOpen(host, until)
+
+class _Job(object):
+    __slots__ = ('url', 'kwargs', 'host', 'retry', 'retries', 'deadline',
+                 'error')
+
+    def __init__(self, url, kwargs, host, retries, deadline):
+        self.url = url
+        self.kwargs = kwargs
+        self.host = host
+        self.retry = 0
+        self.retries = retries
+        self.deadline = deadline
+        self.error = None
+
+class RetryScheduler(object):
+    '''
+    Fetches urls with ``crawler``, and re-queues failed requests in stead of
+    sleeping. Iterating over the scheduler yields (url, result, error) tuples
+    in the order in which requests finish; either ``result`` or ``error`` is
+    None. ``method`` is the name of the crawler method that fetches a url,
+    such as "fetch" or "fetch_html".
+
+    The scheduler uses the crawler's retry policy unless another ``policy``
+    is given. Requests to hosts blocked by the crawler's circuit breaker are
+    postponed until the breaker lets requests through again.
+
+    With ``workers`` greater than 1, that many requests run at once, on a
+    thread pool (so the crawler should be created with ``threadsafe=True``).
+    If the crawler has a ``eureka.throttle.HostThrottle``, requests are only
+    started for hosts that have a free slot, so that the workers aren't
+    blocked by busy hosts while other hosts' urls are waiting.
+
+    Urls from ``add_lazily`` are queued ``batch_size`` at a time, as the
+    scheduler runs out of urls to fetch.
+
+    '''
+
+    batch_size = 1000
+
+    def __init__(self, crawler, method='fetch', policy=None, workers=1):
+        self.crawler = crawler
+        self.method = method
+        self.policy = policy or crawler.retry_policy
+        self.breaker = crawler.circuit_breaker
+        self.metrics = crawler.metrics
+        self.resolver = getattr(crawler, 'resolver', None)
+        self.throttle = getattr(crawler, 'throttle', None)
+        self.workers = workers
+        self._queue = []
+        self._counter = count()
+        self._feeds = deque()
+
+    def __len__(self):
+        ''' returns the number of queued urls, not counting lazy ones '''
+
+        return len(self._queue)
+
+    def add(self, url, not_before=0, deadline=None, **kwargs):
+        '''
+        Queues ``url``. ``kwargs`` are passed on to the crawler method,
+        except ``retries``, which overrides the number of times the scheduler
+        retries the url (the crawler method itself never retries).
+        ``deadline`` is the total number of seconds the request may take,
+        including all retries.
+
+        '''
+
+        host = urlparse.urlsplit(url)[1].lower()
+        retries = kwargs.pop('retries', None)
+        if retries is None:
+            retries = self.policy.retries
+        job = _Job(url, kwargs, host, retries,
+                   self.policy.deadline_for(time(), deadline))
+        self._push(job, not_before)
+        if self.resolver is not None:
+            # look up the host while we work on the urls before it
+            self.resolver.prefetch((host,), self.metrics)
+
+    def add_lazily(self, items):
+        '''
+        Queues the urls of the iterable ``items`` of (url, kwargs) tuples,
+        like ``add(url, **kwargs)``, but only takes them from ``items`` when
+        the scheduler needs more work, so that it doesn't hold all of them
+        at once.
+
+        '''
+
+        self._feeds.append(iter(items))
+
+    def _refill(self):
+        '''
+        Queues the next ``batch_size`` lazy urls if fewer than that are
+        queued, or if none of the queued ones is due yet.
+
+        '''
+
+        queue = self._queue
+        if not self._feeds or (len(queue) >= self.batch_size and
+                               queue[0][0] <= time()):
+            return
+        added = 0
+        while self._feeds and added < self.batch_size:
+            try:
+                url, kwargs = self._feeds[0].next()
+            except StopIteration:
+                self._feeds.popleft()
+                continue
+            self.add(url, **kwargs)
+            added += 1
+
+    def _push(self, job, not_before):
+        heapq.heappush(self._queue, (not_before, self._counter.next(), job))
+
+    def __iter__(self):
+        return self.run()
+
+    def run(self):
+        ''' works through the queue; see the class documentation '''
+
+        if self.workers > 1:
+            return self._run_parallel()
+        return self._run()
+
+    def _run(self):
+        fetch = getattr(self.crawler, self.method)
+        while True:
+            self._refill()
+            if not self._queue:
+                break
+            not_before, _, job = heapq.heappop(self._queue)
+            wait = not_before - time()
+            if wait > 0:
+                # nothing else is ready, so we might as well sleep
+                sleep(wait)
+
+            result, error = self._check_circuit(job) or _call(fetch, job)
+            finished = self._finished(job, result, error)
+            if finished is not None:
+                yield finished
+
+    def _run_parallel(self):
+        from multiprocessing.pool import ThreadPool
+        from Queue import Queue, Empty
+
+        fetch = getattr(self.crawler, self.method)
+        pool = ThreadPool(self.workers)
+        done = Queue()
+        running = 0
+        try:
+            while True:
+                self._refill()
+                if not self._queue and not running:
+                    break
+                wait = None
+                while running < self.workers:
+                    job, wait = self._next_job()
+                    if job is None:
+                        break
+                    blocked = self._check_circuit(job)
+                    if blocked is not None:
+                        finished = self._finished(job, *blocked)
+                        if finished is not None:
+                            yield finished
+                        continue
+                    running += 1
+                    pool.apply_async(_call, (fetch, job),
+                            callback=lambda result, job=job:
+                                         done.put((job, result)))
+
+                try:
+                    job, (result, error) = done.get(timeout=wait)
+                except Empty:
+                    continue
+                running -= 1
+                finished = self._finished(job, result, error)
+                if finished is not None:
+                    yield finished
+        finally:
+            pool.terminate()
+
+    # the number of due jobs _next_job looks at before it gives up
+    _max_scan = 1000
+
+    def _next_job(self):
+        '''
+        Removes and returns the first queued job that is due and whose host
+        the throttle lets us send a request to. If there is none, returns
+        None and the number of seconds after which to look again (or None
+        to wait for a running request).
+
+        '''
+
+        now = time()
+        throttle = self.throttle
+        skipped = []
+        waits = {}
+        job = wait = None
+        try:
+            while self._queue and len(skipped) < self._max_scan:
+                if self._queue[0][0] > now:
+                    wait = self._queue[0][0] - now
+                    break
+                entry = heapq.heappop(self._queue)
+                host = entry[2].host
+                if throttle is not None:
+                    if host not in waits:
+                        waits[host] = throttle.wait_time(host)
+                    if waits[host]:
+                        skipped.append(entry)
+                        continue
+                job = entry[2]
+                break
+        finally:
+            for entry in skipped:
+                heapq.heappush(self._queue, entry)
+
+        if job is None and waits:
+            # a busy host may get a free slot without a request finishing,
+            # eg. when its Retry-After pause is over
+            throttle_wait = min(waits.values())
+            wait = throttle_wait if wait is None else min(wait, throttle_wait)
+        return job, wait
+
+    def _check_circuit(self, job):
+        '''
+        returns (None, CircuitOpen error) if the circuit breaker blocks the
+        host of ``job``, or else None
+
+        '''
+
+        if not self.breaker:
+            return None
+        until = self.breaker.open_until(job.host)
+        if until is None:
+            return None
+        self.metrics.count('circuit_open', 1, job.host)
+        return None, CircuitOpen(job.host, until)
+
+    def _finished(self, job, result, error):
+        '''
+        Handles the ``result`` or ``error`` of running ``job``: re-queues
+        the job if it should be retried, and otherwise returns the (url,
+        result, error) tuple to yield.
+
+        '''
+
+        if error is None:
+            return job.url, result, None
+
+        if isinstance(error, CircuitOpen):
+            if job.deadline is not None and error.until > job.deadline:
+                return job.url, None, job.error or error
+            self._push(job, error.until)
+            return None
+
+        retry_at = self._retry_time(job, error)
+        if retry_at is None:
+            self.metrics.count('retry_giveups', 1, job.host)
+            # if many errors happen, report the first one
+            return job.url, None, job.error or error
+        job.error = job.error or error
+        job.retry += 1
+        self.metrics.count('retries_scheduled', 1, job.host)
+        logging.warning('retrying %s in %.1fs (try %s): %r',
+                        job.url, retry_at - time(), job.retry, error)
+        self._push(job, retry_at)
+        return None
+
+    def _retry_time(self, job, error):
+        '''
+        returns the time at which ``job`` should be retried after failing
+        with ``error``, or None if it should be given up
+
+        '''
+
+        policy = self.policy
+        if job.retry >= job.retries or not policy.is_retryable(error):
+            return None
+        retry_at = time() + policy.delay(job.retry, error)
+        if job.deadline is not None and retry_at > job.deadline:
+            return None
+        return retry_at
+
+def _call(fetch, job):
+    ''' fetches the url of ``job``, and returns a (result, error) tuple '''
+
+    kwargs = job.kwargs
+    if job.deadline is not None:
+        # so that the request itself doesn't outlast the job's deadline
+        kwargs = dict(kwargs, deadline=max(job.deadline - time(), 0))
+    try:
+        return fetch(job.url, retries=0, **kwargs), None
+    except Exception, e:
+        return None, e
@@ -0,0 +1,301 @@
+'''
+Finding the pages of a site through its sitemaps, in stead of by following
+links. Sitemaps are found through the "Sitemap:" lines of the site's
+robots.txt file (or at /sitemap.xml), and are parsed incrementally, so that
+even very large (and gzipped) sitemaps and sitemap indexes are parsed in
+constant memory.
+
+For incremental re-crawls, only the urls that aren't in the crawler's cache
+yet, or whose sitemap "lastmod" date is later than the date at which they
+were cached, are fetched:
+
+    sitemaps = Sitemaps(crawler)
+    for url, html, error in sitemaps.crawl(['http://example.com/']):
+        ...
+
+'''
+
+import calendar
+import httplib
+import logging
+import re
+import socket
+import urllib2
+import urlparse
+import zlib
+from collections import deque
+from time import gmtime, strftime
+
+from eureka import EurekaException
+from eureka.robotstxt import RobotDisallow
+
+__all__ = ('SitemapEntry', 'Sitemaps', 'parse_sitemap', 'parse_w3c_datetime')
+
+# errors that make us skip a robots.txt file or sitemap
+_fetch_errors = (urllib2.URLError, httplib.HTTPException, socket.error,
+                 EurekaException, RobotDisallow)
+
+class SitemapEntry(object):
+    '''
+    A <url> or <sitemap> element of a sitemap. ``lastmod`` is in seconds
+    since the epoch, or None. ``is_sitemap`` is True for the entries of a
+    sitemap index, which refer to other sitemaps.
+
+    '''
+
+    __slots__ = ('loc', 'lastmod', 'changefreq', 'priority', 'is_sitemap')
+
+    def __init__(self, loc, lastmod=None, changefreq=None, priority=None,
+                 is_sitemap=False):
+        self.loc = loc
+        self.lastmod = lastmod
+        self.changefreq = changefreq
+        self.priority = priority
+        self.is_sitemap = is_sitemap
+
+    def __repr__(self):
+        return '<SitemapEntry %s lastmod=%s>' % (self.loc, self.lastmod)
+
+_w3c_datetime = re.compile(r'''
+    ^(\d{4})(?:-(\d\d)(?:-(\d\d)
+    (?:[T\s](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?
+    \s*(Z|[+-]\d\d:?\d\d)?)?)?)?$
+''', re.VERBOSE | re.IGNORECASE)
+
+def parse_w3c_datetime(text):
+    '''
+    Parses the W3C datetime format used by sitemaps (eg. "2012-01-31" or
+    "2012-01-31T18:30:00+01:00"), and returns it in seconds since the epoch.
+    Returns None if ``text`` isn't in that format.
+
+    '''
+
+    match = _w3c_datetime.match((text or '').strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, zone = match.groups()
+    try:
+        timestamp = calendar.timegm((int(year), int(month or 1),
+                int(day or 1), int(hour or 0), int(minute or 0),
+                int(second or 0), 0, 0, 0))
+    except ValueError:
+        return None
+    if zone and zone.upper() != 'Z':
+        sign = zone[0] == '-' and -1 or 1
+        zone = zone[1:].replace(':', '')
+        timestamp -= sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+    return timestamp
+
+class _Prefixed(object):
+    ''' a file-like object that returns ``data``, then reads from ``fp`` '''
+
+    def __init__(self, data, fp):
+        self.data = data
+        self.fp = fp
+
+    def read(self, size=-1):
+        data, self.data = self.data, ''
+        if size is None or size < 0:
+            return data + self.fp.read()
+        if len(data) >= size:
+            data, self.data = data[:size], data[size:]
+            return data
+        return data + self.fp.read(size - len(data))
+
+    def close(self):
+        self.fp.close()
+
+def _uncompressed(fp):
+    ''' wraps ``fp`` in a decompressing reader if it is gzipped '''
+
+    from eureka.compression import _DecodingReader
+
+    magic = fp.read(2)
+    fp = _Prefixed(magic, fp)
+    if magic == '\x1f\x8b':
+        fp = _DecodingReader(fp, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    return fp
+
+def _local_name(tag):
+    if not isinstance(tag, basestring):
+        return None # a comment or processing instruction
+    return tag.rsplit('}', 1)[-1]
+
+def parse_sitemap(fp):
+    '''
+    Parses the sitemap or sitemap index in the file-like object ``fp``
+    (which may be gzipped), and yields a ``SitemapEntry`` for each url or
+    sitemap in it. Elements are discarded as soon as they are parsed, so
+    this works in constant memory.
+
+    '''
+
+    from lxml import etree
+
+    root = None
+    for event, element in etree.iterparse(_uncompressed(fp),
+                                          events=('start', 'end')):
+        if root is None:
+            root = element
+        if event != 'end':
+            continue
+
+        name = _local_name(element.tag)
+        if name not in ('url', 'sitemap'):
+            continue
+
+        values = {}
+        for child in element:
+            child_name = _local_name(child.tag)
+            if child_name in ('loc', 'lastmod', 'changefreq', 'priority'):
+                values[child_name] = (child.text or '').strip()
+        # we're done with everything parsed so far
+        root.clear()
+
+        if not values.get('loc'):
+            continue
+        try:
+            priority = float(values['priority'])
+        except (KeyError, ValueError):
+            priority = None
+        yield SitemapEntry(values['loc'],
+                           parse_w3c_datetime(values.get('lastmod')),
+                           values.get('changefreq') or None, priority,
+                           name == 'sitemap')
+
+class Sitemaps(object):
+    '''
+    Finds the urls of sites through their sitemaps, using ``crawler`` to
+    download the robots.txt files and sitemaps.
+
+    Sitemaps are cached with a cache-control of "sitemap <today's date>", so
+    that they are downloaded again once a day; another ``cache_control`` can
+    be given. Pages whose lastmod date is later than the date at which they
+    were cached are downloaded with a cache-control of "lastmod <lastmod>",
+    so that we get a new copy in stead of the cached one.
+
+    Pages that are already cached, but don't have a lastmod date, are
+    considered unchanged, unless ``include_undated`` is True. At most
+    ``max_sitemaps`` sitemaps are read per crawl.
+
+    '''
+
+    def __init__(self, crawler, cache_control=None, include_undated=False,
+                 max_sitemaps=10000):
+        self.crawler = crawler
+        if cache_control is None:
+            cache_control = strftime('sitemap %Y-%m-%d', gmtime())
+        self.cache_control = cache_control
+        self.include_undated = include_undated
+        self.max_sitemaps = max_sitemaps
+
+    def discover(self, site_url):
+        '''
+        Returns the sitemap urls of the site of ``site_url``: those listed in
+        its robots.txt file, or else its /sitemap.xml.
+
+        '''
+
+        from eureka.robotstxt import RobotsTxt, parse_sitemap_urls
+
+        robots = self.crawler.robots
+        if robots is not None:
+            urls = robots.sitemaps(site_url)
+        else:
+            try:
+                with self.crawler.fetch(RobotsTxt.make_robot_url(site_url),
+                                        referer=False) as fp:
+                    urls = parse_sitemap_urls(fp.readlines())
+            except _fetch_errors:
+                urls = []
+
+        if not urls:
+            scheme, host = urlparse.urlsplit(site_url)[:2]
+            urls = ['%s://%s/sitemap.xml' % (scheme, host)]
+        return urls
+
+    def entries(self, sitemap_urls):
+        '''
+        Yields the ``SitemapEntry`` of every page in the sitemaps at
+        ``sitemap_urls``, following sitemap indexes. Sitemaps that can't be
+        downloaded or parsed are skipped with a warning.
+
+        '''
+
+        from lxml import etree
+
+        metrics = self.crawler.metrics
+        queue = deque(sitemap_urls)
+        seen = set(queue)
+        while queue:
+            sitemap_url = queue.popleft()
+            host = urlparse.urlsplit(sitemap_url)[1].lower()
+            try:
+                with self.crawler.fetch(sitemap_url, referer=False,
+                        cache_control=self.cache_control) as fp:
+                    for entry in parse_sitemap(fp):
+                        if not entry.is_sitemap:
+                            metrics.count('sitemap_urls', 1, host)
+                            yield entry
+                        elif entry.loc not in seen and \
+                                len(seen) < self.max_sitemaps:
+                            seen.add(entry.loc)
+                            queue.append(entry.loc)
+            except _fetch_errors + (etree.XMLSyntaxError, zlib.error), e:
+                metrics.count('sitemap_errors', 1, host)
+                logging.warning('skipping sitemap %s: %r', sitemap_url, e)
+
+    def changed(self, entries):
+        '''
+        Filters ``entries`` down to the pages that are new or changed, and
+        yields (url, cache_control) tuples for them. Every url is yielded at
+        most once.
+
+        '''
+
+        from eureka.url import URLSet
+
+        cache = self.crawler.cache
+        seen = URLSet(canonicalizer=self.crawler.canonicalizer)
+        for entry in entries:
+            if entry.loc in seen:
+                continue
+            last_fetched = cache and cache.last_fetched(entry.loc)
+            if last_fetched is None:
+                cache_control = None
+            elif entry.lastmod is not None and entry.lastmod > last_fetched:
+                cache_control = 'lastmod %d' % entry.lastmod
+            elif entry.lastmod is None and self.include_undated:
+                cache_control = self.cache_control
+            else:
+                # unchanged; a later entry for the same url might not be
+                continue
+            seen.add(entry.loc)
+            yield entry.loc, cache_control
+
+    def crawl(self, site_urls=(), sitemap_urls=None, method='fetch_html',
+              scheduler=None, **kwargs):
+        '''
+        Fetches the new and changed pages of the sites ``site_urls`` (or of
+        the sitemaps ``sitemap_urls``) with the crawler method ``method``,
+        and returns an iterator over (url, result, error) tuples, like
+        ``Crawler.fetch_many``. The urls are added to ``scheduler`` (an
+        ``eureka.scheduler.RetryScheduler``), if given, as it gets to them,
+        so the sitemaps are read while the pages are fetched. ``kwargs`` are
+        passed on to the crawler method.
+
+        '''
+
+        from eureka.scheduler import RetryScheduler
+
+        if sitemap_urls is None:
+            sitemap_urls = []
+            for site_url in site_urls:
+                sitemap_urls.extend(self.discover(site_url))
+        if scheduler is None:
+            scheduler = RetryScheduler(self.crawler, method)
+
+        changed = self.changed(self.entries(sitemap_urls))
+        scheduler.add_lazily((url, dict(kwargs, cache_control=cache_control))
+                             for url, cache_control in changed)
+        return iter(scheduler)
@@ -0,0 +1,232 @@
+'''
+Adaptive per-host concurrency. In stead of a fixed delay between requests, a
+``HostThrottle`` limits the number of concurrent requests to each host, and
+adapts the limit to how the host copes (additive increase, multiplicative
+decrease, like TCP's congestion control):
+
+ - every successful request raises the host's limit a little, so that the
+   limit grows by about one per round of requests
+ - 429 and 503 responses, failed requests and rising response times cut the
+   limit in half
+ - a Retry-After header pauses all requests to the host until then
+
+    crawler = Crawler(throttle=HostThrottle(maximum=8), threadsafe=True)
+    for url, html, error in crawler.fetch_many(urls, 'fetch_html', workers=16):
+        ...
+
+'''
+
+import logging
+import threading
+import urllib2
+from itertools import count
+from time import time
+
+from eureka.metrics import null_metrics, request_host
+from eureka.scheduler import parse_retry_after
+
+__all__ = ('HostThrottle',)
+
+class _HostState(object):
+    __slots__ = ('limit', 'slots', 'not_before', 'latency', 'baseline',
+                 'samples', 'last_decrease')
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.slots = {}         # the start times of running requests, by slot
+        self.not_before = 0
+        self.latency = None     # fast moving average of the response time
+        self.baseline = None    # slow moving average of the response time
+        self.samples = 0
+        self.last_decrease = 0
+
+class HostThrottle(urllib2.BaseHandler):
+    '''
+    Limits the number of concurrent requests per host; see the module docs.
+    Every host starts with a limit of ``initial`` concurrent requests, which
+    stays between ``minimum`` and ``maximum``. The limit is multiplied by
+    ``decrease`` when the host is overloaded, which includes when the
+    average response time rises above ``latency_factor`` times its long-term
+    average. Retry-After pauses are limited to ``max_pause`` seconds.
+
+    Requests are counted from the time they pass the cache (cached pages
+    don't count) until their response headers arrive; ``release(request)``
+    must be called for requests that fail, which the crawler's opener does.
+    Should that not happen, a request's slot is given back anyway after
+    ``slot_timeout`` seconds.
+
+    '''
+
+    # after the cache and the delay, so that only network requests count
+    handler_order = 302
+
+    metrics = null_metrics
+
+    def __init__(self, initial=2, minimum=1, maximum=16, decrease=0.5,
+                 latency_factor=2.0, max_pause=600, slot_timeout=300):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_pause = max_pause
+        self.slot_timeout = slot_timeout
+        self._hosts = {}
+        self._slot_ids = count()
+        self._condition = threading.Condition()
+        self.end_handler = _HostThrottleEnd(self)
+
+        from eureka import forking
+        forking.register(self)
+
+    def after_fork(self):
+        # requests that were running in the parent aren't running here
+        self._condition = threading.Condition()
+        for state in self._hosts.values():
+            state.slots.clear()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(self.initial)
+        return state
+
+    def limit(self, host):
+        ''' the current concurrency limit for ``host`` '''
+
+        with self._condition:
+            return int(self._state(host).limit)
+
+    def wait_time(self, host):
+        '''
+        Returns 0 if a request to ``host`` can start now, or else the
+        number of seconds until we expect it can.
+
+        '''
+
+        with self._condition:
+            state = self._state(host)
+            now = time()
+            if state.not_before > now:
+                return state.not_before - now
+            if len(state.slots) >= int(state.limit):
+                # we can't know when a running request finishes
+                return min(state.latency or 0.1, 1.0)
+            return 0
+
+    def acquire(self, host):
+        '''
+        waits until a request to ``host`` may start, counts it, and returns
+        its slot, which is passed to ``release``
+
+        '''
+
+        with self._condition:
+            state = self._state(host)
+            start = time()
+            while True:
+                now = time()
+                if state.not_before > now:
+                    self._condition.wait(state.not_before - now)
+                elif len(state.slots) >= int(state.limit):
+                    # wait until a slot is released, or the oldest expires
+                    expires = min(state.slots.itervalues()) + self.slot_timeout
+                    if expires > now:
+                        self._condition.wait(expires - now)
+                    else:
+                        self._expire(host, state, now)
+                else:
+                    break
+            slot = next(self._slot_ids)
+            state.slots[slot] = now
+        if now - start > 0.001:
+            self.metrics.timing('throttle_wait', now - start, host)
+        return slot
+
+    def _expire(self, host, state, now):
+        ''' gives back the slots of requests that were never released '''
+
+        for slot, started in state.slots.items():
+            if now - started >= self.slot_timeout:
+                del state.slots[slot]
+                self.metrics.count('throttle_expired_slots', 1, host)
+                logging.warning('a request to %s held its throttle slot '
+                                'for %ss; releasing it', host, now - started)
+
+    def release(self, request, code=None, headers=None):
+        '''
+        Counts ``request`` as finished, with the response ``code`` and
+        ``headers``. If ``code`` is None, the request failed. Calling this
+        again for the same request does nothing.
+
+        '''
+
+        host = getattr(request, 'throttle_host', None)
+        if host is None:
+            return
+        request.throttle_host = None
+        latency = time() - request.throttle_start
+
+        with self._condition:
+            state = self._state(host)
+            state.slots.pop(request.throttle_slot, None)
+            if code is None or code in (429, 503):
+                self._decrease(host, state)
+                pause = parse_retry_after(headers and
+                                          headers.get('retry-after'))
+                if pause is not None:
+                    pause = min(pause, self.max_pause)
+                    state.not_before = max(state.not_before, time() + pause)
+                    self.metrics.count('throttle_pauses', 1, host)
+            elif code < 500:
+                self._record_latency(host, state, latency)
+            self._condition.notify_all()
+
+    def _record_latency(self, host, state, latency):
+        if state.baseline is None:
+            state.latency = state.baseline = latency
+        else:
+            state.latency = 0.7 * state.latency + 0.3 * latency
+            state.baseline = 0.95 * state.baseline + 0.05 * latency
+        state.samples += 1
+
+        if state.samples >= 5 and \
+           state.latency > self.latency_factor * state.baseline:
+            self._decrease(host, state)
+        else:
+            # additive increase: about one more per round of requests
+            state.limit = min(self.maximum,
+                              state.limit + 1.0 / max(state.limit, 1))
+
+    def _decrease(self, host, state):
+        now = time()
+        # responses to requests that were started before the last decrease
+        # don't tell us anything new
+        if now - state.last_decrease < (state.latency or 1.0):
+            return
+        state.last_decrease = now
+        state.limit = max(self.minimum, state.limit * self.decrease)
+        self.metrics.count('throttle_decreases', 1, host)
+
+    def http_open(self, request):
+        host = request_host(request)
+        request.throttle_slot = self.acquire(host)
+        request.throttle_host = host
+        request.throttle_start = time()
+
+    https_open = http_open
+
+class _HostThrottleEnd(urllib2.BaseHandler):
+    ''' releases a request's ``HostThrottle`` slot when its headers arrive '''
+
+    # as soon as the response arrives, before its body is read
+    handler_order = 240
+
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def http_response(self, request, response):
+        self.throttle.release(request, response.code, response.info())
+        return response
+
+    https_response = http_response
@@ -0,0 +1,264 @@
+'''
+Canonicalization of urls. Two urls that only differ in the order of their
+query parameters, a default port, a fragment, the case of percent-escapes or
+a session-id parameter refer to the same page; canonicalizing them lets the
+cache, the robots.txt handler and crawl code treat them as the same url.
+
+'''
+
+import re
+import urlparse
+
+__all__ = ('URLCanonicalizer', 'URLSet', 'canonicalize_url',
+           'default_canonicalizer')
+
+default_ports = {'http': '80', 'https': '443', 'ftp': '21'}
+
+# parameters that only carry a session id, and never change the page content
+default_ignored_parameters = ('jsessionid', 'phpsessid', 'aspsessionid',
+                              'sessionid', 'cfid', 'cftoken')
+
+_unreserved = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                        '0123456789-._~')
+_escape_re = re.compile(r'%([0-9a-fA-F]{2})')
+
+def _normalize_escape(match):
+    char = chr(int(match.group(1), 16))
+    if char in _unreserved:
+        return char
+    else:
+        return '%' + match.group(1).upper()
+
+def normalize_escapes(string):
+    '''
+    Upper-cases all percent-escapes in ``string``, and decodes escaped
+    characters that never need to be escaped (letters, digits and "-._~")
+
+    '''
+
+    if '%' not in string:
+        return string
+    return _escape_re.sub(_normalize_escape, string)
+
+def remove_dot_segments(path):
+    ''' resolves "." and ".." segments in a url path, as in RFC 3986 '''
+
+    if '.' not in path:
+        return path
+
+    output = []
+    segments = path.split('/')
+    for segment in segments:
+        if segment == '.':
+            continue
+        elif segment == '..':
+            if len(output) > 1:
+                output.pop()
+        else:
+            output.append(segment)
+
+    # keep the trailing slash of "/a/b/." and "/a/b/.."
+    if segments[-1] in ('.', '..'):
+        output.append('')
+    return '/'.join(output)
+
+def hostname(netloc):
+    '''
+    Returns the lower-case host name of ``netloc`` ("host", "host:port" or
+    "user@host:port"), without the brackets of an ipv6 address like "[::1]".
+
+    '''
+
+    host = netloc.rpartition('@')[2].lower()
+    if host.startswith('['):
+        return host[1:].partition(']')[0]
+    if host.count(':') == 1:
+        return host.partition(':')[0]
+    # a host name, or an ipv6 address without brackets
+    return host
+
+def parameter_matcher(names):
+    '''
+    Returns a function that checks whether a parameter name is contained in
+    ``names``. Names are compared ignoring case, and a name ending in "*"
+    matches all parameters starting with that prefix.
+
+    '''
+
+    exact = set()
+    prefixes = []
+    for name in names:
+        name = name.lower()
+        if name.endswith('*'):
+            prefixes.append(name[:-1])
+        else:
+            exact.add(name)
+    prefixes = tuple(prefixes)
+
+    def matches(name):
+        name = name.lower()
+        return name in exact or bool(prefixes) and name.startswith(prefixes)
+    return matches
+
+class URLCanonicalizer(object):
+    '''
+    Converts urls into a canonical form. The canonical url:
+
+     - has a lower-case scheme and host, and no default port
+     - has "." and ".." path segments resolved, and the empty path is "/"
+     - has upper-case percent-escapes, and no escaped unreserved characters
+     - has no fragment, unless ``drop_fragment`` is False
+     - has its query parameters sorted, unless ``sort_query`` is False
+     - has none of the ``ignore_parameters``, neither in its query string,
+       nor in its path parameters (as in ";jsessionid=...")
+
+    ``rules`` is a dictionary from host names to additional parameters that
+    should be ignored for that host and all of its subdomains, eg:
+
+        URLCanonicalizer(rules={'example.com': ('ref', 'utm_*')})
+
+    '''
+
+    def __init__(self, ignore_parameters=default_ignored_parameters,
+                 rules=None, sort_query=True, drop_fragment=True):
+        self.ignore_parameters = tuple(ignore_parameters)
+        self.sort_query = sort_query
+        self.drop_fragment = drop_fragment
+        self.rules = {}
+        self._matchers = {}
+        for host, parameters in (rules or {}).iteritems():
+            self.add_rule(host, parameters)
+
+    def add_rule(self, host, ignore_parameters):
+        '''
+        Ignores ``ignore_parameters`` for urls on ``host`` and its subdomains,
+        in addition to parameters ignored by previously added rules.
+
+        '''
+
+        host = host.lower()
+        self.rules[host] = self.rules.get(host, ()) + tuple(ignore_parameters)
+        self._matchers.clear()
+
+    def _matcher(self, host):
+        ''' returns the ignored-parameter matcher for the given host '''
+
+        try:
+            return self._matchers[host]
+        except KeyError:
+            names = list(self.ignore_parameters)
+            for rule_host, parameters in self.rules.iteritems():
+                if host == rule_host or host.endswith('.' + rule_host):
+                    names.extend(parameters)
+            matcher = self._matchers[host] = parameter_matcher(names)
+            return matcher
+
+    def canonicalize_netloc(self, scheme, netloc):
+        ''' lower-cases the host and removes a default port '''
+
+        userinfo, at, hostport = netloc.rpartition('@')
+        hostport = hostport.lower()
+        host, colon, port = hostport.rpartition(':')
+        # careful with ipv6 addresses such as [::1]
+        if colon and ']' not in port and \
+           (port == '' or default_ports.get(scheme) == port):
+            hostport = host
+        return userinfo + at + hostport
+
+    def __call__(self, url):
+        '''
+        Returns the canonical form of ``url``. Urls that can't be parsed are
+        returned unchanged.
+
+        '''
+
+        try:
+            scheme, netloc, path, params, query, fragment = \
+                    urlparse.urlparse(url)
+        except ValueError:
+            return url
+
+        scheme = scheme.lower()
+        netloc = self.canonicalize_netloc(scheme, netloc)
+        is_ignored = self._matcher(hostname(netloc))
+
+        path = remove_dot_segments(normalize_escapes(path))
+        if not path and netloc:
+            path = '/'
+
+        if params:
+            params = ';'.join(param for param in params.split(';')
+                              if not is_ignored(param.split('=', 1)[0]))
+
+        if query:
+            query_list = [normalize_escapes(item) for item in query.split('&')
+                          if item and not is_ignored(item.split('=', 1)[0])]
+            if self.sort_query:
+                query_list.sort()
+            query = '&'.join(query_list)
+
+        if self.drop_fragment:
+            fragment = ''
+        else:
+            fragment = normalize_escapes(fragment)
+
+        return urlparse.urlunparse((scheme, netloc, path, params, query,
+                                    fragment))
+
+class URLSet(object):
+    '''
+    A set of urls, where urls are considered equal if their canonical forms
+    are equal. Useful for not crawling the same page twice:
+
+        seen = URLSet()
+        for link in links:
+            if seen.add(link):
+                crawler.fetch_html(link)
+
+    ``canonicalizer`` defaults to ``default_canonicalizer``; if it is None,
+    urls are compared verbatim.
+
+    '''
+
+    def __init__(self, urls=(), canonicalizer=True):
+        if canonicalizer is True:
+            canonicalizer = default_canonicalizer
+        self.canonicalize = canonicalizer or _verbatim
+        self._urls = set()
+        for url in urls:
+            self.add(url)
+
+    def add(self, url):
+        '''
+        Adds ``url`` to the set. Returns True if the url wasn't in the set
+        before, and False otherwise.
+
+        '''
+
+        url = self.canonicalize(url)
+        if url in self._urls:
+            return False
+        self._urls.add(url)
+        return True
+
+    def discard(self, url):
+        self._urls.discard(self.canonicalize(url))
+
+    def __contains__(self, url):
+        return self.canonicalize(url) in self._urls
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __iter__(self):
+        return iter(self._urls)
+
+def _verbatim(url):
+    return url
+
+default_canonicalizer = URLCanonicalizer()
+
+def canonicalize_url(url):
+    ''' canonicalizes ``url`` using the default canonicalizer '''
+
+    return default_canonicalizer(url)
@@ -0,0 +1,495 @@
+'''
+Moving cached pages between the cache database and WARC files, the standard
+format for web archives (ISO 28500), which other tools can read.
+
+``export_warc`` writes the pages in a cache to a WARC file, and
+``import_warc`` adds the responses in a WARC file to a cache:
+
+    export_warc(cache, 'crawl.warc.gz')
+    import_warc(other_cache, 'crawl.warc.gz')
+
+A ``WARCCache`` serves pages straight from a WARC file, without importing it
+first. It can be used in place of a ``Cache``, but doesn't store anything:
+
+    crawler = Crawler(cache=WARCCache('crawl.warc'))
+
+Every page is written as a "response" record, whose block is the http
+response as it was received. The parts of the cache key that a WARC file
+has no place for are stored in extension fields ("Eureka-Request-Headers",
+"Eureka-Cache-Control" and "Eureka-Postdata"), so that an exported cache can
+be imported without losing anything.
+
+'''
+
+import base64
+import gzip
+import mmap
+import uuid
+import zlib
+from StringIO import StringIO
+from time import gmtime, strftime, strptime
+
+from eureka import EurekaException
+from eureka.cache import Binary, Cache, _make_response, _serialize_headers
+from eureka.metrics import request_host, request_metrics
+from eureka.url import default_canonicalizer
+
+__all__ = ('WARCError', 'WARCRecord', 'WARCCache', 'read_records',
+           'write_record', 'export_warc', 'import_warc')
+
+class WARCError(EurekaException):
+    ''' raised when a WARC file can't be parsed '''
+
+class WARCRecord(object):
+    '''
+    A record of a WARC file. ``headers`` is a dictionary of the WARC header
+    fields with lower-case names, and ``block`` is the record's content.
+
+    '''
+
+    __slots__ = ('headers', 'block')
+
+    def __init__(self, headers, block):
+        self.headers = headers
+        self.block = block
+
+    @property
+    def type(self):
+        return self.headers.get('warc-type')
+
+    def __repr__(self):
+        return '<WARCRecord %s %s>' % (self.type,
+                                       self.headers.get('warc-target-uri'))
+
+def _read_header(fp):
+    '''
+    Reads the version line and header fields of the next record from
+    ``fp``, and returns them as a dictionary, or None at the end of the file.
+
+    '''
+
+    line = fp.readline()
+    while line in ('\r\n', '\n'):
+        # tolerate extra blank lines between records
+        line = fp.readline()
+    if not line:
+        return None
+    if not line.startswith('WARC/'):
+        raise WARCError('Expected a WARC record, got %r' % line[:40])
+
+    headers = {}
+    while True:
+        line = fp.readline()
+        if not line:
+            raise WARCError('Unexpected end of the WARC file')
+        if line in ('\r\n', '\n'):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if not headers.get('content-length', '').isdigit():
+        raise WARCError('WARC record without a valid Content-Length')
+    return headers
+
+def read_records(fp):
+    '''
+    Yields the records in the WARC file ``fp`` (a file name or a file-like
+    object), as ``WARCRecord`` objects. Gzipped files are decompressed.
+
+    '''
+
+    if isinstance(fp, basestring):
+        fp = open(fp, 'rb')
+        if fp.read(2) == '\x1f\x8b':
+            fp.seek(0)
+            # GzipFile reads the concatenated members of a .warc.gz file
+            fp = gzip.GzipFile(fileobj=fp, mode='rb')
+        else:
+            fp.seek(0)
+
+    while True:
+        headers = _read_header(fp)
+        if headers is None:
+            break
+        length = int(headers['content-length'])
+        block = fp.read(length)
+        if len(block) != length:
+            raise WARCError('Unexpected end of the WARC file')
+        yield WARCRecord(headers, block)
+
+def _header_value(value):
+    ''' makes ``value`` safe to use in a WARC header field '''
+
+    return str(value).replace('\r', ' ').replace('\n', ' ')
+
+def write_record(fp, headers, block, compress=False):
+    '''
+    Writes a record with the WARC header fields ``headers`` (a list of (name,
+    value) tuples) and the content ``block`` to ``fp``. The WARC-Record-ID
+    and Content-Length fields are added. If ``compress`` is True, the record
+    is written as a separate gzip member, as usual for .warc.gz files.
+
+    '''
+
+    lines = ['WARC/1.0',
+             'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4()]
+    lines.extend('%s: %s' % (name, _header_value(value))
+                 for name, value in headers)
+    lines.append('Content-Length: %d' % len(block))
+    data = '%s\r\n\r\n%s\r\n\r\n' % ('\r\n'.join(lines), block)
+
+    if compress:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+    fp.write(data)
+
+def _warc_date(date):
+    ''' converts an sqlite datetime to the WARC date format '''
+
+    return strftime('%Y-%m-%dT%H:%M:%SZ', strptime(date, '%Y-%m-%d %H:%M:%S'))
+
+def _sqlite_date(date):
+    ''' converts a WARC date to the sqlite datetime format '''
+
+    try:
+        return strftime('%Y-%m-%d %H:%M:%S',
+                        strptime(date[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return strftime('%Y-%m-%d %H:%M:%S', gmtime())
+
+def export_warc(cache, path, like=None, compress=None):
+    '''
+    Writes the pages in ``cache`` (those whose url matches the SQL LIKE
+    expression ``like``, if it is given) to a new WARC file at ``path``, and
+    returns the number of pages written. The file is gzipped if ``compress``
+    is True, which is the default if ``path`` ends with ".gz".
+
+    '''
+
+    if compress is None:
+        compress = path.endswith('.gz')
+
+    query = '''
+    SELECT
+        date, url, postdata, headers, cache_control, response_url,
+        response_code, response_message, response_data, delta_base
+    FROM cache
+    '''
+    parameters = ()
+    if like:
+        query += ' WHERE url LIKE ?'
+        parameters = (like,)
+    query += ' ORDER BY rowid'
+
+    written = 0
+    cursor = cache.connection.cursor()
+    try:
+        cursor.execute(query, parameters)
+        with open(path, 'wb') as fp:
+            write_record(fp, [('WARC-Type', 'warcinfo'),
+                              ('WARC-Date', strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                     gmtime())),
+                              ('Content-Type', 'application/warc-fields')],
+                         'software: eureka\r\n'
+                         'format: WARC File Format 1.0\r\n', compress)
+            # the cursor fetches rows as we go, so this runs in constant memory
+            for date, url, postdata, headers, cache_control, response_url, \
+                    code, message, data, delta_base in cursor:
+                # older versions of a page may be stored as deltas
+                data = cache._resolve(data, delta_base)
+                fields = [('WARC-Type', 'response'),
+                          ('WARC-Date', _warc_date(date)),
+                          ('WARC-Target-URI', url),
+                          ('Content-Type',
+                           'application/http; msgtype=response'),
+                          ('Eureka-Request-Headers', headers),
+                          ('Eureka-Cache-Control', cache_control)]
+                if response_url != url:
+                    fields.append(('Eureka-Response-URI', response_url))
+                if postdata is not None:
+                    fields.append(('Eureka-Postdata',
+                                   base64.b64encode(str(postdata))))
+                block = 'HTTP/1.1 %d %s\r\n%s' % (code, message, data)
+                write_record(fp, fields, block, compress)
+                written += 1
+    finally:
+        cursor.close()
+    return written
+
+def _parse_response(record):
+    '''
+    returns the (code, message, headers and data) of the http response in a
+    response record, or None if it doesn't contain one
+
+    '''
+
+    status, _, data = record.block.partition('\n')
+    parts = status.strip().split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/') or \
+       not parts[1].isdigit():
+        return None
+    return int(parts[1]), len(parts) > 2 and parts[2] or '', data
+
+def _cache_key(cache, record, headers=None):
+    '''
+    returns the (url, postdata, headers, cache_control) under which ``cache``
+    stores the response in ``record``. Records that weren't written by
+    ``export_warc`` are filed under ``headers``, which should be the headers
+    that the crawler that will look for them sends.
+
+    '''
+
+    import urllib2
+
+    url = record.headers.get('warc-target-uri', '').strip('<>')
+    if cache.canonicalizer:
+        url = cache.canonicalizer(url)
+
+    postdata = record.headers.get('eureka-postdata')
+    if postdata is not None:
+        postdata = base64.b64decode(postdata)
+
+    key_headers = record.headers.get('eureka-request-headers')
+    if key_headers is None:
+        # urllib2 capitalizes header names this way, and adds a Host header
+        host = urllib2.Request(url).get_host()
+        items = [(name.capitalize(), value) for name, value in headers or ()]
+        items.append(('Host', host))
+        if cache.key_policy:
+            key_headers = cache.key_policy(items, host)
+        else:
+            key_headers = _serialize_headers(items)
+
+    return url, postdata, key_headers, \
+           record.headers.get('eureka-cache-control', '')
+
+def import_warc(cache, path, headers=None, batch_size=1000):
+    '''
+    Adds the http responses in the WARC file at ``path`` to ``cache``, and
+    returns the number of responses that were added. Responses that are
+    already cached are skipped. Rows are inserted ``batch_size`` at a time, in
+    a single transaction.
+
+    Records written by other tools don't say which request headers were
+    sent, which are part of the cache key; they are stored as if they were
+    requested with ``headers`` (a list of (name, value) tuples). To find
+    them with a crawler, pass its headers, eg. ``crawler.opener.addheaders``.
+
+    '''
+
+    connection = cache.connection
+    insert = '''
+    INSERT INTO
+        cache
+        (date, url, postdata, headers, cache_control, response_url,
+         response_code, response_message, response_data)
+    VALUES
+        (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+    imported = 0
+    rows = []
+    # the keys in ``rows``; the unique index doesn't catch duplicates of GET
+    # requests, whose postdata is NULL, so we look for them ourselves
+    batch = set()
+    cursor = connection.cursor()
+    try:
+        for record in read_records(path):
+            if record.type != 'response':
+                continue
+            response = _parse_response(record)
+            if response is None:
+                continue
+            key = _cache_key(cache, record, headers)
+            if key in batch or cache._fetch(*key):
+                continue
+            code, message, data = response
+            url, postdata, key_headers, cache_control = key
+            response_url = record.headers.get('eureka-response-uri') or \
+                           record.headers.get('warc-target-uri').strip('<>')
+            if postdata is not None:
+                postdata = Binary(postdata)
+            rows.append((_sqlite_date(record.headers.get('warc-date')),
+                         url, postdata, key_headers, cache_control,
+                         response_url, code, message, Binary(data)))
+            batch.add(key)
+            if len(rows) >= batch_size:
+                cursor.executemany(insert, rows)
+                imported += len(rows)
+                rows = []
+                batch.clear()
+        if rows:
+            cursor.executemany(insert, rows)
+            imported += len(rows)
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return imported
+
+class _MappedReader(object):
+    ''' a read-only file-like object for the bytes start:end of ``data`` '''
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.position = start
+        self.end = end
+
+    def read(self, size=-1):
+        start = self.position
+        if size is None or size < 0:
+            self.position = self.end
+        else:
+            self.position = min(start + size, self.end)
+        return self.data[start:self.position]
+
+    def readline(self, size=-1):
+        start = self.position
+        end = self.data.find('\n', start, self.end)
+        end = self.end if end == -1 else end + 1
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        self.position = end
+        return self.data[start:end]
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.position = self.end
+
+class WARCCache(Cache):
+    '''
+    A read-only cache that serves pages from the WARC file at ``path``. The
+    file is memory-mapped, and indexed by cache key when the cache is
+    created; responses are then read straight from the mapped file. Gzipped
+    WARC files work, but every response has to be decompressed when it is
+    read, and indexing the file means decompressing all of it, so
+    uncompressed files are faster.
+
+    Pages that aren't in the file are downloaded, but not stored.
+    ``canonicalizer`` and ``key_policy`` should be the same as those of the
+    cache the file was exported from. ``headers`` are used to index records
+    written by other tools; see ``import_warc``.
+
+    '''
+
+    def __init__(self, path, canonicalizer=default_canonicalizer,
+                 key_policy=None, headers=None):
+        Cache.__init__(self, database=None, canonicalizer=canonicalizer,
+                       key_policy=key_policy, coalesce=False)
+        self.path = path
+        self.headers = headers
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.compressed = self._data[:2] == '\x1f\x8b'
+        # cache key -> (offset, length, date, response url) of a record
+        self._index = {}
+        # url -> latest date, for last_fetched
+        self._dates = {}
+        self._build_index()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _add(self, headers, offset, length):
+        if headers.get('warc-type') != 'response':
+            return
+        record = WARCRecord(headers, None)
+        key = _cache_key(self, record, self.headers)
+        date = _sqlite_date(headers.get('warc-date'))
+        response_url = headers.get('eureka-response-uri') or \
+                       headers.get('warc-target-uri', '').strip('<>')
+        self._index[key] = (offset, length, date, response_url)
+        if key[1] is None:
+            self._dates[key[0]] = max(self._dates.get(key[0]), date)
+
+    def _build_index(self):
+        data = self._data
+        if not self.compressed:
+            reader = _MappedReader(data, 0, len(data))
+            while True:
+                headers = _read_header(reader)
+                if headers is None:
+                    break
+                length = int(headers['content-length'])
+                # we skip the block without reading it
+                self._add(headers, reader.position, length)
+                reader.position += length
+            return
+
+        # every record is a gzip member; find where each one ends
+        offset = 0
+        end = len(data)
+        while offset < end:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            position = offset
+            text = []
+            while position < end:
+                chunk = data[position:position + (1 << 16)]
+                text.append(decompressor.decompress(chunk))
+                position += len(chunk)
+                if decompressor.unused_data:
+                    position -= len(decompressor.unused_data)
+                    break
+            text.append(decompressor.flush())
+            record = list(read_records(StringIO(''.join(text))))
+            if len(record) == 1:
+                self._add(record[0].headers, offset, position - offset)
+            offset = position
+
+    def _block(self, offset, length):
+        ''' returns a file-like object for the block of a record '''
+
+        if not self.compressed:
+            return _MappedReader(self._data, offset, offset + length)
+        text = zlib.decompress(self._data[offset:offset + length],
+                               16 + zlib.MAX_WBITS)
+        record, = read_records(StringIO(text))
+        return StringIO(record.block)
+
+    def last_fetched(self, url):
+        if self.canonicalizer:
+            url = self.canonicalizer(url)
+        date = self._dates.get(url)
+        if date is None:
+            return None
+        import calendar
+        return calendar.timegm(strptime(date, '%Y-%m-%d %H:%M:%S'))
+
+    def clear(self, like=None):
+        raise EurekaException('A WARCCache is read-only')
+
+    def http_open(self, request):
+        if getattr(request, 'no_cache', False):
+            return None
+
+        key = (self._request_url(request), request.get_data(),
+               self._request_headers(request),
+               getattr(request, 'cache_control', '') or '')
+        host = request_host(request)
+        metrics = request_metrics(request, self.metrics)
+        with metrics.timer('cache_lookup', host):
+            entry = self._index.get(key)
+        if entry is None:
+            metrics.count('cache_misses', 1, host)
+            return None
+
+        offset, length, date, response_url = entry
+        fp = self._block(offset, length)
+        status = fp.readline().strip().split(' ', 2)
+        code, message = int(status[1]), len(status) > 2 and status[2] or ''
+        metrics.count('cache_hits', 1, host)
+        metrics.count('cached_bytes', length, host)
+        return _make_response(response_url, code, message, fp)
+
+    def http_response(self, request, response):
+        # read-only
+        return response
+
+    https_open = http_open
+    https_response = http_response
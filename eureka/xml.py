@@ -14,6 +14,32 @@ class EurekaXPathError(etree.XPathError, EurekaException):
         super(EurekaXPathError, self).__init__(message)
         self.xml = xml
 
+# Compiled XPath expressions, and the XPath translations of CSS selectors, so
+# that we don't compile the same expression for every element. A parent
+# process can fill these before forking, so that the workers share them.
+_max_compiled = 1024
+_compiled_xpaths = {}
+_css_paths = {}
+
+def _compiled_xpath(path, namespaces):
+    key = (path, tuple(sorted(namespaces.iteritems())))
+    compiled = _compiled_xpaths.get(key)
+    if compiled is None:
+        if len(_compiled_xpaths) >= _max_compiled:
+            _compiled_xpaths.clear()
+        compiled = _compiled_xpaths[key] = etree.XPath(path,
+                namespaces=namespaces, smart_strings=False)
+    return compiled
+
+def _css_to_xpath(css):
+    path = _css_paths.get(css)
+    if path is None:
+        from lxml.cssselect import CSSSelector
+        if len(_css_paths) >= _max_compiled:
+            _css_paths.clear()
+        path = _css_paths[css] = CSSSelector(css).path
+    return path
+
 def _input_or_quit():
     '''
     Waits for user input.
@@ -58,8 +84,7 @@ class EurekaElement(etree.ElementBase):
 
         '''
 
-        from lxml.cssselect import CSSSelector
-        return self.xpath(CSSSelector(_path).path)
+        return self.xpath(_css_to_xpath(_path))
 
     def select(self, _path, join_function=None, *args, **kwargs):
         '''
@@ -129,8 +154,12 @@ class EurekaElement(etree.ElementBase):
         namespaces['eureka'] = 'http://schedulizer.com/eureka'
         namespaces['re'] = 'http://exslt.org/regular-expressions'
         try:
-            return etree.ElementBase.xpath(self, _path, namespaces=namespaces,
-                                           smart_strings=False, *args, **kwargs)
+            if args or 'extensions' in kwargs:
+                return etree.ElementBase.xpath(self, _path,
+                        namespaces=namespaces, smart_strings=False,
+                        *args, **kwargs)
+            # the remaining keyword arguments are xpath variables
+            return _compiled_xpath(_path, namespaces)(self, **kwargs)
         except etree.XPathError, e:
             raise EurekaXPathError(self,
                 '\n\n  Error for xpath expression: "%s".\n'
@@ -0,0 +1,4 @@
+import logging
+
+# the tests provoke errors and retries on purpose, which are logged
+logging.disable(logging.WARNING)
@@ -0,0 +1,135 @@
+'''
+Helpers for the tests: a local http server with configurable pages, and
+crawlers and caches that use temporary databases.
+
+'''
+
+import BaseHTTPServer
+import SocketServer
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers))
+        page = server.pages.get(self.path.split('?', 1)[0])
+        if page is None:
+            page = (404, [], 'not found')
+        if callable(page):
+            page = page(self)
+            if page is None:
+                # the page function wrote the response itself
+                return
+        code, headers, body = page
+        self.send_response(code)
+        names = set(name.lower() for name, value in headers)
+        for name, value in headers:
+            self.send_header(name, value)
+        if 'content-type' not in names:
+            self.send_header('Content-Type', 'text/html')
+        if 'content-length' not in names:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        self.body = self.rfile.read(length)
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that give up early are expected
+        pass
+
+class TestServer(object):
+    '''
+    Serves ``pages``, a dictionary from paths to (code, headers, body)
+    tuples, or to functions that are called with the request handler and
+    return such a tuple (or None, if they wrote the response themselves).
+    The paths and headers of all requests are recorded in ``requests``.
+    POST requests are answered like GET requests.
+
+    '''
+
+    def __init__(self, pages=None):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.pages = self.pages = dict(pages or {})
+        self.server.requests = self.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+    def paths(self):
+        return [path for path, headers in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def page(body, code=200, headers=()):
+    return code, list(headers), body
+
+def redirect(location, code=302):
+    return code, [('Location', location)], ''
+
+class TempDirTestCase(unittest.TestCase):
+    ''' a test case with a temporary directory, ``self.tmp`` '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='eureka-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+class ServerTestCase(TempDirTestCase):
+    '''
+    A test case with a ``TestServer`` in ``self.server``, and a
+    ``crawler()`` method that makes crawlers with a temporary cache.
+
+    '''
+
+    pages = {}
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.server = TestServer(self.pages)
+
+    def tearDown(self):
+        self.server.close()
+        TempDirTestCase.tearDown(self)
+
+    def url(self, path='/'):
+        return self.server.url(path)
+
+    def cache(self, **kwargs):
+        from eureka.cache import Cache
+        return Cache(self.path('cache.sqlite'), **kwargs)
+
+    def crawler(self, **kwargs):
+        from eureka.crawler import Crawler
+        if kwargs.get('cache', True) is True:
+            kwargs['cache'] = self.cache()
+        kwargs.setdefault('robotstxt', False)
+        kwargs.setdefault('silent', True)
+        kwargs.setdefault('resolver', False)
+        return Crawler(**kwargs)
@@ -0,0 +1,196 @@
+import gzip
+import threading
+import time
+import unittest
+import urllib
+from StringIO import StringIO
+
+from eureka.cache import HeaderKeyPolicy
+from tests.support import ServerTestCase, page
+
+def gzipped(text):
+    data = StringIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as fp:
+        fp.write(text)
+    return data.getvalue()
+
+def html(version):
+    return '\n'.join(['<html><body>version %d' % version] +
+                     ['<p>row %d</p>' % i for i in xrange(500)] +
+                     ['</body></html>'])
+
+class HistoryTest(ServerTestCase):
+    def serve(self, version, compressed=False):
+        body = html(version)
+        if compressed:
+            self.server.pages['/p'] = page(gzipped(body),
+                    headers=[('Content-Encoding', 'gzip')])
+        else:
+            self.server.pages['/p'] = page(body)
+
+    def fetch(self, crawler, cache_control):
+        with crawler.fetch(self.url('/p'), cache_control=cache_control) as fp:
+            return fp.read()
+
+    def check_history(self, compressed):
+        cache = self.cache()
+        crawler = self.crawler(cache=cache)
+        for version in (1, 2, 3):
+            self.serve(version, compressed)
+            self.assertEqual(self.fetch(crawler, version), html(version))
+
+        history = cache.history(self.url('/p'))
+        self.assertEqual([(cache_control, response.read())
+                          for date, cache_control, response in history],
+                         [('1', html(1)), ('2', html(2)), ('3', html(3))])
+
+        # the old versions are stored as deltas
+        rows = cache.connection.execute('''
+            SELECT delta_base IS NOT NULL, length(response_data) FROM cache
+            ORDER BY rowid''').fetchall()
+        self.assertEqual([delta for delta, size in rows], [1, 1, 0])
+        self.assertTrue(all(size < 200 for delta, size in rows[:2]), rows)
+
+    def test_history(self):
+        self.check_history(False)
+
+    def test_history_of_compressed_pages(self):
+        self.check_history(True)
+
+    def test_large_pages_are_stored_in_full(self):
+        cache = self.cache()
+        cache.max_delta_size = 1000
+        crawler = self.crawler(cache=cache)
+        for version in (1, 2):
+            self.serve(version)
+            self.fetch(crawler, version)
+        self.assertEqual(cache.connection.execute(
+            'SELECT count(*) FROM cache WHERE delta_base IS NOT NULL')
+            .fetchone()[0], 0)
+        self.assertEqual([response.read() for date, cache_control, response
+                          in cache.history(self.url('/p'))],
+                         [html(1), html(2)])
+
+class HeaderKeyPolicyTest(unittest.TestCase):
+    headers = [('Referer', 'http://a.com/'), ('Accept-Encoding', 'gzip'),
+               ('Accept-Language', 'nl'), ('X-Request-Id', '1'),
+               ('Cookie', 'user=1; _ga=GA1.2; PHPSESSID=x; lang=nl')]
+
+    def key(self, policy, host=None):
+        return sorted(urllib.unquote_plus(policy(self.headers, host))
+                      .split('&'))
+
+    def test_default(self):
+        self.assertEqual(self.key(HeaderKeyPolicy()),
+                         ['accept-language=nl', 'cookie=lang=nl; user=1',
+                          'x-request-id=1'])
+
+    def test_ignore_and_include(self):
+        self.assertEqual(self.key(HeaderKeyPolicy(
+                                  ignore_headers=['x-*', 'cookie'])),
+                         ['accept-encoding=gzip', 'accept-language=nl',
+                          'referer=http://a.com/'])
+        # headers ignored by default stay ignored
+        self.assertEqual(self.key(HeaderKeyPolicy(
+                                  include_headers=['Accept-*'])),
+                         ['accept-language=nl'])
+
+    def test_rules(self):
+        policy = HeaderKeyPolicy(rules={
+            'example.com': {'ignore_headers': ['X-Request-Id'],
+                            'ignore_cookies': ['lang']},
+            'shop.example.com': {'include_headers': ['cookie']},
+            '[::1]': {'ignore_cookies': ['user']}})
+        self.assertEqual(self.key(policy, 'www.Example.com:8080'),
+                         ['accept-language=nl', 'cookie=user=1'])
+        self.assertEqual(self.key(policy, 'shop.example.com'),
+                         ['cookie=user=1'])
+        self.assertEqual(self.key(policy, 'other.com'),
+                         self.key(HeaderKeyPolicy()))
+        self.assertEqual(self.key(policy, '[::1]:8080'),
+                         ['accept-language=nl', 'cookie=lang=nl',
+                          'x-request-id=1'])
+
+        policy.add_rule('EXAMPLE.com', ignore_cookies=['user'])
+        self.assertEqual(self.key(policy, 'www.example.com'),
+                         ['accept-language=nl'])
+
+class CacheKeyTest(ServerTestCase):
+    pages = {'/': page('hello')}
+
+    def fetch(self, crawler, cookie, **headers):
+        headers['Cookie'] = cookie
+        crawler.fetch(self.url(), headers=headers, referer=False).read()
+
+    def test_volatile_headers_dont_cause_misses(self):
+        crawler = self.crawler()
+        self.fetch(crawler, 'user=1; _ga=1')
+        self.fetch(crawler, '_ga=2;user=1', Referer='http://a.com/')
+        self.assertEqual(len(self.server.requests), 1)
+        self.fetch(crawler, 'user=2')
+        self.fetch(crawler, 'user=1', DNT='1')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_without_a_policy(self):
+        crawler = self.crawler(cache=self.cache(key_policy=False))
+        self.fetch(crawler, 'user=1; _ga=1')
+        self.fetch(crawler, 'user=1; _ga=2')
+        self.assertEqual(len(self.server.requests), 2)
+
+class CoalescingTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.server.pages['/slow'] = self.slow
+        self.server.pages['/flaky'] = self.flaky
+
+    def slow(self, handler):
+        time.sleep(0.3)
+        return page('slow')
+
+    def flaky(self, handler):
+        # the first request fails, after a while
+        time.sleep(0.3)
+        if len(self.server.requests) == 1:
+            return None # close the connection without a response
+        return page('flaky')
+
+    def fetch_concurrently(self, path, cache, count=5):
+        crawler = self.crawler(cache=cache, threadsafe=True)
+        results = []
+        def fetch():
+            try:
+                results.append(crawler.fetch(self.url(path)).read())
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=fetch) for i in xrange(count)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_are_downloaded_once(self):
+        self.assertEqual(self.fetch_concurrently('/slow', self.cache()),
+                         ['slow'] * 5)
+        self.assertEqual(self.server.paths(), ['/slow'])
+
+    def test_failed_downloads_release_the_waiters(self):
+        results = self.fetch_concurrently('/flaky', self.cache())
+        errors = [result for result in results
+                  if isinstance(result, Exception)]
+        self.assertEqual(len(errors), 1, results)
+        self.assertEqual([result for result in results
+                          if result not in errors], ['flaky'] * 4)
+        self.assertEqual(self.server.paths(), ['/flaky'] * 2)
+
+    def test_timeout(self):
+        cache = self.cache()
+        cache.coalesce_timeout = 0.05
+        self.assertEqual(self.fetch_concurrently('/slow', cache, 3),
+                         ['slow'] * 3)
+        self.assertTrue(len(self.server.requests) > 1)
+
+    def test_without_coalescing(self):
+        self.fetch_concurrently('/slow', self.cache(coalesce=False))
+        self.assertEqual(self.server.paths(), ['/slow'] * 5)
@@ -0,0 +1,97 @@
+import gzip
+import mimetools
+import unittest
+import zlib
+from StringIO import StringIO
+
+from eureka.compression import decompress_body
+from eureka.limits import ResponseTooLarge
+from tests.support import ServerTestCase, page
+
+def headers(text):
+    return mimetools.Message(StringIO(text + '\r\n'))
+
+def gzipped(text):
+    data = StringIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as fp:
+        fp.write(text)
+    return data.getvalue()
+
+class DecompressBodyTest(unittest.TestCase):
+    text = 'hello world\n' * 100
+
+    def test_gzip(self):
+        self.assertEqual(decompress_body(headers('Content-Encoding: gzip\r\n'),
+                                         gzipped(self.text)), self.text)
+
+    def test_deflate(self):
+        deflate = headers('Content-Encoding: deflate\r\n')
+        self.assertEqual(decompress_body(deflate, zlib.compress(self.text)),
+                         self.text)
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = raw.compress(self.text) + raw.flush()
+        self.assertEqual(decompress_body(deflate, data), self.text)
+
+    def test_not_compressed(self):
+        self.assertEqual(decompress_body(headers(''), self.text), None)
+        self.assertEqual(decompress_body(
+            headers('Content-Encoding: identity\r\n'), self.text), None)
+        self.assertEqual(decompress_body(
+            headers('Content-Encoding: compress\r\n'), self.text), None)
+
+    def test_corrupt(self):
+        self.assertEqual(decompress_body(
+            headers('Content-Encoding: gzip\r\n'), 'not gzip'), None)
+
+def raw_deflated(text):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+class CompressedResponseTest(ServerTestCase):
+    text = 'hello world\n' * 100
+    pages = {'/gzip': page(gzipped(text),
+                           headers=[('Content-Encoding', 'gzip')]),
+             '/deflate': page(zlib.compress(text),
+                              headers=[('Content-Encoding', 'deflate')]),
+             '/raw': page(raw_deflated(text),
+                          headers=[('Content-Encoding', 'deflate')]),
+             '/plain': page(text)}
+
+    def test_decompressed(self):
+        crawler = self.crawler(cache=False)
+        for path in ('/gzip', '/deflate', '/raw', '/plain'):
+            fp = crawler.fetch(self.url(path))
+            self.assertEqual(fp.read(), self.text, path)
+            self.assertEqual(fp.info().get('content-encoding'), None)
+
+    def test_readline(self):
+        fp = self.crawler(cache=False).fetch(self.url('/gzip'))
+        self.assertEqual(fp.readline(), 'hello world\n')
+        self.assertEqual(len(fp.readlines()), 99)
+
+    def test_accept_encoding(self):
+        self.crawler(cache=False).fetch(self.url('/plain')).read()
+        self.crawler(cache=False, compression=False) \
+            .fetch(self.url('/plain')).read()
+        self.crawler(cache=False).fetch(self.url('/plain'), headers={
+            'Accept-Encoding': 'gzip'}).read()
+        # httplib asks for "identity" if no one else asks for anything
+        self.assertEqual([headers.get('accept-encoding')
+                          for path, headers in self.server.requests],
+                         ['gzip, deflate', 'identity', 'gzip'])
+
+    def test_cache_stores_compressed_data(self):
+        cache = self.cache()
+        crawler = self.crawler(cache=cache)
+        for i in xrange(2):
+            self.assertEqual(crawler.fetch(self.url('/gzip')).read(),
+                             self.text)
+        self.assertEqual(self.server.paths(), ['/gzip'])
+        size, = cache.connection.execute(
+            'SELECT length(response_data) FROM cache').fetchone()
+        self.assertTrue(size < len(self.text), size)
+
+    def test_decompressed_size_is_limited(self):
+        crawler = self.crawler(cache=False, max_body_size=100)
+        fp = crawler.fetch(self.url('/gzip'))
+        self.assertRaises(ResponseTooLarge, fp.read)
@@ -0,0 +1,95 @@
+import socket
+import time
+import unittest
+import urllib2
+
+from eureka.connection import RequestTimeout, TimeoutPolicy, Timeouts
+from tests.support import ServerTestCase, page
+
+def timeout_error(error):
+    ''' returns the RequestTimeout behind ``error``, or None '''
+
+    if isinstance(error, urllib2.URLError):
+        error = error.reason
+    if isinstance(error, RequestTimeout):
+        return error
+    return None
+
+class TimeoutPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = TimeoutPolicy(Timeouts(connect=1, read=2), hosts={
+            'example.com': Timeouts(read=5),
+            'slow.example.com': Timeouts(connect=3),
+            '::1': Timeouts(read=7),
+            '[fe80::1]': Timeouts(read=8)})
+
+    def test_default(self):
+        timeouts = self.policy.for_host('other.com:8080')
+        self.assertEqual((timeouts.connect, timeouts.read), (1, 2))
+
+    def test_subdomains_inherit(self):
+        timeouts = self.policy.for_host('Slow.Example.com:81')
+        self.assertEqual((timeouts.connect, timeouts.read), (3, 5))
+        self.assertEqual(self.policy.for_host('www.example.com').read, 5)
+
+    def test_ipv6(self):
+        self.assertEqual(self.policy.for_host('[::1]').read, 7)
+        self.assertEqual(self.policy.for_host('[::1]:8080').read, 7)
+        self.assertEqual(self.policy.for_host('[FE80::1]:80').read, 8)
+
+    def test_make_and_override(self):
+        self.assertEqual(repr(Timeouts.make(4)),
+                         'Timeouts(connect=4, first_byte=4, read=4, '
+                         'total=None)')
+        timeouts = Timeouts(connect=1, read=2).override(Timeouts(read=3,
+                                                                 total=9))
+        self.assertEqual((timeouts.connect, timeouts.read, timeouts.total),
+                         (1, 3, 9))
+
+class TimeoutTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.server.pages['/slow'] = self.slow
+        self.server.pages['/trickle'] = self.trickle
+
+    def slow(self, handler):
+        time.sleep(1.5)
+        return page('slow')
+
+    def trickle(self, handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', '20')
+        handler.end_headers()
+        for i in xrange(20):
+            handler.wfile.write('x')
+            handler.wfile.flush()
+            time.sleep(0.1)
+
+    def fetch(self, path, **kwargs):
+        crawler = self.crawler(cache=False)
+        start = time.time()
+        try:
+            with crawler.fetch(self.url(path), **kwargs) as fp:
+                fp.read()
+        except (urllib2.URLError, socket.error), e:
+            return timeout_error(e), time.time() - start
+        return None, time.time() - start
+
+    def test_first_byte(self):
+        error, seconds = self.fetch('/slow', timeouts={'first_byte': 0.3})
+        self.assertEqual(error.phase, 'first_byte')
+        self.assertTrue(seconds < 1, seconds)
+
+    def test_trickling_response_is_not_a_read_timeout(self):
+        error, seconds = self.fetch('/trickle', timeouts={'read': 0.5})
+        self.assertEqual(error, None)
+
+    def test_total(self):
+        error, seconds = self.fetch('/trickle', timeouts={'total': 0.5})
+        self.assertEqual(error.phase, 'total')
+        self.assertTrue(seconds < 1.5, seconds)
+
+    def test_deadline(self):
+        error, seconds = self.fetch('/slow', deadline=0.3)
+        self.assertEqual(error.phase, 'total')
+        self.assertTrue(seconds < 1, seconds)
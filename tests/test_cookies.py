@@ -0,0 +1,192 @@
+import cookielib
+import mimetools
+import threading
+import unittest
+import urllib2
+from StringIO import StringIO
+from time import time
+
+from eureka.cookies import IndexedCookieJar, ShardedCookieJar
+from tests.support import ServerTestCase, TempDirTestCase, page
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = mimetools.Message(StringIO(
+            ''.join('Set-Cookie: %s\r\n' % header for header in headers) +
+            '\r\n'))
+
+    def info(self):
+        return self.headers
+
+# (url, Set-Cookie headers) of the responses that set the cookies
+responses = [
+    ('http://www.example.com/', ['a=1', 'b=2; Domain=.example.com',
+                                 'c=3; Path=/sub',
+                                 'd=4; Domain=example.com; Path=/']),
+    ('http://shop.example.com/basket', ['e=5; Domain=.example.com',
+                                        'local=6']),
+    ('http://a.b.example.com/', ['f=7; Domain=.b.example.com']),
+    ('http://WWW.Other.org:8080/x/y', ['g=8; Path=/x', 'h=9']),
+    ('http://other.org/', ['i=10; Domain=.other.org; Secure',
+                           'gone=1; Expires=Thu, 01 Jan 1970 00:00:00 GMT']),
+    ('http://www.example.com/sub/page', ['c=changed; Path=/sub',
+                                         'a=deleted; Max-Age=0']),
+    ('http://evil.com/', ['j=11; Domain=.example.com']),
+]
+
+hosts = ['www.example.com', 'shop.example.com', 'example.com',
+         'x.a.b.example.com', 'b.example.com', 'www.other.org:8080',
+         'other.org', 'evil.com', 'unknown.net']
+paths = ['/', '/sub', '/sub/x', '/subway', '/x/y/z', '/basket/1']
+
+def cookie_header(jar, url):
+    request = urllib2.Request(url)
+    jar.add_cookie_header(request)
+    # cookies with paths of the same length may come in any order
+    return sorted((request.get_header('Cookie') or '').split('; '))
+
+def fill(jar):
+    for url, headers in responses:
+        jar.extract_cookies(FakeResponse(headers), urllib2.Request(url))
+    return jar
+
+class CookieJarTest(unittest.TestCase):
+    jars = [ShardedCookieJar, IndexedCookieJar]
+
+    def test_same_cookies_as_cookielib(self):
+        expected = fill(cookielib.CookieJar())
+        for jar_class in self.jars:
+            jar = fill(jar_class())
+            self.assertEqual(sorted((c.domain, c.path, c.name, c.value)
+                                    for c in jar),
+                             sorted((c.domain, c.path, c.name, c.value)
+                                    for c in expected))
+            self.assertEqual(len(jar), len(expected))
+            for scheme in ('http', 'https'):
+                for host in hosts:
+                    for path in paths:
+                        url = '%s://%s%s' % (scheme, host, path)
+                        self.assertEqual(cookie_header(jar, url),
+                                         cookie_header(expected, url),
+                                         (jar_class.__name__, url))
+
+    def test_clear(self):
+        for jar_class in self.jars:
+            jar = fill(jar_class())
+            count = len(jar)
+            jar.clear('.example.com', '/', 'b')
+            self.assertEqual(len(jar), count - 1)
+            self.assertRaises(KeyError, jar.clear, 'unknown.net')
+            jar.clear('www.example.com')
+            self.assertEqual(cookie_header(jar, 'http://www.example.com/sub'),
+                             ['d=4', 'e=5'])
+            jar.clear()
+            self.assertEqual(len(jar), 0)
+
+    def test_session_cookies(self):
+        for jar_class in self.jars:
+            jar = fill(jar_class())
+            jar.extract_cookies(FakeResponse([
+                'kept=1; Expires=Fri, 01 Jan 2100 00:00:00 GMT']),
+                urllib2.Request('http://www.example.com/'))
+            jar.clear_session_cookies()
+            self.assertEqual([cookie.name for cookie in jar], ['kept'])
+
+def make_cookie(name, domain='www.example.com', path='/', expires=None):
+    return cookielib.Cookie(0, name, 'v', None, False, domain, False,
+                            domain.startswith('.'), path, True, False,
+                            expires, expires is None, None, None,
+                            {'HttpOnly': None, 'Note': 'a b&c=d+%'})
+
+class IndexedCookieJarTest(TempDirTestCase):
+    def test_max_cookies(self):
+        jar = IndexedCookieJar(max_cookies=3)
+        for name in 'abcd':
+            jar.set_cookie(make_cookie(name))
+        self.assertEqual(sorted(cookie.name for cookie in jar),
+                         ['b', 'c', 'd'])
+        # setting a cookie again makes it the most recently set one
+        jar.set_cookie(make_cookie('b'))
+        jar.extract_cookies(FakeResponse(['e=1']),
+                            urllib2.Request('http://www.example.com/'))
+        self.assertEqual(sorted(cookie.name for cookie in jar),
+                         ['b', 'd', 'e'])
+        self.assertEqual(len(jar), 3)
+
+    def test_expired_cookies_are_dropped_when_looked_up(self):
+        jar = IndexedCookieJar()
+        jar.set_cookie(make_cookie('old', expires=int(time()) - 10))
+        jar.set_cookie(make_cookie('new', expires=int(time()) + 3600))
+        self.assertEqual(len(jar), 2)
+        self.assertEqual(cookie_header(jar, 'http://www.example.com/'),
+                         ['new=v'])
+        self.assertEqual(len(jar), 1)
+
+    def test_save_and_load(self):
+        from eureka.cache import Cache
+        cache = Cache(self.path('cache.sqlite'))
+        jar = fill(IndexedCookieJar())
+        jar.set_cookie(make_cookie('kept', '.example.com', '/sub',
+                                   int(time()) + 3600))
+        jar.set_cookie(make_cookie('expired', expires=int(time()) - 10))
+        jar.save(cache)
+
+        loaded = IndexedCookieJar(cache=cache)
+        self.assertEqual([(c.domain, c.path, c.name, c.value, c._rest)
+                          for c in loaded],
+                         [('.example.com', '/sub', 'kept', 'v',
+                           {'HttpOnly': None, 'Note': 'a b&c=d+%'})])
+
+        jar.save(cache, ignore_discard=True)
+        loaded = IndexedCookieJar()
+        loaded.load(cache, ignore_discard=True)
+        self.assertEqual(sorted((c.domain, c.path, c.name, c.value)
+                                for c in loaded),
+                         sorted((c.domain, c.path, c.name, c.value)
+                                for c in jar if c.name != 'expired'))
+        self.assertEqual(cookie_header(loaded, 'http://shop.example.com/'),
+                         cookie_header(jar, 'http://shop.example.com/'))
+
+    def test_after_fork(self):
+        jar = fill(IndexedCookieJar())
+        locks = [shard._cookies_lock for shard in jar._shards.values()]
+        for lock in locks:
+            lock.acquire() # as if held by another thread in the parent
+        jar._order_lock.acquire()
+        jar.after_fork()
+        jar.set_cookie(make_cookie('x'))
+        self.assertTrue('x=v' in cookie_header(jar,
+                                                'http://www.example.com/'))
+        for lock in locks:
+            lock.release()
+
+class ThreadsafeCrawlerTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        for i in xrange(20):
+            self.server.pages['/set%d' % i] = page('', headers=[
+                ('Set-Cookie', 'c%d=%d' % (i, i))])
+        self.server.pages['/check'] = page('')
+
+    def test_concurrent_requests(self):
+        crawler = self.crawler(cache=False, threadsafe=True)
+        self.assertTrue(isinstance(crawler.cookies, ShardedCookieJar))
+
+        errors = []
+        def fetch(i):
+            try:
+                crawler.fetch(self.url('/set%d' % i)).read()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch, args=(i,))
+                   for i in xrange(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        crawler.fetch(self.url('/check')).read()
+        path, headers = self.server.requests[-1]
+        self.assertEqual(sorted(headers['cookie'].split('; ')),
+                         sorted('c%d=%d' % (i, i) for i in xrange(20)))
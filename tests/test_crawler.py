@@ -0,0 +1,56 @@
+import hashlib
+
+from tests.support import ServerTestCase, page, redirect
+
+class FingerprintTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.server.pages.update({'/r': redirect('/p'),
+                                  '/p': page('first version')})
+
+    def fetch(self, crawler, path, **kwargs):
+        with crawler.fetch(self.url(path), **kwargs) as fp:
+            fp.read()
+            return fp
+
+    def test_redirect_uses_the_final_response(self):
+        crawler = self.crawler()
+        fp = self.fetch(crawler, '/r')
+        self.assertEqual(fp.geturl(), self.url('/p'))
+        self.assertNotEqual(fp.fingerprint, hashlib.sha1('').hexdigest())
+        self.assertEqual(fp.fingerprint, self.fetch(crawler, '/p').fingerprint)
+
+    def test_redirect_unchanged(self):
+        crawler = self.crawler()
+        first = self.fetch(crawler, '/r', cache_control='1')
+        self.assertFalse(first.unchanged)
+        self.assertTrue(self.fetch(crawler, '/r', cache_control='2').unchanged)
+
+        self.server.pages['/p'] = page('second version')
+        third = self.fetch(crawler, '/r', cache_control='3')
+        self.assertFalse(third.unchanged)
+        self.assertNotEqual(third.fingerprint, first.fingerprint)
+
+    def test_cache_hit_is_not_unchanged(self):
+        crawler = self.crawler()
+        self.fetch(crawler, '/p')
+        fp = self.fetch(crawler, '/p')
+        self.assertTrue(fp.is_from_cache)
+        self.assertFalse(fp.unchanged)
+        self.assertEqual(self.server.paths(), ['/p'])
+
+    def test_extract_through_redirect(self):
+        crawler = self.crawler()
+        read = lambda fp: fp.read()
+        self.assertEqual(crawler.extract(self.url('/r'), read, method='fetch',
+                                         name='read', cache_control='1'),
+                         'first version')
+        self.server.pages['/p'] = page('second version')
+        self.assertEqual(crawler.extract(self.url('/r'), read, method='fetch',
+                                         name='read', cache_control='2'),
+                         'second version')
+
+    def test_extract_needs_a_name_for_lambdas(self):
+        crawler = self.crawler()
+        self.assertRaises(ValueError, crawler.extract, self.url('/p'),
+                          lambda fp: fp.read(), method='fetch')
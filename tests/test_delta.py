@@ -0,0 +1,68 @@
+import random
+import time
+import unittest
+import zlib
+
+from eureka.delta import apply_delta, make_delta
+
+def page(version, rows=2000):
+    lines = ['<html><head><title>version %d</title></head><body>' % version]
+    for i in xrange(rows):
+        if i % 97 == version % 97:
+            lines.append('<p>changed row %d in version %d</p>' % (i, version))
+        else:
+            lines.append('<p class="row">row %d</p>' % i)
+    lines.append('</body></html>')
+    return '\n'.join(lines)
+
+class DeltaTest(unittest.TestCase):
+    def roundtrip(self, base, target):
+        delta = make_delta(base, target)
+        self.assertEqual(apply_delta(base, delta), target)
+        return delta
+
+    def test_similar_pages(self):
+        base, target = page(2), page(1)
+        delta = self.roundtrip(base, target)
+        self.assertTrue(len(delta) < len(zlib.compress(target)) / 4)
+
+    def test_edge_cases(self):
+        for base, target in [('', ''), ('', 'new'), ('old', ''),
+                             ('same', 'same'), ('a\nb\nc\n', 'c\nb\na\n'),
+                             ('<a><b>' * 50, '<b><a>' * 50),
+                             ('no newline', 'no newline at all')]:
+            self.roundtrip(base, target)
+
+    def test_minified_html(self):
+        base = ''.join('<td>%d</td>' % i for i in xrange(5000))
+        target = base.replace('<td>2500</td>', '<td>changed</td>')
+        delta = self.roundtrip(base, target)
+        self.assertTrue(len(delta) < 200, len(delta))
+
+    def test_random_edits(self):
+        rng = random.Random(42)
+        base = page(0, 300)
+        for i in xrange(20):
+            lines = base.split('\n')
+            for j in xrange(rng.randint(1, 10)):
+                k = rng.randrange(len(lines))
+                action = rng.choice(('delete', 'insert', 'change'))
+                if action == 'delete':
+                    del lines[k]
+                elif action == 'insert':
+                    lines.insert(k, '<div>%d</div>' % rng.random())
+                else:
+                    lines[k] += 'x'
+            self.roundtrip(base, '\n'.join(lines))
+
+    def test_large_pages_take_linear_time(self):
+        base, target = page(2, 40000), page(1, 40000)
+        start = time.time()
+        self.roundtrip(base, target)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_corrupt_delta(self):
+        self.assertRaises((ValueError, zlib.error), apply_delta, 'base',
+                          'not a delta')
+        self.assertRaises(ValueError, apply_delta, 'base',
+                          zlib.compress('XX'))
@@ -0,0 +1,125 @@
+import httplib
+import os
+import re
+
+from eureka.metrics import MemorySink, Metrics
+from eureka.scheduler import RetryPolicy
+from tests.support import ServerTestCase
+
+data = ''.join(chr(i % 251) for i in xrange(10000))
+
+class RangeServerTestCase(ServerTestCase):
+    '''
+    Serves ``self.data`` at /file, with support for range requests. The
+    first ``self.failures`` responses are cut off after ``self.cut_at``
+    bytes. If ``self.ranges`` is False, Range headers are ignored.
+
+    '''
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.data = data
+        self.etag = '"v1"'
+        self.failures = 0
+        self.cut_at = 3000
+        self.ranges = True
+        self.server.pages['/file'] = self.serve
+
+    def serve(self, handler):
+        first = 0
+        match = re.match(r'bytes=(\d+)-$', handler.headers.get('range', ''))
+        if match and self.ranges and \
+           handler.headers.get('if-range') in (None, self.etag):
+            first = int(match.group(1))
+            if first >= len(self.data):
+                handler.send_response(416)
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+        body = self.data[first:]
+
+        handler.send_response(first and 206 or 200)
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header('ETag', self.etag)
+        if first:
+            handler.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                first, len(self.data) - 1, len(self.data)))
+        handler.end_headers()
+        if self.failures:
+            self.failures -= 1
+            body = body[:self.cut_at]
+        handler.wfile.write(body)
+
+    def ranges_requested(self):
+        return [headers.get('range') for path, headers in self.server.requests]
+
+class DownloadTest(RangeServerTestCase):
+    def download(self, crawler=None, **kwargs):
+        crawler = crawler or self.crawler(**kwargs)
+        self.target = self.path('file.bin')
+        return crawler.fetch_to_file(self.url('/file'), self.target,
+                                     chunk_size=1000)
+
+    def test_download(self):
+        sink = MemorySink()
+        crawler = self.crawler(metrics=Metrics(sink))
+        self.assertEqual(self.download(crawler)[:], data)
+        with open(self.target, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+        # a completed download isn't repeated
+        self.assertEqual(self.download(crawler)[:], data)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(sink.counter('download_hits'), 1)
+
+    def test_empty_file(self):
+        self.data = ''
+        self.assertEqual(self.download(), '')
+
+    def test_resume_after_a_retry(self):
+        self.failures = 2
+        sink = MemorySink()
+        result = self.download(metrics=Metrics(sink),
+                               retry_policy=RetryPolicy(2, backoff=0))
+        self.assertEqual(result[:], data)
+        self.assertEqual(self.ranges_requested(),
+                         [None, 'bytes=3000-', 'bytes=6000-'])
+        self.assertEqual(sink.counter('download_resumes'), 2)
+
+    def test_resume_in_a_later_run(self):
+        self.failures = 1
+        self.assertRaises(httplib.IncompleteRead, self.download)
+        self.assertEqual(os.path.getsize(self.target + '.part'), 3000)
+        self.assertEqual(self.download()[:], data)
+        path, headers = self.server.requests[-1]
+        self.assertEqual((headers.get('range'), headers.get('if-range')),
+                         ('bytes=3000-', '"v1"'))
+
+    def test_changed_file_is_downloaded_again(self):
+        self.failures = 1
+        self.assertRaises(httplib.IncompleteRead, self.download)
+        self.data = data[::-1]
+        self.etag = '"v2"'
+        self.assertEqual(self.download()[:], data[::-1])
+
+    def test_server_without_range_support(self):
+        self.failures = 1
+        self.ranges = False
+        self.assertEqual(self.download(retry_policy=RetryPolicy(
+                                           1, backoff=0))[:], data)
+        self.assertEqual(self.ranges_requested(), [None, 'bytes=3000-'])
+
+    def test_part_larger_than_the_file(self):
+        self.failures = 1
+        self.assertRaises(httplib.IncompleteRead, self.download)
+        self.data = data[:2000]
+        self.assertEqual(self.download()[:], data[:2000])
+        self.assertEqual(self.ranges_requested(),
+                         [None, 'bytes=3000-', None])
+
+    def test_without_a_cache(self):
+        self.assertEqual(self.download(cache=False)[:], data)
+        self.assertEqual(self.download(cache=False)[:], data)
+        self.assertEqual(len(self.server.requests), 2)
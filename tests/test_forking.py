@@ -0,0 +1,101 @@
+import gc
+import os
+import unittest
+
+from eureka import forking
+from eureka.metrics import MemorySink, Metrics
+from tests.support import ServerTestCase, page
+
+class Counter(object):
+    def __init__(self):
+        self.forks = 0
+
+    def after_fork(self):
+        self.forks += 1
+
+class RegistryTest(unittest.TestCase):
+    def test_after_fork(self):
+        counter = forking.register(Counter())
+        forking.after_fork()
+        self.assertEqual(counter.forks, 1)
+
+    def test_only_weak_references_are_kept(self):
+        gc.collect()
+        count = len(forking._objects)
+        forking.register(Counter())
+        self.assertEqual(len(forking._objects), count)
+
+def in_child(function):
+    '''
+    Runs ``function`` in a child process started by ``eureka.forking.fork()``
+    and returns the string it returns, or raises AssertionError if it fails.
+
+    '''
+
+    read, write = os.pipe()
+    pid = forking.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read)
+            os.write(write, function())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    pid, status = os.waitpid(pid, 0)
+    if status:
+        raise AssertionError('the child process failed')
+    return ''.join(chunks)
+
+class ForkTest(ServerTestCase):
+    pages = {'/a': page('a'),
+             '/b': page('b'),
+             '/cookie': page('', headers=[('Set-Cookie', 'session=1')])}
+
+    def test_child_uses_a_new_cache_connection(self):
+        cache = self.cache()
+        crawler = self.crawler(cache=cache)
+        crawler.fetch(self.url('/a')).read()
+        parent_connection = cache.connection
+
+        def child():
+            if cache.connection is parent_connection:
+                return 'same connection'
+            # a cached page, and one that the child stores itself
+            return crawler.fetch(self.url('/a')).read() + \
+                   crawler.fetch(self.url('/b')).read()
+
+        self.assertEqual(in_child(child), 'ab')
+        self.assertTrue(cache.connection is parent_connection)
+        self.assertEqual(self.server.paths(), ['/a', '/b'])
+        crawler.fetch(self.url('/b')).read()
+        self.assertEqual(self.server.paths(), ['/a', '/b'])
+
+    def test_metrics_are_reset(self):
+        sink = MemorySink()
+        Metrics(sink).count('pages', 5)
+        self.assertEqual(in_child(lambda: str(sink.counter('pages'))), '0')
+        self.assertEqual(sink.counter('pages'), 5)
+
+    def test_clear_cookies_after_fork(self):
+        crawler = self.crawler(cache=False)
+        crawler.fetch(self.url('/cookie')).read()
+        count = lambda: str(len(list(crawler.cookies)))
+        self.assertEqual(in_child(count), '1')
+        crawler.clear_cookies_after_fork = True
+        self.assertEqual(in_child(count), '0')
+        self.assertEqual(count(), '1')
+
+    def test_fork_is_noticed_without_forking_fork(self):
+        crawler = self.crawler()
+        crawler._pid = -1 # as if we had been forked with os.fork()
+        crawler.fetch(self.url('/a')).read()
+        self.assertEqual(crawler._pid, os.getpid())
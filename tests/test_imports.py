@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(statements):
+    ''' runs ``statements`` in a fresh interpreter, and returns its output '''
+
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', PYTHONPATH=root)
+    return subprocess.check_output([sys.executable, '-c', statements],
+                                   env=env, cwd=root).split()
+
+class ImportTest(unittest.TestCase):
+    def test_import_is_cheap(self):
+        self.assertEqual(run('''
+import sys
+import eureka.crawler
+for name in ('sqlite3', 'lxml', 'cookielib', 'robotparser', 'eureka.cache'):
+    print name in sys.modules
+print eureka.crawler.crawler._crawler is None
+'''), ['False'] * 5 + ['True'])
+
+    def test_default_crawler_is_created_on_first_use(self):
+        self.assertEqual(run('''
+import sys
+from eureka.crawler import Crawler, crawler
+crawler.silent = True
+print isinstance(crawler._crawler, Crawler), crawler.silent
+print crawler.opener is crawler._crawler.opener
+print 'eureka.cache' in sys.modules, 'sqlite3' in sys.modules
+'''), ['True', 'True', 'True', 'True', 'False'])
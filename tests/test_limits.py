@@ -0,0 +1,69 @@
+import urllib2
+
+from eureka.limits import ResponseTooLarge, UnwantedContentType
+from tests.support import ServerTestCase, page
+
+def without_length(body):
+    ''' a page function that doesn't send a Content-Length '''
+
+    def send(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/plain')
+        handler.end_headers()
+        handler.wfile.write(body)
+    return send
+
+class LimitsTest(ServerTestCase):
+    pages = {'/small': page('x' * 10),
+             '/large': page('x' * 1000),
+             '/streamed': without_length('x' * 1000),
+             '/pdf': page('%PDF', headers=[('Content-Type',
+                                            'application/pdf')]),
+             '/missing': page('gone', code=404,
+                              headers=[('Content-Type', 'application/pdf')]),
+             '/headers': page('x', headers=[('X-Padding', 'x' * 500)])}
+
+    def test_content_length(self):
+        crawler = self.crawler(cache=False, max_body_size=100)
+        self.assertEqual(crawler.fetch(self.url('/small')).read(), 'x' * 10)
+        self.assertRaises(ResponseTooLarge, crawler.fetch,
+                          self.url('/large'))
+
+    def test_body_without_content_length(self):
+        crawler = self.crawler(cache=False, max_body_size=100)
+        fp = crawler.fetch(self.url('/streamed'))
+        self.assertRaises(ResponseTooLarge, fp.read)
+
+    def test_cached_bodies_are_limited(self):
+        crawler = self.crawler(max_body_size=100)
+        self.assertRaises(ResponseTooLarge, crawler.fetch,
+                          self.url('/streamed'))
+        self.assertEqual(crawler.fetch(self.url('/small')).read(), 'x' * 10)
+
+    def test_header_size(self):
+        crawler = self.crawler(cache=False, max_header_size=200)
+        self.assertEqual(crawler.fetch(self.url('/small')).read(), 'x' * 10)
+        self.assertRaises(ResponseTooLarge, crawler.fetch,
+                          self.url('/headers'))
+
+    def test_content_types(self):
+        crawler = self.crawler(cache=False, content_types=['Text/'])
+        self.assertEqual(crawler.fetch(self.url('/small')).read(), 'x' * 10)
+        self.assertRaises(UnwantedContentType, crawler.fetch,
+                          self.url('/pdf'))
+        # error responses still raise HTTPError
+        self.assertRaises(urllib2.HTTPError, crawler.fetch,
+                          self.url('/missing'))
+
+    def test_robots_txt_is_exempt_and_truncated(self):
+        # a robots.txt file whose disallow line is past the first max_size
+        # bytes, served as text/plain to a crawler that only wants html
+        self.server.pages['/robots.txt'] = page(
+            'User-agent: *\nDisallow: /private\n' + '#' * 100 +
+            '\nDisallow: /small\n',
+            headers=[('Content-Type', 'text/plain')])
+        crawler = self.crawler(cache=False, robotstxt=True, max_body_size=20,
+                               content_types=['text/html'])
+        crawler.robots.max_size = 60
+        self.assertFalse(crawler.robots.can_fetch(self.url('/private')))
+        self.assertTrue(crawler.robots.can_fetch(self.url('/small')))
@@ -0,0 +1,118 @@
+import logging
+import unittest
+import urllib2
+
+from eureka.metrics import LoggingSink, MemorySink, Metrics, PrometheusSink, \
+                           null_metrics
+from tests.support import ServerTestCase, page
+
+class MetricsTest(unittest.TestCase):
+    def test_without_sinks(self):
+        self.assertFalse(null_metrics)
+        with null_metrics.timer('anything'):
+            null_metrics.count('anything')
+
+    def test_memory_sink(self):
+        sink = MemorySink()
+        metrics = Metrics(sink)
+        metrics.count('hits', 2, 'a.com')
+        metrics.count('hits', 1, 'b.com')
+        metrics.count('hits')
+        metrics.timing('fetch', 0.5, 'a.com')
+        metrics.timing('fetch', 1.5, 'a.com')
+        self.assertEqual(sink.counter('hits', 'a.com'), 2)
+        self.assertEqual(sink.counter('hits'), 4)
+        self.assertEqual(sink.counter('misses'), 0)
+        self.assertEqual(sink.timers[('fetch', 'a.com')], [2, 2.0, 1.5])
+        self.assertEqual(sink.total_time('fetch'), 2.0)
+
+    def test_hit_rate_and_report(self):
+        sink = MemorySink()
+        self.assertEqual(sink.hit_rate(), None)
+        metrics = Metrics(sink)
+        metrics.count('cache_hits', 3, 'a.com')
+        metrics.count('cache_misses', 1, 'a.com')
+        self.assertEqual(sink.hit_rate('a.com'), 0.75)
+        report = sink.report()
+        self.assertTrue('cache_hit_rate' in report, report)
+        self.assertFalse('[a.com]' in report, report)
+        self.assertTrue('cache_hits[a.com]' in sink.report(hosts=True))
+
+    def test_logging_sink(self):
+        records = []
+        class Collect(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        logger = logging.getLogger('eureka.tests.metrics')
+        logger.propagate = False
+        logger.addHandler(Collect())
+        metrics = Metrics(LoggingSink(logger, logging.CRITICAL))
+        metrics.count('hits', 1, 'a.com')
+        self.assertEqual(records, ['metrics: hits[a.com] +1'])
+
+    def test_prometheus(self):
+        sink = PrometheusSink()
+        metrics = Metrics(sink)
+        metrics.count('cache_hits', 2, 'a.com')
+        metrics.timing('fetch', 0.25, 'a"b')
+        self.assertEqual(sink.render().splitlines(), [
+            '# TYPE eureka_cache_hits_total counter',
+            'eureka_cache_hits_total{host="a.com"} 2',
+            '# TYPE eureka_fetch_seconds summary',
+            'eureka_fetch_seconds_count{host="a\\"b"} 1',
+            'eureka_fetch_seconds_sum{host="a\\"b"} 0.250000'])
+
+        server = sink.serve(port=0)
+        try:
+            fp = urllib2.urlopen('http://127.0.0.1:%d/' %
+                                 server.server_address[1])
+            self.assertEqual(fp.read(), sink.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class CrawlerMetricsTest(ServerTestCase):
+    pages = {'/': page('hello'),
+             '/missing': page('gone', code=404)}
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.sink = MemorySink()
+        self.host = self.url()[len('http://'):-1]
+
+    def test_cache_hits_and_misses(self):
+        crawler = self.crawler(metrics=Metrics(self.sink))
+        for i in xrange(3):
+            crawler.fetch(self.url()).read()
+        self.assertEqual(self.server.paths(), ['/'])
+        self.assertEqual(self.sink.counter('cache_misses', self.host), 1)
+        self.assertEqual(self.sink.counter('cache_hits', self.host), 2)
+        self.assertEqual(self.sink.counter('responses', self.host), 1)
+        self.assertEqual(self.sink.counter('bytes', self.host), 5)
+        self.assertEqual(self.sink.timers[('fetch', self.host)][0], 3)
+        self.assertEqual(self.sink.timers[('network', self.host)][0], 1)
+
+    def test_errors(self):
+        crawler = self.crawler(cache=False, metrics=Metrics(self.sink))
+        self.assertRaises(urllib2.HTTPError, crawler.fetch,
+                          self.url('/missing'))
+        self.assertEqual(self.sink.counter('http_errors', self.host), 1)
+        self.assertEqual(self.sink.counter('retries', self.host), 0)
+
+    def test_shared_cache_keeps_its_metrics(self):
+        # the cache counts for the crawler whose request it handles
+        cache = self.cache()
+        other = MemorySink()
+        first = self.crawler(cache=cache, metrics=Metrics(self.sink))
+        second = self.crawler(cache=cache, metrics=Metrics(other))
+        first.fetch(self.url()).read()
+        second.fetch(self.url()).read()
+        self.assertTrue(cache.metrics is null_metrics)
+        self.assertEqual(self.sink.counter('cache_misses'), 1)
+        self.assertEqual(self.sink.counter('cache_hits'), 0)
+        self.assertEqual(other.counter('cache_hits'), 1)
+
+    def test_parse_timer(self):
+        crawler = self.crawler(metrics=Metrics(self.sink))
+        crawler.fetch_html(self.url())
+        self.assertEqual(self.sink.timers[('parse', self.host)][0], 1)
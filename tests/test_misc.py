@@ -0,0 +1,67 @@
+import unittest
+import urllib
+
+from eureka.misc import add_parameters_to_url, urldecode, urldecode_many, \
+                        urlencode, urlencode_many
+
+class URLEncodeTest(unittest.TestCase):
+    queries = [[('a', 'b c'), ('x&y', '1=2'), ('n', 3), ('f', 1.5)],
+               [('__VIEWSTATE', 'dDwtMTA4/+=' * 4), ('q', '%/?')],
+               [(u'k', u'v'), ('empty', ''), ('~._-', '~._-')],
+               []]
+
+    def test_same_as_urllib(self):
+        for query in self.queries:
+            for doseq in (0, 1):
+                self.assertEqual(urlencode(query, doseq),
+                                 urllib.urlencode(query, doseq))
+
+    def test_doseq(self):
+        query = [('days', ('M', 'W')), ('u', u'\xe9t\xe9'), ('n', 5)]
+        self.assertEqual(urlencode(query, 1), urllib.urlencode(query, 1))
+        self.assertEqual(urlencode(query, 1), 'days=M&days=W&u=%3Ft%3F&n=5')
+
+    def test_none(self):
+        self.assertEqual(urlencode([('a', None), ('b', 1)]), 'a&b=1')
+        self.assertEqual(urlencode([('a', None), ('b', [1, None])], 1),
+                         'a&b=1&b=b')
+
+    def test_mapping(self):
+        self.assertEqual(urlencode({'a': 1}), 'a=1')
+
+    def test_not_a_query(self):
+        self.assertRaises(TypeError, urlencode, 'a=1')
+
+    def test_equal_keys_of_other_types(self):
+        self.assertEqual(urlencode([(1, 'a'), (True, 'b'), (1.0, 'c')]),
+                         '1=a&True=b&1.0=c')
+
+    def test_many(self):
+        queries = self.queries * 3
+        for doseq in (0, 1):
+            self.assertEqual(urlencode_many(queries, doseq),
+                             [urlencode(query, doseq) for query in queries])
+
+class URLDecodeTest(unittest.TestCase):
+    strings = ['a=b+c&x%26y=1%3D2', 'flag&a=', '', 'a=%7e&%41=b', 'a=b=c']
+
+    def test_urldecode(self):
+        self.assertEqual(list(urldecode('a=1&b&c=%20x')),
+                         [('a', '1'), ('b', None), ('c', ' x')])
+        self.assertEqual(list(urldecode('a=b=c')), [('a', 'b=c')])
+
+    def test_roundtrip(self):
+        query = [('a', 'b c'), ('x&y', '1=2'), ('flag', None)]
+        self.assertEqual(list(urldecode(urlencode(query).replace('+', ' '))),
+                         query)
+
+    def test_many(self):
+        strings = self.strings * 3
+        self.assertEqual(urldecode_many(strings),
+                         [list(urldecode(string)) for string in strings])
+
+class AddParametersTest(unittest.TestCase):
+    def test_replaces_parameters(self):
+        self.assertEqual(add_parameters_to_url('http://a/p?x=1&y=2#f',
+                                               [('x', 3), ('z', None)]),
+                         'http://a/p?y=2&x=3&z#f')
@@ -0,0 +1,101 @@
+import urllib2
+
+from eureka.cache import NotCached
+from eureka.metrics import MemorySink, Metrics
+from tests.support import ServerTestCase, page
+
+class OfflineTestCase(ServerTestCase):
+    pages = {'/a': page('<html><body><p>page a</p></body></html>',
+                        headers=[('Content-Type', 'text/html')]),
+             '/b': page('page b'),
+             '/dir/c': page('page c'),
+             '/missing': page('not here', 404)}
+
+    def fill(self, cache_control=None):
+        ''' fetches the test pages with an online crawler '''
+
+        crawler = self.crawler(cache=self.cache())
+        for path in ('/a', '/b', '/dir/c'):
+            crawler.fetch(self.url(path), cache_control=cache_control).read()
+        crawler.fetch(self.url('/b'), data='x=1').read()
+        self.assertRaises(urllib2.HTTPError, crawler.fetch,
+                          self.url('/missing'), cache_control=cache_control)
+        return len(self.server.requests)
+
+class OfflineTest(OfflineTestCase):
+    def test_serves_cached_pages(self):
+        count = self.fill()
+        sink = MemorySink()
+        crawler = self.crawler(offline=True, robotstxt=True, delay=10,
+                               metrics=Metrics(sink))
+        self.assertEqual(crawler.fetch(self.url('/b')).read(), 'page b')
+        self.assertEqual(crawler.fetch(self.url('/b'), data='x=1').read(),
+                         'page b')
+        self.assertRaises(urllib2.HTTPError, crawler.fetch,
+                          self.url('/missing'))
+        self.assertEqual(crawler.robots, None)
+        self.assertEqual(len(self.server.requests), count)
+
+        try:
+            crawler.fetch(self.url('/new'))
+        except NotCached, e:
+            self.assertEqual(e.url, self.url('/new'))
+        else:
+            self.fail('NotCached not raised')
+        self.assertEqual(len(self.server.requests), count)
+        self.assertEqual(sink.counter('offline_misses'), 1)
+
+    def test_needs_a_cache(self):
+        self.assertRaises(ValueError, self.crawler, offline=True, cache=False)
+
+class ReplayTest(OfflineTestCase):
+    def replay(self, **kwargs):
+        crawler = self.crawler(offline=True)
+        return dict((url, (result, error)) for url, result, error
+                    in crawler.replay(**kwargs))
+
+    def test_replay(self):
+        count = self.fill()
+        sink = MemorySink()
+        crawler = self.crawler(offline=True, metrics=Metrics(sink))
+        results = dict((url, (result, error)) for url, result, error
+                       in crawler.replay())
+        self.assertEqual(sorted(results), [self.url(path) for path in
+                                           ('/a', '/b', '/dir/c', '/missing')])
+        document, error = results[self.url('/a')]
+        self.assertEqual(error, None)
+        self.assertEqual(document.findtext('.//p'), 'page a')
+        result, error = results[self.url('/missing')]
+        self.assertEqual((result, error.code), (None, 404))
+        self.assertEqual(sink.counter('replayed_pages'), 4)
+        self.assertEqual(len(self.server.requests), count)
+
+    def test_replay_raw_responses(self):
+        self.fill()
+        results = self.replay(like='%/b', method='fetch')
+        self.assertEqual(results.keys(), [self.url('/b')])
+        result, error = results[self.url('/b')]
+        self.assertEqual((result.read(), error), ('page b', None))
+
+    def test_replay_by_host(self):
+        self.fill()
+        host = self.url()[len('http://'):-1]
+        self.assertEqual(len(self.replay(host=host)), 4)
+        self.assertEqual(self.replay(host='example.com'), {})
+        self.assertEqual(sorted(self.replay(like='%/dir/%', host=host)),
+                         [self.url('/dir/c')])
+
+    def test_replay_newest_copy(self):
+        self.fill(cache_control=1)
+        self.server.pages['/b'] = page('page b, again')
+        self.fill(cache_control=2)
+        result, error = self.replay(method='fetch')[self.url('/b')]
+        self.assertEqual(result.read(), 'page b, again')
+        result, error = self.replay(method='fetch',
+                                    cache_control=1)[self.url('/b')]
+        self.assertEqual(result.read(), 'page b')
+
+    def test_unsupported_method(self):
+        crawler = self.crawler(offline=True)
+        self.assertRaises(ValueError, list,
+                          crawler.replay(method='fetch_many'))
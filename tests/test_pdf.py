@@ -0,0 +1,140 @@
+import os
+import stat
+from StringIO import StringIO
+from hashlib import sha1
+
+from eureka.pdf import PDFConverterPool, PDFDocument, PDFException, pdftohtml
+from tests.support import TempDirTestCase
+
+# Fake pdftohtml and pdfinfo commands. The "pdf" files are text files with
+# their number of pages, and pdftohtml fails for page ranges past the end.
+# Every pdftohtml run is logged to the file calls.log.
+_pdftohtml = r'''#!/bin/sh
+dir=$(dirname "$0")
+for file; do :; done
+pages=$(cat "$file")
+first=1; last=$pages
+while [ $# -gt 1 ]; do
+    case "$1" in -f) first=$2; shift;; -l) last=$2; shift;; esac
+    shift
+done
+echo "$first-$last" >> "$dir/calls.log"
+[ "$first" -gt "$pages" ] && exit 1
+[ "$last" -gt "$pages" ] && last=$pages
+echo "<pdf2xml>"
+i=$first
+while [ $i -le $last ]; do
+    echo "<page number=\"$i\"><text>page $i</text></page>"
+    i=$((i+1))
+done
+echo "</pdf2xml>"
+'''
+
+_pdfinfo = r'''#!/bin/sh
+echo "Title: fake"
+echo "Pages:          $(cat "$1")"
+'''
+
+class FakeCommandTestCase(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.command = self.script('pdftohtml', _pdftohtml)
+
+    def script(self, name, text):
+        filename = self.path(name)
+        with open(filename, 'w') as script:
+            script.write(text)
+        os.chmod(filename, stat.S_IRWXU)
+        return filename
+
+    def calls(self):
+        try:
+            with open(self.path('calls.log')) as log:
+                return log.read().split()
+        except IOError:
+            return []
+
+    def texts(self, pages):
+        return [page.findtext('text') for page in pages]
+
+class PDFDocumentTest(FakeCommandTestCase):
+    def document(self, pages, **kwargs):
+        return PDFDocument(StringIO(str(pages)), command=self.command,
+                           chunk_size=10, **kwargs)
+
+    def test_pages_are_converted_lazily(self):
+        self.script('pdfinfo', _pdfinfo)
+        with self.document(23) as document:
+            self.assertEqual(document.page(12).findtext('text'), 'page 12')
+            self.assertEqual(self.calls(), ['11-20'])
+            self.assertEqual(self.texts(document.pages(9, 11)),
+                             ['page 9', 'page 10', 'page 11'])
+            self.assertEqual(self.calls(), ['11-20', '1-10'])
+            self.assertEqual(len(document), 23)
+            self.assertRaises(IndexError, document.page, 24)
+            self.assertEqual(len(list(document)), 23)
+            self.assertEqual(self.calls(), ['11-20', '1-10', '21-23'])
+
+    def test_exact_multiple_of_the_chunk_size(self):
+        self.script('pdfinfo', _pdfinfo)
+        with self.document(20) as document:
+            # not list(document), which asks for len(document) first
+            self.assertEqual(sum(1 for page in document.pages()), 20)
+            self.assertEqual(self.calls(), ['1-10', '11-20'])
+
+    def test_without_pdfinfo(self):
+        with self.document(23) as document:
+            self.assertEqual(len(list(document.pages(15))), 9)
+            self.assertEqual(document.page_count, 23)
+            self.assertEqual(self.calls(), ['11-20', '21-30'])
+
+    def test_cached_chunks(self):
+        self.script('pdfinfo', _pdfinfo)
+        with self.document(40, cache_chunks=1) as document:
+            document.page(1)
+            document.page(2)
+            document.page(11)
+            document.page(1)
+            self.assertEqual(self.calls(), ['1-10', '11-20', '1-10'])
+
+    def test_close_removes_the_copy(self):
+        document = self.document(3)
+        filename = document.filename
+        self.assertTrue(os.path.exists(filename))
+        document.close()
+        self.assertFalse(os.path.exists(filename))
+
+class PDFToHTMLTest(FakeCommandTestCase):
+    def test_pdftohtml(self):
+        document = pdftohtml(StringIO('3'), command=self.command)
+        self.assertEqual(self.texts(document.xpath('page')),
+                         ['page 1', 'page 2', 'page 3'])
+
+    def test_failure(self):
+        self.assertRaises(PDFException, pdftohtml, StringIO('2'),
+                          command=self.command, extra_args=['-f', '5'])
+
+class PDFConverterPoolTest(FakeCommandTestCase):
+    def test_imap_keeps_the_order(self):
+        with PDFConverterPool(processes=3, command=self.command) as pool:
+            documents = list(pool.imap(StringIO(str(pages))
+                                       for pages in xrange(1, 9)))
+        self.assertEqual([len(document.xpath('page'))
+                          for document in documents], range(1, 9))
+
+    def test_cache(self):
+        with PDFConverterPool(processes=2, command=self.command,
+                              cache_size=1) as pool:
+            for pages in ('2', '2', '3', '2'):
+                pool.convert(StringIO(pages))
+            self.assertEqual(len(self.calls()), 3)
+            output = pool._outputs.get(sha1('2').hexdigest())
+            self.assertTrue(os.path.exists(output))
+        self.assertFalse(os.path.exists(output))
+
+    def test_failure(self):
+        with PDFConverterPool(processes=2, command=self.command,
+                              extra_args=['-f', '5']) as pool:
+            results = pool.imap([StringIO('9'), StringIO('2')])
+            self.assertEqual(len(results.next().xpath('page')), 5)
+            self.assertRaises(PDFException, results.next)
@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+
+from eureka.pool import LRUCache, WorkerPool
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        cache = LRUCache(2, evicted.append)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(evicted, [2])
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_replacing_evicts_the_old_value(self):
+        evicted = []
+        cache = LRUCache(2, evicted.append)
+        cache.put('a', 1)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        self.assertEqual(evicted, [1])
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_clear(self):
+        evicted = []
+        cache = LRUCache(3, evicted.append)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.clear()
+        self.assertEqual(sorted(evicted), [1, 2])
+        self.assertEqual(len(cache), 0)
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_ordered(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0, 'submitted': 0}
+
+        def work(n):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'],
+                                           state['running'])
+            # later items finish first
+            time.sleep(0.01 * (10 - n))
+            with lock:
+                state['running'] -= 1
+            return n * n
+
+        def submit(n):
+            state['submitted'] += 1
+            return pool._pool.apply_async(work, (n,))
+
+        with WorkerPool(3) as pool:
+            results = pool._ordered(submit, xrange(10))
+            self.assertEqual(results.next(), 0)
+            # reads ahead at most twice as many items as there are workers
+            self.assertEqual(state['submitted'], 6)
+            self.assertEqual(list(results), [n * n for n in xrange(1, 10)])
+        self.assertTrue(state['max_running'] <= 3)
@@ -0,0 +1,115 @@
+import socket
+import threading
+import time
+import unittest
+
+from eureka.metrics import MemorySink, Metrics
+from eureka.resolver import DNSCache
+from tests.support import ServerTestCase, page
+
+class FakeResolverTestCase(unittest.TestCase):
+    '''
+    Replaces ``socket.getaddrinfo`` with a function that records the hosts
+    it is asked for, and fails for hosts ending in ".invalid".
+
+    '''
+
+    delay = 0
+
+    def setUp(self):
+        self.lookups = []
+        self.getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = self.fake_getaddrinfo
+
+    def tearDown(self):
+        socket.getaddrinfo = self.getaddrinfo
+
+    def fake_getaddrinfo(self, host, *args):
+        self.lookups.append(host)
+        time.sleep(self.delay)
+        if host.endswith('.invalid'):
+            raise socket.gaierror(socket.EAI_NONAME, 'unknown host')
+        return self.getaddrinfo('127.0.0.1', *args)
+
+class DNSCacheTest(FakeResolverTestCase):
+    def test_cache(self):
+        sink = MemorySink()
+        resolver = DNSCache()
+        addresses = resolver.resolve('Example.com', Metrics(sink))
+        self.assertEqual(addresses[0][4][0], '127.0.0.1')
+        self.assertEqual(resolver.resolve('example.com'), addresses)
+        self.assertEqual(self.lookups, ['example.com'])
+        self.assertEqual(sink.counter('dns_misses'), 1)
+
+    def test_ttl(self):
+        resolver = DNSCache(ttl=0)
+        resolver.resolve('example.com')
+        resolver.resolve('example.com')
+        self.assertEqual(len(self.lookups), 2)
+        resolver.ttl = 300
+        resolver.resolve('example.com')
+        resolver.clear()
+        resolver.resolve('example.com')
+        self.assertEqual(len(self.lookups), 4)
+
+    def test_failures_are_cached(self):
+        resolver = DNSCache()
+        for i in xrange(2):
+            self.assertRaises(socket.gaierror, resolver.resolve, 'a.invalid')
+        self.assertEqual(self.lookups, ['a.invalid'])
+        resolver = DNSCache(negative_ttl=0)
+        for i in xrange(2):
+            self.assertRaises(socket.gaierror, resolver.resolve, 'a.invalid')
+        self.assertEqual(len(self.lookups), 3)
+
+    def test_max_size(self):
+        resolver = DNSCache(max_size=2)
+        for host in ('a.com', 'b.com', 'c.com', 'c.com'):
+            resolver.resolve(host)
+        self.assertEqual(self.lookups, ['a.com', 'b.com', 'c.com'])
+        self.assertTrue(len(resolver._entries) <= 2)
+
+    def test_concurrent_lookups(self):
+        self.delay = 0.2
+        resolver = DNSCache()
+        threads = [threading.Thread(target=resolver.resolve,
+                                    args=('example.com',))
+                   for i in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.lookups, ['example.com'])
+
+    def test_prefetch(self):
+        sink = MemorySink()
+        resolver = DNSCache(workers=2)
+        resolver.resolve('cached.com')
+        resolver.prefetch(['http://Example.com:8080/page', 'example.com',
+                           'cached.com', '[::1]:80', 'b.invalid'],
+                          Metrics(sink))
+        resolver.close()
+        self.assertEqual(sorted(self.lookups),
+                         ['::1', 'b.invalid', 'cached.com', 'example.com'])
+        self.assertEqual(sink.counter('dns_prefetches'), 3)
+        resolver.resolve('example.com')
+        self.assertRaises(socket.gaierror, resolver.resolve, 'b.invalid')
+        self.assertEqual(len(self.lookups), 4)
+
+class CrawlerResolverTest(FakeResolverTestCase, ServerTestCase):
+    pages = {'/': page('hello')}
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        FakeResolverTestCase.setUp(self)
+
+    def tearDown(self):
+        FakeResolverTestCase.tearDown(self)
+        ServerTestCase.tearDown(self)
+
+    def test_connections_use_the_cache(self):
+        crawler = self.crawler(cache=False, resolver=DNSCache())
+        url = self.url().replace('127.0.0.1', 'eureka.test')
+        for i in xrange(3):
+            self.assertEqual(crawler.fetch(url).read(), 'hello')
+        self.assertEqual(self.lookups, ['eureka.test'])
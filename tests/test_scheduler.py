@@ -0,0 +1,157 @@
+import time
+import unittest
+import urllib2
+
+from eureka.metrics import null_metrics
+from eureka.scheduler import CircuitBreaker, CircuitOpen, RetryPolicy, \
+                             RetryScheduler, parse_retry_after
+from tests.support import ServerTestCase, page
+
+class FakeCrawler(object):
+    '''
+    Stands in for a crawler: ``fetch`` records its calls, and raises the
+    next of ``errors`` until they run out.
+
+    '''
+
+    metrics = null_metrics
+    circuit_breaker = None
+
+    def __init__(self, errors=(), **policy):
+        self.retry_policy = RetryPolicy(**policy)
+        self.errors = list(errors)
+        self.calls = []
+
+    def fetch(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'page %s' % url
+
+def http_error(code, headers=None):
+    return urllib2.HTTPError('http://example.com/', code, 'error',
+                             headers or {}, None)
+
+class RetrySchedulerTest(unittest.TestCase):
+    def test_fetches_in_order(self):
+        crawler = FakeCrawler()
+        scheduler = RetryScheduler(crawler)
+        for url in ('http://a/1', 'http://b/2', 'http://a/3'):
+            scheduler.add(url, cache_control='x')
+        self.assertEqual([(url, result) for url, result, error in scheduler],
+                         [('http://a/1', 'page http://a/1'),
+                          ('http://b/2', 'page http://b/2'),
+                          ('http://a/3', 'page http://a/3')])
+        self.assertEqual(crawler.calls[0][1],
+                         {'retries': 0, 'cache_control': 'x'})
+
+    def test_retries_failed_urls_later(self):
+        crawler = FakeCrawler([http_error(503)], retries=1, backoff=0)
+        scheduler = RetryScheduler(crawler)
+        scheduler.add('http://a/1')
+        scheduler.add('http://b/2')
+        results = list(scheduler)
+        self.assertEqual([url for url, result, error in results],
+                         ['http://b/2', 'http://a/1'])
+        self.assertEqual([error for url, result, error in results],
+                         [None, None])
+
+    def test_gives_up_with_the_first_error(self):
+        first = http_error(503)
+        crawler = FakeCrawler([first, http_error(502)], retries=1, backoff=0)
+        scheduler = RetryScheduler(crawler)
+        scheduler.add('http://a/1')
+        self.assertEqual(list(scheduler), [('http://a/1', None, first)])
+
+    def test_retries_keyword(self):
+        crawler = FakeCrawler([http_error(503)] * 3, retries=0, backoff=0)
+        scheduler = RetryScheduler(crawler)
+        scheduler.add('http://a/1', retries=3)
+        self.assertEqual(list(scheduler), [('http://a/1', 'page http://a/1',
+                                            None)])
+        self.assertEqual(len(crawler.calls), 4)
+        self.assertTrue(all(kwargs == {'retries': 0}
+                            for url, kwargs in crawler.calls))
+
+    def test_passes_the_remaining_deadline(self):
+        crawler = FakeCrawler()
+        scheduler = RetryScheduler(crawler)
+        scheduler.add('http://a/1', deadline=60)
+        list(scheduler)
+        deadline = crawler.calls[0][1]['deadline']
+        self.assertTrue(55 < deadline <= 60, deadline)
+
+    def test_add_lazily(self):
+        pulled = []
+        def items():
+            for i in xrange(25):
+                pulled.append(i)
+                yield 'http://a/%d' % i, {}
+        crawler = FakeCrawler()
+        scheduler = RetryScheduler(crawler)
+        scheduler.batch_size = 10
+        scheduler.add_lazily(items())
+        results = iter(scheduler)
+        results.next()
+        self.assertEqual(len(pulled), 10)
+        self.assertEqual(len(list(results)), 24)
+        self.assertEqual(len(pulled), 25)
+
+    def test_parallel(self):
+        crawler = FakeCrawler()
+        scheduler = RetryScheduler(crawler, workers=4)
+        urls = ['http://h%d/' % i for i in xrange(20)]
+        for url in urls:
+            scheduler.add(url)
+        self.assertEqual(sorted(url for url, result, error in scheduler),
+                         sorted(urls))
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failures=2, reset_after=60)
+        self.assertFalse(breaker.failure('a'))
+        self.assertTrue(breaker.failure('a'))
+        self.assertTrue(breaker.open_until('a') > time.time())
+        self.assertEqual(breaker.open_until('b'), None)
+        self.assertRaises(CircuitOpen, breaker.check, 'a')
+
+    def test_closes_again(self):
+        breaker = CircuitBreaker(failures=1, reset_after=0)
+        breaker.failure('a')
+        time.sleep(0.01)
+        self.assertEqual(breaker.open_until('a'), None)
+        breaker.check('a')
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(failures=2)
+        breaker.failure('a')
+        breaker.success('a')
+        self.assertFalse(breaker.failure('a'))
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+
+    def test_date(self):
+        wait = parse_retry_after(time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                 time.gmtime(time.time() + 100)))
+        self.assertTrue(95 <= wait <= 101, wait)
+
+    def test_policy_honors_retry_after(self):
+        policy = RetryPolicy(backoff=0)
+        error = http_error(503, {'retry-after': '7'})
+        self.assertEqual(policy.delay(0, error), 7)
+
+class DeadlineTest(ServerTestCase):
+    def test_slow_request_is_given_up_at_the_deadline(self):
+        def slow(handler):
+            time.sleep(2)
+            return page('late')
+        self.server.pages['/slow'] = slow
+        scheduler = RetryScheduler(self.crawler(cache=False))
+        scheduler.add(self.url('/slow'), deadline=0.5)
+        start = time.time()
+        [(url, result, error)] = list(scheduler)
+        self.assertEqual(result, None)
+        self.assertNotEqual(error, None)
+        self.assertTrue(time.time() - start < 1.5)
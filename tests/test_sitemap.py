@@ -0,0 +1,174 @@
+import calendar
+import gzip
+import unittest
+from StringIO import StringIO
+from time import gmtime, strftime, time
+
+from eureka.sitemap import SitemapEntry, Sitemaps, parse_sitemap, \
+                           parse_w3c_datetime
+from tests.support import ServerTestCase, page
+
+def urlset(*urls):
+    ''' a sitemap of ``urls``, which are urls or (url, lastmod) tuples '''
+
+    entries = []
+    for url in urls:
+        if isinstance(url, tuple):
+            url, lastmod = url
+            entries.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>'
+                           % (url, lastmod))
+        else:
+            entries.append('<url><loc> %s </loc></url>' % url)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            '%s</urlset>' % ''.join(entries))
+
+def sitemapindex(*urls):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex '
+            'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s'
+            '</sitemapindex>' % ''.join('<sitemap><loc>%s</loc></sitemap>'
+                                        % url for url in urls))
+
+def gzipped(text):
+    data = StringIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as fp:
+        fp.write(text)
+    return data.getvalue()
+
+def timestamp(*date):
+    return calendar.timegm(date + (0,) * (9 - len(date)))
+
+def w3c_datetime(seconds):
+    return strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(seconds))
+
+class ParseTest(unittest.TestCase):
+    def test_w3c_datetime(self):
+        self.assertEqual(parse_w3c_datetime('2012'), timestamp(2012, 1, 1))
+        self.assertEqual(parse_w3c_datetime(' 2012-03-04 '),
+                         timestamp(2012, 3, 4))
+        self.assertEqual(parse_w3c_datetime('2012-03-04T05:06Z'),
+                         timestamp(2012, 3, 4, 5, 6))
+        self.assertEqual(parse_w3c_datetime('2012-03-04T05:06:07.5+01:00'),
+                         timestamp(2012, 3, 4, 4, 6, 7))
+        self.assertEqual(parse_w3c_datetime('2012-03-04 05:06:07-0130'),
+                         timestamp(2012, 3, 4, 6, 36, 7))
+        for text in (None, '', 'yesterday', '2012-13-01', '2012-1-1'):
+            self.assertEqual(parse_w3c_datetime(text), None, text)
+
+    def check_entries(self, data):
+        entries = list(parse_sitemap(StringIO(data)))
+        self.assertEqual([(entry.loc, entry.lastmod, entry.changefreq,
+                           entry.priority, entry.is_sitemap)
+                          for entry in entries],
+                         [('http://a.com/1', None, None, None, False),
+                          ('http://a.com/2', timestamp(2012, 1, 31), 'daily',
+                           0.5, False)])
+
+    sitemap = urlset('http://a.com/1').replace('</urlset>', '''
+        <!-- a comment -->
+        <url><lastmod>2012-01-01</lastmod></url>
+        <url>
+            <loc>http://a.com/2</loc>
+            <lastmod>2012-01-31</lastmod>
+            <changefreq>daily</changefreq>
+            <priority>0.5</priority>
+        </url>
+        </urlset>''')
+
+    def test_sitemap(self):
+        self.check_entries(self.sitemap)
+
+    def test_gzipped_sitemap(self):
+        self.check_entries(gzipped(self.sitemap))
+
+    def test_sitemap_index(self):
+        entries = list(parse_sitemap(StringIO(sitemapindex(
+            'http://a.com/s1.xml', 'http://a.com/s2.xml.gz'))))
+        self.assertEqual([(entry.loc, entry.is_sitemap) for entry in entries],
+                         [('http://a.com/s1.xml', True),
+                          ('http://a.com/s2.xml.gz', True)])
+
+class SitemapsTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        url = self.url
+        for path in ('/a', '/b', '/c'):
+            self.server.pages[path] = page(path)
+        self.server.pages['/robots.txt'] = page(
+            'User-agent: *\nDisallow:\n\nSitemap: %s\n' % url('/index.xml'),
+            headers=[('Content-Type', 'text/plain')])
+        self.server.pages['/index.xml'] = page(sitemapindex(
+            url('/one.xml'), url('/two.xml.gz'), url('/broken.xml'),
+            url('/one.xml')))
+        self.serve_sitemap_one(url('/b'))
+        self.server.pages['/two.xml.gz'] = page(
+            gzipped(urlset(url('/c'), url('/a'))),
+            headers=[('Content-Type', 'application/x-gzip')])
+        self.server.pages['/broken.xml'] = page('<urlset><url>')
+
+    def serve_sitemap_one(self, b):
+        self.server.pages['/one.xml'] = page(urlset(self.url('/a'), b))
+
+    def test_discover(self):
+        self.assertEqual(Sitemaps(self.crawler(robotstxt=True))
+                         .discover(self.url('/a')), [self.url('/index.xml')])
+        self.assertEqual(Sitemaps(self.crawler())
+                         .discover(self.url('/a')), [self.url('/index.xml')])
+        del self.server.pages['/robots.txt']
+        self.assertEqual(Sitemaps(self.crawler(cache=False))
+                         .discover(self.url('/a')), [self.url('/sitemap.xml')])
+
+    def test_entries(self):
+        sitemaps = Sitemaps(self.crawler())
+        self.assertEqual([entry.loc for entry in
+                          sitemaps.entries([self.url('/index.xml')])],
+                         [self.url(path) for path in ('/a', '/b', '/c', '/a')])
+
+    def crawl(self, **kwargs):
+        sitemaps = Sitemaps(self.crawler(cache=self.cache()), **kwargs)
+        results = {}
+        for url, result, error in sitemaps.crawl([self.url('/')],
+                                                 method='fetch'):
+            self.assertEqual(error, None)
+            results[url] = result.read()
+        return results
+
+    def test_crawl(self):
+        self.assertEqual(self.crawl(),
+                         dict((self.url(path), path)
+                              for path in ('/a', '/b', '/c')))
+        pages = [path for path in self.server.paths()
+                 if path in ('/a', '/b', '/c')]
+        self.assertEqual(sorted(pages), ['/a', '/b', '/c'])
+
+        # the sitemaps are cached for the day, and the pages are unchanged
+        self.assertEqual(self.crawl(), {})
+
+        # a sitemap now says /b changed after we cached it
+        lastmod = int(time()) + 60
+        self.serve_sitemap_one((self.url('/b'), w3c_datetime(lastmod)))
+        self.assertEqual(self.crawl(cache_control='again'),
+                         {self.url('/b'): '/b'})
+        path, headers = self.server.requests[-1]
+        self.assertEqual(path, '/b')
+
+        # undated pages are fetched again if include_undated is set
+        self.serve_sitemap_one(self.url('/b'))
+        self.assertEqual(sorted(self.crawl(cache_control='undated',
+                                           include_undated=True)),
+                         [self.url(path) for path in ('/a', '/b', '/c')])
+
+    def test_changed(self):
+        crawler = self.crawler()
+        crawler.fetch(self.url('/a')).read()
+        sitemaps = Sitemaps(crawler)
+        now = int(time())
+        entries = [SitemapEntry(self.url('/a'), now - 3600),
+                   SitemapEntry(self.url('/b')),
+                   SitemapEntry(self.url('/a'), now + 60),
+                   SitemapEntry(self.url('/b'), now + 60),
+                   SitemapEntry(self.url('/a'), now + 120)]
+        self.assertEqual(list(sitemaps.changed(entries)),
+                         [(self.url('/b'), None),
+                          (self.url('/a'), 'lastmod %d' % (now + 60))])
@@ -0,0 +1,149 @@
+import os
+import stat
+import unittest
+
+try:
+    from eureka import tesseract
+    from eureka.tesseract import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy
+    from eureka.tesseract import otsu_threshold, preprocess, skew_angle
+except ImportError:
+    numpy = None
+
+from tests.support import TempDirTestCase
+
+def text_image():
+    ''' a white image with two black "text lines" '''
+
+    image = Image.new('L', (200, 100), 255)
+    for top in (30, 60):
+        image.paste(0, (40, top, 160, top + 5))
+    return image
+
+def rotated(image, angle):
+    inverted = Image.fromarray(255 - numpy.asarray(image))
+    return Image.fromarray(255 - numpy.asarray(
+        inverted.rotate(angle, Image.BICUBIC, True)))
+
+def levels(image):
+    return set(numpy.unique(numpy.asarray(image)))
+
+@unittest.skipIf(numpy is None, 'needs numpy and PIL')
+class PreprocessTest(unittest.TestCase):
+    def test_otsu_threshold(self):
+        pixels = numpy.array([[30] * 50 + [200] * 50], dtype=numpy.uint8)
+        self.assertTrue(30 <= otsu_threshold(pixels) < 200)
+
+    def test_converts_to_grayscale(self):
+        image = preprocess(text_image().convert('RGB'))
+        self.assertEqual(image.mode, 'L')
+        self.assertEqual(levels(image), set([0, 255]))
+
+    def test_black_and_white_images(self):
+        image = preprocess(text_image().convert('1'), threshold='otsu',
+                           crop=True)
+        self.assertEqual(image.mode, 'L')
+        self.assertEqual(levels(image), set([0, 255]))
+        self.assertEqual(image.size, (128, 43))
+
+    def test_threshold(self):
+        image = text_image()
+        image.paste(100, (0, 0, 10, 10))
+        self.assertEqual(levels(preprocess(image, threshold=128)),
+                         set([0, 255]))
+        self.assertEqual(levels(preprocess(image, threshold=50)),
+                         set([0, 255]))
+        self.assertEqual(numpy.asarray(preprocess(image, threshold=50))[0, 0],
+                         255)
+
+    def test_crop(self):
+        image = preprocess(text_image(), crop=True, margin=4)
+        self.assertEqual(image.size, (128, 43))
+        self.assertEqual(preprocess(text_image(), crop=True,
+                                    margin=0).size, (120, 35))
+
+    def test_crop_blank_image(self):
+        image = Image.new('L', (20, 10), 255)
+        self.assertEqual(preprocess(image, crop=True).size, (20, 10))
+
+    def test_scale(self):
+        self.assertEqual(preprocess(text_image(), scale=2).size, (400, 200))
+
+    def test_deskew(self):
+        image = rotated(text_image(), 3)
+        pixels = numpy.asarray(image)
+        self.assertAlmostEqual(abs(skew_angle(pixels)), 3, delta=0.6)
+        straight = preprocess(image, threshold='otsu', deskew=True)
+        self.assertAlmostEqual(skew_angle(numpy.asarray(straight)), 0,
+                               delta=0.6)
+
+# A fake tesseract command, which "recognizes" the checksum of the image
+# file, or fails for the language "bad". Every run is logged to calls.log.
+_tesseract = r'''#!/bin/sh
+dir=$(dirname "$0")
+echo "$1" >> "$dir/calls.log"
+if [ "$4" = bad ]; then
+    echo "Error: no such language" >&2
+    exit 1
+fi
+cksum < "$1" | cut -d' ' -f1 > "$2.txt"
+'''
+
+@unittest.skipIf(Image is None, 'needs PIL')
+class OCRPoolTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        command = self.path('tesseract')
+        with open(command, 'w') as script:
+            script.write(_tesseract)
+        os.chmod(command, stat.S_IRWXU)
+        self.original_cmd = tesseract.tesseract_cmd
+        tesseract.tesseract_cmd = command
+
+    def tearDown(self):
+        tesseract.tesseract_cmd = self.original_cmd
+        TempDirTestCase.tearDown(self)
+
+    def calls(self):
+        try:
+            with open(self.path('calls.log')) as log:
+                return log.read().split()
+        except IOError:
+            return []
+
+    def images(self):
+        return [Image.new('L', (10 + i, 10), 255) for i in xrange(6)]
+
+    def test_map_keeps_the_order(self):
+        expected = [tesseract.image_to_string(image)
+                    for image in self.images()]
+        self.assertEqual(len(set(expected)), 6)
+        with tesseract.OCRPool(workers=3) as pool:
+            self.assertEqual(list(pool.map(self.images())), expected)
+
+    def test_cache(self):
+        with tesseract.OCRPool(workers=2) as pool:
+            first = list(pool.map(self.images()))
+            self.assertEqual(list(pool.map(self.images())), first)
+            self.assertEqual(pool.image_to_string(self.images()[2]),
+                             first[2])
+        self.assertEqual(len(self.calls()), 6)
+
+    def test_files_stay_in_the_pool_directory(self):
+        pool = tesseract.OCRPool(workers=2)
+        directory = pool.directory
+        list(pool.map(self.images()))
+        self.assertTrue(all(os.path.dirname(call) == directory
+                            for call in self.calls()))
+        self.assertEqual(os.listdir(directory), [])
+        pool.close()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_errors(self):
+        with tesseract.OCRPool(workers=2, lang='bad') as pool:
+            self.assertRaises(tesseract.TesseractError,
+                              pool.image_to_string, self.images()[0])
@@ -0,0 +1,137 @@
+import threading
+import time
+import unittest
+import urllib2
+
+from eureka.metrics import MemorySink, Metrics
+from eureka.throttle import HostThrottle
+from tests.support import ServerTestCase, page
+
+class FakeRequest(object):
+    ''' the attributes that ``HostThrottle.http_open`` sets on a request '''
+
+    def __init__(self, throttle, host='a.com'):
+        self.throttle_slot = throttle.acquire(host)
+        self.throttle_host = host
+        self.throttle_start = time.time()
+
+class HostThrottleTest(unittest.TestCase):
+    def test_additive_increase(self):
+        throttle = HostThrottle(initial=2, maximum=4)
+        for i in xrange(4):
+            throttle.release(FakeRequest(throttle), 200)
+        self.assertEqual(throttle.limit('a.com'), 3)
+        for i in xrange(20):
+            throttle.release(FakeRequest(throttle), 200)
+        self.assertEqual(throttle.limit('a.com'), 4)
+        self.assertEqual(throttle.limit('b.com'), 2)
+
+    def test_multiplicative_decrease(self):
+        sink = MemorySink()
+        throttle = HostThrottle(initial=8)
+        throttle.metrics = Metrics(sink)
+        throttle.release(FakeRequest(throttle), 429)
+        self.assertEqual(throttle.limit('a.com'), 4)
+        # answers to requests that were already running don't count again
+        throttle.release(FakeRequest(throttle), 503)
+        throttle.release(FakeRequest(throttle))
+        self.assertEqual(throttle.limit('a.com'), 4)
+        self.assertEqual(sink.counter('throttle_decreases'), 1)
+
+    def test_minimum(self):
+        throttle = HostThrottle(initial=1, minimum=1)
+        throttle.release(FakeRequest(throttle), 429)
+        self.assertEqual(throttle.limit('a.com'), 1)
+
+    def test_release_twice(self):
+        throttle = HostThrottle(initial=1)
+        request = FakeRequest(throttle)
+        throttle.release(request, 200)
+        throttle.release(request, 429)
+        self.assertEqual(throttle.limit('a.com'), 2)
+
+    def test_retry_after(self):
+        throttle = HostThrottle(max_pause=60)
+        throttle.release(FakeRequest(throttle), 503, {'retry-after': '30'})
+        self.assertAlmostEqual(throttle.wait_time('a.com'), 30, delta=1)
+        self.assertEqual(throttle.wait_time('b.com'), 0)
+        throttle.release(FakeRequest(throttle, 'b.com'), 429,
+                         {'retry-after': '86400'})
+        self.assertAlmostEqual(throttle.wait_time('b.com'), 60, delta=1)
+
+    def test_pause_blocks_acquire(self):
+        throttle = HostThrottle()
+        throttle.release(FakeRequest(throttle), 429, {'retry-after': '1'})
+        start = time.time()
+        throttle.acquire('a.com')
+        self.assertTrue(time.time() - start >= 0.9)
+
+    def test_acquire_waits_for_a_free_slot(self):
+        throttle = HostThrottle(initial=1)
+        request = FakeRequest(throttle)
+        self.assertTrue(throttle.wait_time('a.com') > 0)
+        timer = threading.Timer(0.2, throttle.release, (request, 200))
+        timer.start()
+        start = time.time()
+        throttle.acquire('a.com')
+        self.assertTrue(time.time() - start >= 0.15)
+        timer.join()
+
+    def test_slots_expire(self):
+        sink = MemorySink()
+        throttle = HostThrottle(initial=1, slot_timeout=0.2)
+        throttle.metrics = Metrics(sink)
+        throttle.acquire('a.com') # never released
+        start = time.time()
+        throttle.acquire('a.com')
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(sink.counter('throttle_expired_slots'), 1)
+
+class CrawlerThrottleTest(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.running = self.most_running = 0
+        self.lock = threading.Lock()
+        self.server.pages['/slow'] = self.slow
+        self.server.pages['/busy'] = page('busy', 429, [('Retry-After',
+                                                          '30')])
+        self.server.pages['/broken'] = lambda handler: None
+
+    def slow(self, handler):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        return page('slow')
+
+    def test_limits_concurrent_requests(self):
+        throttle = HostThrottle(initial=2, maximum=2)
+        crawler = self.crawler(cache=False, threadsafe=True,
+                               throttle=throttle)
+        threads = [threading.Thread(target=crawler.fetch,
+                                    args=(self.url('/slow'),))
+                   for i in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.most_running, 2)
+
+    def test_retry_after_pauses_the_host(self):
+        throttle = HostThrottle()
+        crawler = self.crawler(cache=False, throttle=throttle)
+        self.assertRaises(urllib2.HTTPError, crawler.fetch,
+                          self.url('/busy'))
+        host = self.url()[len('http://'):-1]
+        self.assertAlmostEqual(throttle.wait_time(host), 30, delta=1)
+
+    def test_failed_requests_give_back_their_slot(self):
+        throttle = HostThrottle(initial=1)
+        crawler = self.crawler(cache=False, throttle=throttle)
+        host = self.url()[len('http://'):-1]
+        for i in xrange(3):
+            self.assertRaises(Exception, crawler.fetch, self.url('/broken'))
+        self.assertEqual(throttle._state(host).slots, {})
@@ -0,0 +1,121 @@
+import sqlite3
+import unittest
+
+from eureka.url import URLCanonicalizer, URLSet, canonicalize_url, hostname
+from tests.support import ServerTestCase, page
+
+class CanonicalizeTest(unittest.TestCase):
+    def test_equivalent_urls(self):
+        for url, canonical in [
+                ('HTTP://Example.COM', 'http://example.com/'),
+                ('http://example.com:80/a', 'http://example.com/a'),
+                ('https://example.com:443/a', 'https://example.com/a'),
+                ('http://example.com:8080/a', 'http://example.com:8080/a'),
+                ('http://example.com/a/./b/../c', 'http://example.com/a/c'),
+                ('http://example.com/a/b/..', 'http://example.com/a/'),
+                ('http://example.com/%7euser/%2f%41', 'http://example.com/'
+                                                      '~user/%2FA'),
+                ('http://example.com/?b=2&a=1&',
+                 'http://example.com/?a=1&b=2'),
+                ('http://example.com/p#top', 'http://example.com/p'),
+                ('http://example.com/p?jsessionid=1&x=2',
+                 'http://example.com/p?x=2'),
+                ('http://example.com/p;jsessionid=ABC?x=2',
+                 'http://example.com/p?x=2'),
+                ('http://[::1]:80/', 'http://[::1]/'),
+                ('http://user@Example.com:80/', 'http://user@example.com/'),
+                ('not a url', 'not a url')]:
+            self.assertEqual(canonicalize_url(url), canonical)
+
+    def test_idempotent(self):
+        url = 'http://Example.com:80/a/../b?z=1&a=%7e#x'
+        self.assertEqual(canonicalize_url(canonicalize_url(url)),
+                         canonicalize_url(url))
+
+    def test_options(self):
+        canonicalizer = URLCanonicalizer(sort_query=False,
+                                         drop_fragment=False)
+        self.assertEqual(canonicalizer('http://a.com/?b=1&a=2#%7e'),
+                         'http://a.com/?b=1&a=2#~')
+
+    def test_rules(self):
+        canonicalizer = URLCanonicalizer(rules={'example.com': ('ref',
+                                                                'utm_*')})
+        self.assertEqual(canonicalizer('http://www.example.com/?ref=x&'
+                                       'utm_source=y&UTM_medium=z&id=1'),
+                         'http://www.example.com/?id=1')
+        self.assertEqual(canonicalizer('http://example.com:8080/?ref=x'),
+                         'http://example.com:8080/')
+        self.assertEqual(canonicalizer('http://other.com/?ref=x'),
+                         'http://other.com/?ref=x')
+        canonicalizer.add_rule('other.com', ['ref'])
+        self.assertEqual(canonicalizer('http://other.com/?ref=x'),
+                         'http://other.com/')
+
+class URLSetTest(unittest.TestCase):
+    def test_add(self):
+        urls = URLSet(['http://a.com/?x=1&y=2'])
+        self.assertFalse(urls.add('http://A.com:80/?y=2&x=1#f'))
+        self.assertTrue(urls.add('http://a.com/other'))
+        self.assertTrue('HTTP://A.COM/other' in urls)
+        self.assertEqual(len(urls), 2)
+        urls.discard('http://a.com/other#x')
+        self.assertEqual(len(urls), 1)
+
+    def test_verbatim(self):
+        urls = URLSet(['http://a.com/'], canonicalizer=None)
+        self.assertTrue(urls.add('http://A.com/'))
+
+class HostnameTest(unittest.TestCase):
+    def test_hostname(self):
+        for netloc, host in [('Example.COM', 'example.com'),
+                             ('example.com:8080', 'example.com'),
+                             ('user@example.com:21', 'example.com'),
+                             ('[::1]', '::1'), ('[::1]:8080', '::1'),
+                             ('[FE80::1]:80', 'fe80::1'), ('::1', '::1'),
+                             ('', '')]:
+            self.assertEqual(hostname(netloc), host)
+
+class CrawlerCanonicalizationTest(ServerTestCase):
+    pages = {'/p': page('page')}
+
+    def test_is_new_url(self):
+        crawler = self.crawler(cache=False)
+        self.assertTrue(crawler.is_new_url('http://a.com/?b=1&a=2'))
+        self.assertFalse(crawler.is_new_url('http://A.com/?a=2&b=1'))
+
+    def test_turned_off(self):
+        crawler = self.crawler(cache=False, canonicalizer=None)
+        self.assertEqual(crawler.canonicalizer, None)
+        self.assertTrue(crawler.is_new_url('http://a.com/?b=1&a=2'))
+        self.assertTrue(crawler.is_new_url('http://a.com/?a=2&b=1'))
+
+    def test_cache_keys(self):
+        crawler = self.crawler()
+        crawler.fetch(self.url('/p?b=1&a=2')).read()
+        fp = crawler.fetch(self.url('/p?a=2&b=1#x'))
+        self.assertTrue(fp.is_from_cache)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_existing_databases_keep_their_keys(self):
+        # a database written before urls were canonicalized
+        old = self.crawler(cache=self.cache(canonicalizer=None))
+        old.fetch(self.url('/p?b=1&a=2')).read()
+        old.cache.connection.execute('PRAGMA user_version = 0')
+        old.cache.connection.close()
+        self.server.pages['/p'] = page('new page')
+
+        crawler = self.crawler()
+        self.assertEqual(crawler.fetch(self.url('/p?b=1&a=2')).read(),
+                         'page')
+        self.assertEqual(crawler.fetch(self.url('/p?a=2&b=1')).read(),
+                         'new page')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_new_databases_use_canonical_keys(self):
+        self.crawler().fetch(self.url('/p?b=1&a=2')).read()
+        database = sqlite3.connect(self.path('cache.sqlite'))
+        self.assertEqual(database.execute('PRAGMA user_version').fetchone(),
+                         (1,))
+        self.assertEqual(database.execute('SELECT url FROM cache').fetchall(),
+                         [(self.url('/p?a=2&b=1'),)])
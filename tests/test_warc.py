@@ -0,0 +1,171 @@
+import gzip
+import unittest
+import urllib2
+from StringIO import StringIO
+
+from eureka.metrics import MemorySink, Metrics
+from eureka.warc import WARCCache, WARCError, export_warc, import_warc, \
+                        read_records, write_record
+from tests.support import ServerTestCase, page, redirect
+
+def gzipped(text):
+    data = StringIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as fp:
+        fp.write(text)
+    return data.getvalue()
+
+class RecordTest(unittest.TestCase):
+    records = [([('WARC-Type', 'warcinfo')], 'software: eureka\r\n'),
+               ([('WARC-Type', 'response'),
+                 ('WARC-Target-URI', 'http://a.com/\r\nx')],
+                'HTTP/1.1 200 OK\r\n\r\n' + ''.join(map(chr, range(256))))]
+
+    def check_roundtrip(self, compress):
+        fp = StringIO()
+        for headers, block in self.records:
+            write_record(fp, headers, block, compress)
+        data = fp.getvalue()
+        if compress:
+            self.assertEqual(data[:2], '\x1f\x8b')
+            fp = gzip.GzipFile(fileobj=StringIO(data), mode='rb')
+        else:
+            fp = StringIO(data)
+        records = list(read_records(fp))
+        self.assertEqual([record.block for record in records],
+                         [block for headers, block in self.records])
+        self.assertEqual([record.type for record in records],
+                         ['warcinfo', 'response'])
+        self.assertEqual(records[1].headers['warc-target-uri'],
+                         'http://a.com/  x')
+        self.assertTrue(records[0].headers['warc-record-id']
+                        .startswith('<urn:uuid:'))
+
+    def test_roundtrip(self):
+        self.check_roundtrip(False)
+
+    def test_compressed_roundtrip(self):
+        self.check_roundtrip(True)
+
+    def test_errors(self):
+        self.assertRaises(WARCError, list, read_records(StringIO('HTTP/1.1')))
+        fp = StringIO()
+        write_record(fp, [('WARC-Type', 'response')], 'x' * 100)
+        self.assertRaises(WARCError, list,
+                          read_records(StringIO(fp.getvalue()[:-10])))
+        self.assertRaises(WARCError, list, read_records(StringIO(
+            'WARC/1.0\r\nWARC-Type: response\r\n\r\n')))
+
+class WARCTest(ServerTestCase):
+    pages = {'/a': page('page a'),
+             '/gzip': page(gzipped('compressed'),
+                           headers=[('Content-Encoding', 'gzip')]),
+             '/missing': page('not here', 404),
+             '/moved': redirect('/a'),
+             '/form': page('posted')}
+
+    def fill(self, crawler):
+        ''' fetches the test pages, and returns what the crawler got '''
+
+        results = []
+        for path in ('/a', '/gzip', '/moved'):
+            results.append(crawler.fetch(self.url(path)).read())
+        results.append(crawler.fetch(self.url('/form'), data='x=1').read())
+        for version in (1, 2):
+            self.server.pages['/v'] = page('version %d\n' % version * 100)
+            results.append(crawler.fetch(self.url('/v'),
+                                         cache_control=version).read())
+        try:
+            crawler.fetch(self.url('/missing'))
+        except urllib2.HTTPError, e:
+            results.append((e.code, e.read()))
+        return results
+
+    def rows(self, cache):
+        return sorted((url, str(postdata or ''), headers, cache_control,
+                       response_url, code, message,
+                       str(cache._resolve(data, delta_base)))
+                      for url, postdata, headers, cache_control,
+                          response_url, code, message, data, delta_base
+                      in cache.connection.execute('''
+                          SELECT url, postdata, headers, cache_control,
+                                 response_url, response_code,
+                                 response_message, response_data, delta_base
+                          FROM cache'''))
+
+    def check_roundtrip(self, filename):
+        from eureka.cache import Cache
+        cache = self.cache()
+        expected = self.fill(self.crawler(cache=cache))
+        count = len(self.server.requests)
+        path = self.path(filename)
+        self.assertEqual(export_warc(cache, path), len(self.rows(cache)))
+
+        other = Cache(self.path('other.sqlite'))
+        self.assertEqual(import_warc(other, path), len(self.rows(cache)))
+        self.assertEqual(self.rows(other), self.rows(cache))
+        self.assertEqual(import_warc(other, path), 0)
+
+        self.assertEqual(self.fill(self.crawler(cache=other)), expected)
+        self.assertEqual(len(self.server.requests), count)
+
+        warc_cache = WARCCache(path)
+        self.assertEqual(len(warc_cache), len(self.rows(cache)))
+        self.assertEqual(self.fill(self.crawler(cache=warc_cache)), expected)
+        self.assertEqual(len(self.server.requests), count)
+
+    def test_roundtrip(self):
+        self.check_roundtrip('crawl.warc')
+
+    def test_compressed_roundtrip(self):
+        self.check_roundtrip('crawl.warc.gz')
+
+    def test_export_like(self):
+        cache = self.cache()
+        self.fill(self.crawler(cache=cache))
+        path = self.path('crawl.warc')
+        self.assertEqual(export_warc(cache, path, like='%/v'), 2)
+        self.assertEqual([record.type for record in read_records(path)],
+                         ['warcinfo', 'response', 'response'])
+
+    def foreign_warc(self):
+        ''' a WARC file written by another tool '''
+
+        path = self.path('foreign.warc')
+        with open(path, 'wb') as fp:
+            write_record(fp, [('WARC-Type', 'request'),
+                              ('WARC-Target-URI', self.url('/a'))],
+                         'GET /a HTTP/1.1\r\n\r\n')
+            write_record(fp, [('WARC-Type', 'response'),
+                              ('WARC-Target-URI', '<%s>' % self.url('/a')),
+                              ('WARC-Date', '2012-01-31T12:00:00Z')],
+                         'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n'
+                         '\r\narchived a')
+        return path
+
+    def test_import_foreign_warc(self):
+        cache = self.cache()
+        crawler = self.crawler(cache=cache)
+        self.assertEqual(import_warc(cache, self.foreign_warc(),
+                                     headers=crawler.opener.addheaders), 1)
+        self.assertEqual(crawler.fetch(self.url('/a')).read(), 'archived a')
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(cache.last_fetched(self.url('/a')), 1328011200)
+
+    def test_warc_cache(self):
+        sink = MemorySink()
+        crawler = self.crawler(metrics=Metrics(sink))
+        cache = WARCCache(self.foreign_warc(),
+                          headers=crawler.opener.addheaders)
+        crawler = self.crawler(cache=cache, metrics=Metrics(sink))
+        self.assertEqual(crawler.fetch(self.url('/a')).read(), 'archived a')
+        self.assertEqual(cache.last_fetched(self.url('/a')), 1328011200)
+        self.assertEqual(cache.last_fetched(self.url('/other')), None)
+
+        # pages that aren't in the file are downloaded, but not stored
+        for i in xrange(2):
+            self.assertEqual(crawler.fetch(self.url('/form')).read(),
+                             'posted')
+        self.assertEqual(self.server.paths(), ['/form', '/form'])
+        self.assertEqual((sink.counter('cache_hits'),
+                          sink.counter('cache_misses')), (1, 2))
+        self.assertRaises(Exception, cache.clear)